@@ -1,4 +1,5 @@
 from .config import Config
+from .cache import ChangeStreamInvalidator, DocumentCache
 from .convert import Convert
 from .file import File
 from .db import DB
@@ -0,0 +1,302 @@
+import copy
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from logging import INFO, getLogger
+from typing import Any, Generator
+
+from bson import DBRef, ObjectId
+from pymongo import errors
+
+from edman import Config
+
+
+class DocumentCache:
+    """
+    | ドキュメントの読み込み用キャッシュ
+    | (コレクション, _id)をキーとするサイズ上限付きのLRUキャッシュ
+    |
+    | maxsizeを超えた場合は最も長く参照されていないドキュメントから破棄する
+    | ttl(秒)を指定した場合は、格納してからttl秒を超えたドキュメントを破棄する
+    | 格納時と取得時にコピーするため、取得したドキュメントを変更してもよい
+    |
+    | put()でmembersを指定した場合は、membersのいずれかを破棄した際に
+    | その項目も破棄する(ツリー全体をキャッシュする場合など)
+    |
+    | get(), put(), invalidate(), clear()を持つオブジェクトであれば
+    | DB(cache=...)に代わりに指定できる
+    """
+
+    def __init__(self, maxsize=1024, ttl=None) -> None:
+        if maxsize < 1:
+            raise ValueError('maxsizeは1以上を指定してください')
+        if ttl is not None and ttl <= 0:
+            raise ValueError('ttlは0より大きい値を指定してください')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[
+            tuple[str, Any], tuple[float, dict, frozenset]] = OrderedDict()
+        # members -> 項目のキー
+        self._index: dict[tuple[str, Any], set] = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, collection: str, oid: ObjectId) -> dict | None:
+        """
+        | キャッシュからドキュメントを取得する
+        | 存在しない場合と期限切れの場合はNoneを返す
+
+        :param str collection:
+        :param ObjectId oid:
+        :return: ドキュメントのコピー
+        :rtype: dict or None
+        """
+        key = (collection, oid)
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl is not None and \
+                    time.monotonic() - item[0] > self.ttl:
+                self._discard(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            doc = item[1]
+        return copy.deepcopy(doc)
+
+    def put(self, collection: str, oid: ObjectId, doc: dict,
+            members=None) -> None:
+        """
+        ドキュメントをキャッシュに格納する
+
+        :param str collection:
+        :param ObjectId oid:
+        :param dict doc:
+        :param members: 依存する(コレクション, ObjectId)のリスト default None
+        :type members: list or None
+        :return:
+        """
+        key = (collection, oid)
+        doc = copy.deepcopy(doc)
+        depends = frozenset(members or ()) - {key}
+        with self._lock:
+            self._discard(key)
+            self._data[key] = (time.monotonic(), doc, depends)
+            for member in depends:
+                self._index[member].add(key)
+            while len(self._data) > self.maxsize:
+                self._discard(next(iter(self._data)))
+
+    def _discard(self, key: tuple) -> None:
+        """
+        | 項目を破棄する
+        | ロックを取得した状態で呼び出すこと
+
+        :param tuple key:
+        :return:
+        """
+        if (item := self._data.pop(key, None)) is None:
+            return
+        for member in item[2]:
+            if (keys := self._index.get(member)) is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[member]
+
+    def invalidate(self, collection: str, oids=None) -> None:
+        """
+        | 指定のドキュメントと、それをmembersに含む項目をキャッシュから破棄する
+        | oidsがNoneの場合はコレクション単位で破棄する
+
+        :param str collection:
+        :param oids: ObjectIdのリスト default None
+        :type oids: list or None
+        :return:
+        """
+        with self._lock:
+            if oids is None:
+                targets = {k for k in self._data if k[0] == collection}
+                for member, keys in self._index.items():
+                    if member[0] == collection:
+                        targets.update(keys)
+            else:
+                targets = set()
+                for oid in oids:
+                    key = (collection, oid)
+                    targets.add(key)
+                    targets.update(self._index.get(key, ()))
+            for key in targets:
+                self._discard(key)
+
+    def clear(self) -> None:
+        """
+        キャッシュを全て破棄する(カウンタはそのまま)
+
+        :return:
+        """
+        with self._lock:
+            self._data.clear()
+            self._index.clear()
+
+    def stats(self) -> dict:
+        """
+        キャッシュの利用状況を取得する
+
+        :return: hits, misses, size, maxsize
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class ChangeStreamInvalidator:
+    """
+    | チェンジストリームを監視し、他のプロセスの書き込みをキャッシュに反映する
+    | (MongoDBがレプリカセットまたはシャードクラスタであること)
+    |
+    | 変更されたドキュメントを各キャッシュから破棄する
+    | membersに含むツリー(Search(tree_cache=...)など)もまとめて破棄される
+    | リファレンス(parent, child, root)が変更された場合は
+    | 参照先のドキュメントも破棄する
+    | 監視が途切れた場合は、再開後にキャッシュを全て破棄する
+    |
+    | cachesを省略した場合はDB(cache=...)とDB.add_cache()で登録した
+    | キャッシュを対象とする
+    """
+
+    _ref_keys = (Config.parent, Config.child, Config.root)
+
+    def __init__(self, db, caches=None, max_await_time_ms=1000,
+                 retry_interval=1.0) -> None:
+        if caches is None:
+            caches = db.caches
+        self.edman_db = db
+        self.caches = list(caches)
+        self.max_await_time_ms = max_await_time_ms
+        self.retry_interval = retry_interval
+        self.resume_token = None
+        self.events = 0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        # ログ設定(トップに伝搬し、利用側でログとして取得してもらう)
+        self.logger = getLogger(__name__)
+        self.logger.setLevel(INFO)
+        self.logger.propagate = True
+
+    def start(self) -> None:
+        """
+        監視用のスレッドを開始する
+
+        :return:
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None) -> None:
+        """
+        監視用のスレッドを停止する
+
+        :param timeout: 停止を待つ秒数 default None
+        :type timeout: float or None
+        :return:
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run(self) -> None:
+        """
+        | stop()が呼ばれるまでチェンジストリームを監視する
+        | 接続エラーの場合はretry_interval秒後に再開する
+
+        :return:
+        """
+        lost = False
+        while not self._stop.is_set():
+            try:
+                with self.edman_db.get_db.watch(
+                        resume_after=self.resume_token,
+                        max_await_time_ms=self.max_await_time_ms) as stream:
+                    # 途切れていた間の変更は分からないので全て破棄する
+                    if lost:
+                        self.clear()
+                        lost = False
+                    while not self._stop.is_set():
+                        if (change := stream.try_next()) is not None:
+                            self.handle(change)
+                        self.resume_token = stream.resume_token
+            except errors.PyMongoError as e:
+                self.logger.info(f'change stream interrupted: {e}')
+                self.resume_token = None
+                lost = True
+                self._stop.wait(self.retry_interval)
+
+    def clear(self) -> None:
+        """
+        全てのキャッシュを破棄する
+
+        :return:
+        """
+        for cache in self.caches:
+            cache.clear()
+
+    def handle(self, change: dict) -> None:
+        """
+        チェンジイベントに該当するドキュメントをキャッシュから破棄する
+
+        :param dict change: チェンジイベント
+        :return:
+        """
+        self.events += 1
+        operation = change['operationType']
+        if operation in ('dropDatabase', 'invalidate'):
+            self.clear()
+            return
+
+        collection = change.get('ns', {}).get('coll')
+        if operation in ('drop', 'rename'):
+            for cache in self.caches:
+                cache.invalidate(collection)
+            return
+        if 'documentKey' not in change:
+            return
+
+        targets = defaultdict(list)
+        targets[collection].append(change['documentKey']['_id'])
+        changed = dict(change.get('fullDocument') or {})
+        changed.update(
+            (change.get('updateDescription') or {}).get('updatedFields', {}))
+        for field, value in changed.items():
+            if field.split('.')[0] in self._ref_keys:
+                for ref in self._dbrefs(value):
+                    targets[ref.collection].append(ref.id)
+
+        for cache in self.caches:
+            for target_collection, oids in targets.items():
+                cache.invalidate(target_collection, oids)
+
+    @staticmethod
+    def _dbrefs(value) -> Generator:
+        """
+        値に含まれるDBRefを取り出すジェネレータ
+
+        :param value: DBRefまたはDBRefのリスト
+        :return:
+        :rtype: Generator
+        """
+        if isinstance(value, DBRef):
+            yield value
+        elif isinstance(value, list):
+            yield from (i for i in value if isinstance(i, DBRef))
@@ -14,10 +14,20 @@ class Config:
     parent = '_ed_parent'  # 親のリファレンス情報
     child = '_ed_child'  # 子のリファレンス情報
     file = '_ed_file'  # Grid.fsのリファレンス情報
+    # ツリー構造の補助情報(ref形式で任意に付与)
+    ancestors = '_ed_ancestors'  # ルートから親までのリファレンス情報
+    root = '_ed_root'  # ルートのリファレンス情報
+    depth = '_ed_depth'  # ルートからの階層の深さ
+    # 楽観的排他制御用のリビジョン(任意に付与)
+    revision = '_ed_rev'  # 書き込み毎に1ずつ増える
 
     # Grid.fsのデフォルトコレクション名
     fs_files = 'fs.files'  # ファイルコレクション名
     fs_chunks = 'fs.chunks'  # ファイルチャンクコレクション名
+    # 重複排除したファイルの参照数(fs.filesに付与)
+    fs_refcount = 'refcount'
+    # oidと所属コレクションの対応表のコレクション名(任意で利用)
+    registry = '_ed_registry'
 
     # ユーザがJSON内で使用するキー
     # 日付に変換する場合
@@ -2,12 +2,13 @@ import copy
 import datetime
 from collections import defaultdict
 from logging import INFO, getLogger
-from typing import Any, Union
+from typing import IO, Any, Iterator, Union
 
 from bson import DBRef, ObjectId
 
 from edman import Config
 from edman.exceptions import EdmanFormatError, EdmanInternalError
+from edman.json_manager import JsonManager
 from edman.utils import Utils
 
 
@@ -20,6 +21,9 @@ class Convert:
         config = Config()  # システム環境用の設定を読み込む
         self.parent = config.parent
         self.child = config.child
+        self.ancestors = config.ancestors
+        self.root = config.root
+        self.depth = config.depth
         self.date = config.date
 
         # ログ設定(トップに伝搬し、利用側でログとして取得してもらう)
@@ -52,6 +56,23 @@ class Convert:
 
         return {self.child: children}
 
+    def _get_ancestors_reference(self, ref_list: list) -> dict:
+        """
+        | 祖先のリファレンス情報を作成して取得
+        |
+        | ref_listにはルートから自分までのリファレンスが順番に入っている
+        | ルートの場合は祖先は空リスト、深さは0でルートのリファレンスは付与しない
+
+        :param list ref_list:
+        :return:
+        :rtype: dict
+        """
+        result = {self.ancestors: ref_list[:-1],
+                  self.depth: len(ref_list) - 1}
+        if len(ref_list) > 1:
+            result.update({self.root: ref_list[0]})
+        return result
+
     def _convert_datetime(self, child_dict: dict) -> dict:
         """
         | 辞書内辞書になっている文字列日付時間データを、辞書内日付時間に変換
@@ -168,11 +189,13 @@ class Convert:
 
         return output
 
-    def _ref(self, raw_data: dict) -> list:
+    def _ref(self, raw_data: dict, ancestors=False) -> list:
         """
-        リファレンスモードでedman用に変換を行う
+        | リファレンスモードでedman用に変換を行う
+        | ancestorsがTrueの場合は祖先、ルートのリファレンスと深さを各ドキュメントに付与する
 
         :param dict raw_data:
+        :param bool ancestors: default False
         :return:
         :rtype: list
         """
@@ -220,6 +243,9 @@ class Convert:
                     if self.parent not in tmp:
                         tmp.update({'_id': ref_list[0].id})
 
+                    if ancestors:
+                        tmp.update(self._get_ancestors_reference(ref_list))
+
                     del ref_list[my]
 
                     # バルクインサート用のリストを作成
@@ -264,6 +290,10 @@ class Convert:
                         if list(child_ref.values())[0]:  # 子データがない場合もある
                             tmp.update(child_ref)
 
+                        if ancestors:
+                            tmp.update(
+                                self._get_ancestors_reference(ref_list))
+
                         del ref_list[my]
                         tmp_list.append(tmp)
 
@@ -288,6 +318,158 @@ class Convert:
         _ = recursive(raw_data)
         return self._list_organize(list_output)
 
+    def stream_to_edman(self, fp: IO, batch_size=1000, ancestors=False,
+                        buffer_size=65536) -> Iterator[list]:
+        """
+        | JSONをファイルオブジェクトから少しずつ読み込み、
+        | リファレンスモードでedman用に変換するジェネレータ
+        |
+        | dict_to_edman()と違いJSON全体を辞書として読み込まない
+        | 子要素まで読み終えたドキュメントから順にバッファに入れ、
+        | batch_size件たまるごとにインサート用のリストデータを返す
+        | そのため使用メモリは階層の深さとbatch_sizeで決まる
+        | 返ってくるデータはそのままDB.insert()に渡せる
+        | 子のドキュメントは親より先に返される
+        |
+        | (例)
+        | with open('data.json', 'rb') as f:
+        |     for insert_data in convert.stream_to_edman(f):
+        |         db.insert(insert_data)
+
+        :param fp: 読み込み対象のファイルオブジェクト
+        :type fp: IO
+        :param int batch_size: 1回に返すドキュメント数 default 1000
+        :param bool ancestors: default False
+        :param int buffer_size: 1回に読み込むサイズ default 65536
+        :return: インサート用のリストデータ
+        :rtype: Iterator
+        """
+        if batch_size < 1:
+            raise EdmanFormatError('batch_sizeは1以上を指定してください')
+
+        buffer: dict[str, list] = defaultdict(list)
+        buffered = 0
+        # 読み込み途中のドキュメントやリストのスタック
+        # typeはtop(JSONの一番外側), doc, listのいずれか
+        frames: list[dict] = []
+
+        def new_doc(collection: str, maybe_date: bool) -> dict:
+            """
+            ドキュメントの読み込みを開始する
+            """
+            parent_path: list = next(
+                (f['path'] for f in reversed(frames) if f['type'] == 'doc'),
+                [])
+            ref = DBRef(collection, ObjectId())
+            return {'type': 'doc', 'collection': collection,
+                    'path': parent_path + [ref], 'doc': {'_id': ref.id},
+                    'children': [], 'key': None,
+                    'maybe_date': maybe_date, 'is_date': False}
+
+        def set_field(frame: dict, key: str, value: Any) -> None:
+            """
+            ドキュメントに値を入れる
+            """
+            if frame['type'] == 'top':
+                raise EdmanFormatError(f'この名前はコレクション名にできません {key}')
+            if not Utils.field_name_check(key):
+                raise EdmanFormatError(f'フィールド名に不備があります {key}')
+            frame['doc'][key] = value
+
+        def finish_doc(frame: dict) -> dict | None:
+            """
+            | 読み込みを終えたドキュメントにリファレンスを付与する
+            | 日付データの場合は親のドキュメントのフィールドにする
+            """
+            owner = frames[-1] if frames[-1]['type'] != 'list' else frames[-2]
+            if frame['is_date']:
+                if frame['children']:
+                    raise EdmanFormatError(
+                        f'日付データに子要素は含められません {frame["collection"]}')
+                set_field(owner, frame['collection'],
+                          Utils.to_datetime(frame['doc'][self.date]))
+                return None
+
+            if not Utils.collection_name_check(frame['collection']):
+                raise EdmanFormatError(
+                    f'この名前はコレクション名にできません {frame["collection"]}')
+            path = frame['path']
+            doc = frame['doc']
+            if len(path) > 1:
+                doc.update({self.parent: path[-2]})
+            if frame['children']:
+                doc.update({self.child: frame['children']})
+            if ancestors:
+                doc.update(self._get_ancestors_reference(path))
+            if owner['type'] == 'doc':
+                owner['children'].append(path[-1])
+            return doc
+
+        for event, value in JsonManager.iter_events(fp, buffer_size):
+            frame = frames[-1] if frames else None
+
+            if frame is None:
+                if event != 'start_map':
+                    raise EdmanFormatError('JSONの一番外側は辞書にしてください')
+                frames.append({'type': 'top', 'key': None})
+
+            elif event == 'map_key':
+                frame['key'] = value
+                # 辞書内に日付のキーがあれば日付データとして扱う
+                if frame['type'] == 'doc' and frame['maybe_date'] and (
+                        value == self.date):
+                    frame['is_date'] = True
+
+            elif event == 'value':
+                if frame['type'] == 'list':
+                    if frame['is_children']:
+                        raise EdmanFormatError(
+                            f'子要素のリストに値は含められません {frame["key"]}')
+                    frame['items'].append(value)
+                else:
+                    set_field(frame, frame['key'], value)
+
+            elif event == 'start_map':
+                if frame['type'] == 'list':
+                    if frame['items']:
+                        raise EdmanFormatError(
+                            f'値のリストに子要素は含められません {frame["key"]}')
+                    frame['is_children'] = True
+                    frames.append(new_doc(frame['key'], False))
+                else:
+                    frames.append(
+                        new_doc(frame['key'], frame['type'] == 'doc'))
+
+            elif event == 'start_array':
+                if frame['type'] == 'list':
+                    raise EdmanFormatError(
+                        f'リストの入れ子は変換できません {frame["key"]}')
+                frames.append({'type': 'list', 'key': frame['key'],
+                               'items': [], 'is_children': False})
+
+            elif event == 'end_array':
+                frames.pop()
+                if not frame['is_children']:
+                    # 日付データが含まれていたらdatetimeオブジェクトに変換
+                    set_field(frames[-1], frame['key'],
+                              self._date_replace(frame['items']))
+
+            elif event == 'end_map':
+                frames.pop()
+                if frame['type'] == 'top':
+                    break
+                doc = finish_doc(frame)
+                if doc is not None:
+                    buffer[frame['collection']].append(doc)
+                    buffered += 1
+                    if buffered >= batch_size:
+                        yield [dict(buffer)]
+                        buffer = defaultdict(list)
+                        buffered = 0
+
+        if buffered:
+            yield [dict(buffer)]
+
     @staticmethod
     def pullout_key(data: dict, pull_key: str) -> dict:
         """
@@ -431,18 +613,21 @@ class Convert:
             output.update(o)
         return output
 
-    def dict_to_edman(self, raw_data: dict, mode='ref') -> list:
+    def dict_to_edman(self, raw_data: dict, mode='ref',
+                      ancestors=False) -> list:
         """
         | json辞書からedman用に変換する
         | embはobjectIdを付与したり、辞書からリストに変換している
+        | refでancestorsがTrueの場合は祖先、ルートのリファレンスと深さを付与する
 
         :param dict raw_data: JSONを辞書にしたデータ
         :param str mode: ref(reference) or emb(embedded) データ構造の選択肢
+        :param bool ancestors: default False
         :return: インサート用のリストデータ
         :rtype: list
         """
         if mode == 'ref':
-            return self._ref(raw_data)
+            return self._ref(raw_data, ancestors=ancestors)
         elif mode == 'emb':
             return [self._attached_oid(self.emb(raw_data))]
         else:
@@ -1,15 +1,20 @@
 import copy
+import itertools
+import time
 import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from logging import INFO, getLogger
 from typing import Any, Generator
 
-from bson import DBRef, ObjectId
+from bson import DBRef, ObjectId, encode
 from jmespath import exceptions as jms_exceptions
 from jmespath import search as jms_search
-from pymongo import MongoClient, errors
+from pymongo import (ASCENDING, DESCENDING, IndexModel, MongoClient,
+                     UpdateOne, errors)
 
-from edman import Config, Convert, File
+from edman import Config, Convert, DocumentCache, File
 from edman.exceptions import (EdmanDbConnectError, EdmanDbProcessError,
                               EdmanFormatError, EdmanInternalError)
 from edman.utils import Utils
@@ -19,9 +24,25 @@ class DB:
     """
     | DB関連クラス
     | MongoDBへの接続や各種チェック、インサート、作成や破棄など
+    |
+    | auto_index=Trueの場合は接続時にリファレンス用のインデックスを作成する
+    | oid_registry=Trueの場合はインサートと削除の際に
+    | oidと所属コレクションの対応表(Config.registry)を更新する
+    | cacheにDocumentCacheなどを指定した場合は、リファレンスを辿る際の
+    | ドキュメントの取得(_dereference(), _dereference_many())で利用し、
+    | 書き込みや削除の際に該当のドキュメントを破棄する
+    | add_cache()で登録したキャッシュ(Search(tree_cache=...)など)も同様に破棄する
     """
 
-    def __init__(self, con=None) -> None:
+    # get_ref_depth(memoize=True)の結果をキャッシュに格納する際のキーの接頭辞
+    _depth_namespace = '__depth__'
+
+    # bson_type()でサーバ側で変換する型と$convertの変換先
+    _server_cast_types = {'int': 'int', 'float': 'double',
+                          'datetime': 'date', 'bool': 'bool'}
+
+    def __init__(self, con=None, auto_index=False,
+                 oid_registry=False, cache=None) -> None:
 
         if con is not None:
             try:
@@ -35,13 +56,29 @@ class DB:
         self.parent = Config.parent
         self.child = Config.child
         self.file_ref = Config.file
+        self.ancestors = Config.ancestors
+        self.root = Config.root
+        self.depth = Config.depth
+        self.revision = Config.revision
         self.date = Config.date
+        self.registry = Config.registry
+        self.oid_registry = oid_registry
+        self.cache = cache
+        # cache以外に書き込みや削除の際に破棄するキャッシュ
+        self._extra_caches: list = []
+        # cacheがない場合のget_ref_depth(memoize=True)の結果の格納先
+        self._depth_cache: DocumentCache | None = None
+        # get_ref_depth(memoize=True)の結果を格納したかどうか
+        self._depth_memoized = False
 
         # ログ設定(トップに伝搬し、利用側でログとして取得してもらう)
         self.logger = getLogger(__name__)
         self.logger.setLevel(INFO)
         self.logger.propagate = True
 
+        if con is not None and auto_index:
+            self.ensure_indexes()
+
     @property
     def get_db(self):
         """
@@ -297,33 +334,312 @@ class DB:
         except Exception:
             raise
 
-    def insert(self, insert_data: list) -> list[dict[str, list[ObjectId]]]:
+    def _reference_index_models(self) -> list[IndexModel]:
+        """
+        edmanのリファレンス用キーのインデックス定義を取得する
+
+        :return:
+        :rtype: list
         """
-        インサート実行
+        return [
+            IndexModel([(self.parent + '.$id', ASCENDING)],
+                       name='edman_parent', sparse=True),
+            IndexModel([(self.child + '.$id', ASCENDING)],
+                       name='edman_child', sparse=True),
+            IndexModel([(self.file_ref, ASCENDING)],
+                       name='edman_file', sparse=True),
+            IndexModel([(self.ancestors + '.$id', ASCENDING),
+                        (self.depth, ASCENDING)],
+                       name='edman_ancestors', sparse=True),
+        ]
+
+    def ensure_indexes(self, collections=None) -> dict:
+        """
+        | edmanのリファレンス用キーにインデックスを作成する
+        |
+        | 親、子、ファイルのリファレンスと祖先のリファレンス情報が対象
+        | collectionsを指定しない場合はget_collections()で取得した全コレクションが対象
+        | 作成済みのインデックスはそのまま
+        | MongoDB 4.2以降はインデックス作成中も読み書きはブロックされない
+
+        :param collections: default None
+        :type collections: list or None
+        :return: result コレクション毎の作成したインデックス名のリスト
+        :rtype: dict
+        """
+        result = {}
+        for collection in (collections or self.get_collections()):
+            try:
+                result[collection] = self.db[collection].create_indexes(
+                    self._reference_index_models())
+            except errors.OperationFailure as e:
+                raise EdmanDbProcessError(
+                    f'インデックスの作成に失敗しました {collection}: {e}')
+        return result
+
+    def index_stats(self, collections=None) -> dict:
+        """
+        | インデックスの利用状況を取得する
+        |
+        | $indexStatsを利用し、サーバ起動後(またはインデックス作成後)の利用回数を取得する
+        |   例:
+        |   {'collection': {'edman_parent': {'ops': 10, 'since': datetime}}}
+
+        :param collections: default None
+        :type collections: list or None
+        :return: result
+        :rtype: dict
+        """
+        result: dict[str, dict] = {}
+        for collection in (collections or self.get_collections()):
+            try:
+                stats = self.db[collection].aggregate([{'$indexStats': {}}])
+                result[collection] = {
+                    i['name']: {'ops': i['accesses']['ops'],
+                                'since': i['accesses']['since']}
+                    for i in stats}
+            except errors.OperationFailure as e:
+                raise EdmanDbProcessError(
+                    f'インデックスの利用状況を取得できませんでした {collection}: {e}')
+        return result
+
+    def insert(self, insert_data: list, batch_size=None, batch_bytes=None,
+               ordered=True, max_workers=None,
+               transaction=False) -> list[dict[str, list[ObjectId]]]:
+        """
+        | インサート実行
+        |
+        | batch_size(ドキュメント数)やbatch_bytes(BSONのバイト数)を指定すると
+        | コレクション毎のリストを分割してインサートする
+        | orderedがFalseの場合は失敗したドキュメントがあっても残りをインサートし、
+        | 全て終わった後に例外を送出する
+        | コレクション毎の件数と処理時間はロガーに出力する
+        | 失敗した場合は、インサートできたoidを例外のメッセージに含める
+        | max_workersを指定するとコレクション毎のインサートをスレッドで並列に行う
+        | スレッドはMongoClientを共有し、結果は元の順番で返す
+        | 並列の場合はorderedがTrueでも他のコレクションのインサートは中断しない
+        | transactionがTrueの場合は全てのインサートを1つのトランザクション内で行い、
+        | 失敗した場合はロールバックする(max_workersとは併用できない)
+        | 失敗した時点でトランザクションは中止されるため、orderedは常にTrueとし、
+        | 例外のメッセージにはoidを含めない
+        | トランザクションの上限を超えないよう、batch_bytesの指定がない場合は
+        | 8MB毎に分割する
 
         :param list insert_data: バルクインサート対応のリストデータ
+        :param batch_size: 1回にインサートするドキュメント数 default None
+        :type batch_size: int or None
+        :param batch_bytes: 1回にインサートするバイト数の上限 default None
+        :type batch_bytes: int or None
+        :param bool ordered: default True
+        :param max_workers: 並列でインサートするスレッド数 default None
+        :type max_workers: int or None
+        :param bool transaction: default False
         :return: results
         :rtype: list
         """
-        results: list[dict[str, list[ObjectId]]] = []
-        for i in insert_data:
-            for collection, bulk_list in i.items():
-                if isinstance(bulk_list, dict):
-                    bulk_list = [bulk_list]
-                try:
-                    result = self.db[collection].insert_many(bulk_list)
-                except errors.BulkWriteError as e:
-                    raise EdmanDbProcessError(
-                        f'インサートに失敗しました:{e.details}\nインサート結果:{results}')
-                results.append({collection: result.inserted_ids})
+        if max_workers is not None and max_workers < 1:
+            raise EdmanFormatError('max_workersは1以上を指定してください')
+        if batch_size is not None and batch_size < 1:
+            raise EdmanFormatError('batch_sizeは1以上を指定してください')
+        if batch_bytes is not None and batch_bytes < 1:
+            raise EdmanFormatError('batch_bytesは1以上を指定してください')
+
+        if transaction:
+            if max_workers is not None:
+                raise EdmanFormatError(
+                    'transactionとmax_workersは同時に指定できません')
+            if batch_bytes is None:
+                batch_bytes = 8 * 1024 * 1024
+            return self._run_in_transaction(
+                lambda session: self._insert(insert_data, batch_size,
+                                             batch_bytes, True,
+                                             session=session))
+        return self._insert(insert_data, batch_size, batch_bytes, ordered,
+                            max_workers)
+
+    def _insert(self, insert_data: list, batch_size=None, batch_bytes=None,
+                ordered=True, max_workers=None,
+                session=None) -> list[dict[str, list[ObjectId]]]:
+        """
+        | インサート実行
+        | 引数のチェックはinsert()で行う
+
+        :param list insert_data: バルクインサート対応のリストデータ
+        :param batch_size: default None
+        :type batch_size: int or None
+        :param batch_bytes: default None
+        :type batch_bytes: int or None
+        :param bool ordered: default True
+        :param max_workers: default None
+        :type max_workers: int or None
+        :param session: default None
+        :type session: ClientSession or None
+        :return: results
+        :rtype: list
+        """
+        tasks = [(collection, [bulk_list] if isinstance(bulk_list, dict)
+                  else bulk_list)
+                 for i in insert_data for collection, bulk_list in i.items()]
 
+        results: list[dict[str, list[ObjectId]]] = []
+        failures = []
+        if max_workers is not None:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(self._insert_collection,
+                                           collection, bulk_list, batch_size,
+                                           batch_bytes, ordered)
+                           for collection, bulk_list in tasks]
+                for (collection, _), future in zip(tasks, futures):
+                    inserted_ids, errors_details = future.result()
+                    results.append({collection: inserted_ids})
+                    if errors_details:
+                        failures.append({collection: errors_details})
+        else:
+            for collection, bulk_list in tasks:
+                inserted_ids, errors_details = self._insert_collection(
+                    collection, bulk_list, batch_size, batch_bytes, ordered,
+                    session=session)
+                results.append({collection: inserted_ids})
+                if errors_details:
+                    failures.append({collection: errors_details})
+                    if ordered:
+                        break
+
+        if failures:
+            raise EdmanDbProcessError(
+                f'インサートに失敗しました:{failures}\nインサート結果:{results}')
         return results
 
+    def _insert_collection(self, collection: str, docs: list,
+                           batch_size=None, batch_bytes=None, ordered=True,
+                           session=None) -> tuple[list[ObjectId], list]:
+        """
+        | 1コレクション分のドキュメントを分割してインサートする
+        | 失敗した時はインサートできたoidと、エラーの詳細を返す
+        | orderedがTrueの場合は失敗した時点で中断する
+        | sessionを指定した(トランザクション内の)場合は、失敗した時点で
+        | トランザクションが中止されるため例外をそのまま送出する
+
+        :param str collection:
+        :param list docs:
+        :param batch_size: default None
+        :type batch_size: int or None
+        :param batch_bytes: default None
+        :type batch_bytes: int or None
+        :param bool ordered: default True
+        :param session: default None
+        :type session: ClientSession or None
+        :return: inserted_ids, errors_details
+        :rtype: tuple
+        """
+        start = time.perf_counter()
+        inserted_ids: list[ObjectId] = []
+        errors_details = []
+        batches = 0
+        for batch in self._split_insert_batches(docs, batch_size,
+                                                batch_bytes):
+            batches += 1
+            try:
+                result = self.db[collection].insert_many(
+                    batch, ordered=ordered, session=session)
+            except errors.BulkWriteError as e:
+                if session is not None:
+                    raise
+                # insert_many()でoidは各ドキュメントに付与されている
+                failed = {i['index'] for i in e.details.get('writeErrors', [])}
+                if ordered:
+                    landed = batch[:e.details.get('nInserted', 0)]
+                else:
+                    landed = [doc for idx, doc in enumerate(batch)
+                              if idx not in failed]
+                landed_ids = [doc['_id'] for doc in landed]
+                inserted_ids.extend(landed_ids)
+                errors_details.append(e.details)
+                if self.oid_registry:
+                    self._register_oids(collection, landed_ids,
+                                        session=session)
+                if ordered:
+                    break
+            else:
+                inserted_ids.extend(result.inserted_ids)
+                if self.oid_registry:
+                    self._register_oids(collection, result.inserted_ids,
+                                        session=session)
+
+        seconds = time.perf_counter() - start
+        rate = len(inserted_ids) / seconds if seconds else 0.0
+        self.logger.info(
+            f'insert {collection}: {len(inserted_ids)} docs, '
+            f'{batches} batches, {seconds:.3f}s, {rate:.1f} docs/s')
+        return inserted_ids, errors_details
+
+    @staticmethod
+    def _split_insert_batches(docs: list, batch_size=None,
+                              batch_bytes=None) -> Generator:
+        """
+        | ドキュメントのリストをドキュメント数とBSONのバイト数で分割するジェネレータ
+        | どちらも指定がない場合はリストをそのまま返す
+        | 1ドキュメントでbatch_bytesを超える場合はそのドキュメント単独で返す
+
+        :param list docs:
+        :param batch_size: default None
+        :type batch_size: int or None
+        :param batch_bytes: default None
+        :type batch_bytes: int or None
+        :return:
+        :rtype: Generator
+        """
+        if batch_size is None and batch_bytes is None:
+            yield docs
+            return
+
+        batch: list[dict] = []
+        size = 0
+        for doc in docs:
+            doc_size = len(encode(doc)) if batch_bytes else 0
+            if batch and (
+                    (batch_size and len(batch) >= batch_size) or (
+                        batch_bytes and size + doc_size > batch_bytes)):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(doc)
+            size += doc_size
+        if batch:
+            yield batch
+
+    def _run_in_transaction(self, callback) -> Any:
+        """
+        | トランザクション内で処理を実行する
+        | 処理中に例外が発生した場合はロールバックして例外を送出する
+        | トランザクションはレプリカセットまたはシャードクラスタでのみ利用可能
+        |
+        | callbackはセッションを引数にとる関数
+        | 一時的なエラーの場合はcallbackが再実行されることがある
+
+        :param callback:
+        :type callback: Callable
+        :return: callbackの戻り値
+        :rtype: Any
+        """
+        with self.client.start_session() as session:
+            try:
+                return session.with_transaction(callback)
+            except (errors.OperationFailure, errors.ConnectionFailure) as e:
+                raise EdmanDbProcessError(
+                    f'トランザクションに失敗したためロールバックしました:{e}')
+
     def find_collection_from_objectid(self,
                                       oid: str | ObjectId) -> str | None:
         """
         | DB内のコレクションから指定のObjectIDを探し、所属しているコレクションを返す
+        | oid_registryがTrueの場合は対応表を1回検索する
+        | 対応表に無い場合や対応表を使わない場合は全コレクションを検索するため、
         | DBに負荷がかかるので使用は注意が必要
+        | 全コレクションの検索で見つかった場合は対応表に登録する
+        | 対応表で見つかった場合もコレクションにドキュメントがあるか確認し、
+        | 無ければ(他の書き込みで削除された場合など)対応表から外して
+        | 全コレクションを検索する
 
         :param oid:
         :type oid: ObjectId or str
@@ -331,13 +647,100 @@ class DB:
         :rtype: str or None
         """
         oid = Utils.conv_objectid(oid)
+        if self.oid_registry:
+            if (entry := self.db[self.registry].find_one(
+                    {'_id': oid})) is not None:
+                if self.db[entry['collection']].find_one(
+                        {'_id': oid}, {'_id': 1}) is not None:
+                    return entry['collection']
+                self._unregister_oids([oid])
+
         result = None
         coll_filter = {"name": {"$regex": r"^(?!system\.)"}}
         for collection in self.db.list_collection_names(filter=coll_filter):
+            if collection == self.registry:
+                continue
             find_oid = self.db[collection].find_one({'_id': oid})
             if find_oid is not None and '_id' in find_oid:
                 result = collection
                 break
+        if self.oid_registry and result is not None:
+            self._register_oids(result, [oid])
+        return result
+
+    def _register_oids(self, collection: str, oids: list,
+                       session=None) -> None:
+        """
+        | oidと所属コレクションを対応表に登録する
+        | 登録済みのoidは無視する
+
+        :param str collection:
+        :param list oids:
+        :param session: default None
+        :type session: ClientSession or None
+        :return:
+        """
+        if not oids:
+            return
+        try:
+            self.db[self.registry].insert_many(
+                [{'_id': oid, 'collection': collection} for oid in oids],
+                ordered=False, session=session)
+        except errors.BulkWriteError as e:
+            # 登録済み(重複キー)以外のエラーは例外とする
+            if any(i['code'] != 11000 for i in e.details['writeErrors']):
+                raise EdmanDbProcessError(
+                    f'oidの対応表に登録できませんでした: {e.details}')
+
+    def _unregister_oids(self, oids: list, session=None) -> None:
+        """
+        対応表からoidを削除する
+
+        :param list oids:
+        :param session: default None
+        :type session: ClientSession or None
+        :return:
+        """
+        if oids:
+            self.db[self.registry].delete_many({'_id': {'$in': oids}},
+                                               session=session)
+
+    def rebuild_oid_registry(self, collections=None,
+                             batch_size=10000) -> dict:
+        """
+        | oidと所属コレクションの対応表を既存のデータから作り直す
+        | collectionsを指定しない場合はget_collections()で取得した全コレクションが対象
+        | 指定した場合は該当コレクションの登録のみ作り直す
+
+        :param collections: default None
+        :type collections: list or None
+        :param int batch_size: default 10000
+        :return: result コレクション毎の登録件数
+        :rtype: dict
+        """
+        if collections is None:
+            collections = self.get_collections()
+            self.db[self.registry].drop()
+        else:
+            self.db[self.registry].delete_many(
+                {'collection': {'$in': collections}})
+
+        result = {}
+        for collection in collections:
+            start = time.perf_counter()
+            count = 0
+            batch = []
+            for doc in self.db[collection].find({}, {'_id': 1}):
+                batch.append(doc['_id'])
+                if len(batch) >= batch_size:
+                    self._register_oids(collection, batch)
+                    count += len(batch)
+                    batch = []
+            self._register_oids(collection, batch)
+            count += len(batch)
+            result[collection] = count
+            self.logger.info(f'rebuild_oid_registry {collection}: {count} '
+                             f'oids, {time.perf_counter() - start:.3f}s')
         return result
 
     def doc(self, collection: str, oid: ObjectId | str,
@@ -376,7 +779,9 @@ class DB:
                     f'指定されたクエリはドキュメントではありません {query}')
 
             result = Utils.item_delete(
-                doc_result, ('_id', self.parent, self.child, self.file_ref)
+                doc_result, ('_id', self.parent, self.child, self.file_ref,
+                             self.ancestors, self.root, self.depth,
+                             self.revision)
             ) if reference_delete else doc_result
 
         return result
@@ -400,9 +805,13 @@ class DB:
         return result
 
     def item_delete(self, collection: str, oid: ObjectId | str,
-                    delete_key: str, query: list | None) -> bool:
+                    delete_key: str, query: list | None, revision=False,
+                    max_retries=3) -> bool:
         """
-        ドキュメントの項目を削除する
+        | ドキュメントの項目を削除する
+        | 書き込みは削除した項目の$unsetなど差分のみ行う
+        | revisionがTrueの場合はリビジョンを条件に書き込み、
+        | 他の書き込みと競合した時はmax_retries回まで読み込みからやり直す
 
         :param str collection:
         :param oid:
@@ -410,33 +819,64 @@ class DB:
         :param str delete_key:
         :param query:
         :type query: list or None
+        :param bool revision: default False
+        :param int max_retries: default 3
         :return:
         :rtype: bool
         """
 
+        def amend(doc: dict) -> dict:
+            if query is not None:  # emb
+                try:
+                    doc = Utils.doc_traverse(doc, [delete_key], query,
+                                             Utils.item_delete)
+                except Exception:
+                    raise
+            else:  # ref
+                try:
+                    del doc[delete_key]
+                except IndexError:
+                    raise EdmanInternalError(
+                        f'キーは存在しません: {delete_key}')
+            return doc
+
         oid = Utils.conv_objectid(oid)
-        doc = self.db[collection].find_one({'_id': oid})
-        if doc is None:
-            raise EdmanDbProcessError('ドキュメントが存在しません')
+        modified_count = self._read_modify_write(
+            collection, oid, amend, revision=revision,
+            max_retries=max_retries)
+        result = True if modified_count == 1 else False
 
-        doc = dict(doc)
-        if query is not None:  # emb
-            try:
-                doc = Utils.doc_traverse(doc, [delete_key], query,
-                                         Utils.item_delete)
-            except Exception:
-                raise
-        else:  # ref
-            try:
-                del doc[delete_key]
-            except IndexError:
-                raise EdmanInternalError(f'キーは存在しません: {delete_key}')
+        return result
 
-        # ドキュメント置き換え処理
-        replace_result = self.db[collection].replace_one({'_id': oid}, doc)
-        result = True if replace_result.modified_count == 1 else False
+    def _read_modify_write(self, collection: str, oid: ObjectId, amend,
+                           revision=False, max_retries=3, session=None,
+                           not_found=EdmanDbProcessError) -> int:
+        """
+        | ドキュメントを読み込み、amendで変更して差分を書き込む
+        | リビジョンの扱いはUtils.read_modify_write()を参照
 
-        return result
+        :param str collection:
+        :param ObjectId oid:
+        :param amend: ドキュメントのコピーを受け取り変更後のドキュメントを返す関数
+        :type amend: Callable
+        :param bool revision: default False
+        :param int max_retries: default 3
+        :param session: default None
+        :type session: ClientSession or None
+        :param not_found: ドキュメントが存在しない時の例外
+            default EdmanDbProcessError
+        :type not_found: type
+        :return: modified_count
+        :rtype: int
+        """
+        def write(doc: dict, amended: dict, query) -> int:
+            return self._write_diff(collection, doc, amended,
+                                    session=session, query=query)
+
+        return Utils.read_modify_write(
+            self.db[collection], oid, amend, write, revision=revision,
+            max_retries=max_retries, session=session, not_found=not_found,
+            logger=self.logger)
 
     def _convert_datetime_dict(self, amend: dict) -> dict:
         """
@@ -474,7 +914,39 @@ class DB:
         return result
 
     def update(self, collection: str, oid: str | ObjectId,
-               amend_data: dict, structure: str) -> bool:
+               amend_data: dict, structure: str, transaction=False,
+               revision=False, max_retries=3) -> bool:
+        """
+        | 修正データを用いてDBデータをアップデート
+        | 書き込みはドキュメント全体ではなく、差分を$set, $unset, $pushで行う
+        | transactionがTrueの場合は読み込みから書き込みまでを
+        | 1つのトランザクション内で行う
+        | revisionがTrueの場合はリビジョンを条件に書き込み、
+        | 他の書き込みと競合した時はmax_retries回まで読み込みからやり直す
+
+        :param str collection:
+        :param oid:
+        :type oid: str or ObjectId
+        :param dict amend_data:
+        :param str structure:
+        :param bool transaction: default False
+        :param bool revision: default False
+        :param int max_retries: default 3
+        :return:
+        :rtype: bool
+        """
+        if transaction:
+            return self._run_in_transaction(
+                lambda session: self._update(collection, oid, amend_data,
+                                             structure, revision=revision,
+                                             max_retries=max_retries,
+                                             session=session))
+        return self._update(collection, oid, amend_data, structure,
+                            revision=revision, max_retries=max_retries)
+
+    def _update(self, collection: str, oid: str | ObjectId,
+                amend_data: dict, structure: str, revision=False,
+                max_retries=3, session=None) -> bool:
         """
         修正データを用いてDBデータをアップデート
 
@@ -483,39 +955,153 @@ class DB:
         :type oid: str or ObjectId
         :param dict amend_data:
         :param str structure:
+        :param bool revision: default False
+        :param int max_retries: default 3
+        :param session: default None
+        :type session: ClientSession or None
         :return:
         :rtype: bool
         """
 
         oid = Utils.conv_objectid(oid)
-        db_result = self.db[collection].find_one({'_id': oid})
-        if db_result is None:
-            raise EdmanInternalError('該当するドキュメントは存在しません')
-
-        db_result = dict(db_result)
         if structure == 'emb':
             convert = Convert()
-            try:
-                # 日付データを日付オブジェクトに変換するため、
-                # 必ずコンバートしてからマージする
-                converted_amend_data = convert.emb(amend_data)
-                amended = self._merge(db_result, converted_amend_data)
-            except ValueError:
-                raise
+            # 日付データを日付オブジェクトに変換するため、
+            # 必ずコンバートしてからマージする
+            converted_amend_data = convert.emb(amend_data)
+
+            def amend(db_result: dict) -> dict:
+                try:
+                    return self._merge(db_result, converted_amend_data)
+                except ValueError:
+                    raise
         elif structure == 'ref':
             # 日付データを日付オブジェクトに変換
             converted_amend_data = self._convert_datetime_dict(amend_data)
-            amended = {**db_result, **converted_amend_data}
+
+            def amend(db_result: dict) -> dict:
+                return {**db_result, **converted_amend_data}
         else:
             raise EdmanFormatError('structureはrefまたはembの指定が必要です')
 
         try:
-            replace_result = self.db[collection].replace_one({'_id': oid},
-                                                             amended)
+            modified_count = self._read_modify_write(
+                collection, oid, amend, revision=revision,
+                max_retries=max_retries, session=session,
+                not_found=EdmanInternalError)
         except errors.OperationFailure:
             raise EdmanDbProcessError('アップデートに失敗しました')
 
-        return True if replace_result.modified_count == 1 else False
+        return True if modified_count == 1 else False
+
+    def _write_diff(self, collection: str, orig: dict, amended: dict,
+                    session=None, query=None) -> int:
+        """
+        | 元のドキュメントとの差分だけを$set, $unset, $pushで書き込む
+        | 差分の方がドキュメントより大きい場合や、
+        | ドット記法で表せないキーが含まれる場合はreplace_oneで置き換える
+        | 差分がない場合は書き込まない
+
+        :param str collection:
+        :param dict orig: DBから取得した元のドキュメント
+        :param dict amended: 変更後のドキュメント
+        :param session: default None
+        :type session: ClientSession or None
+        :param query: 書き込みの条件 default None(_idのみ)
+        :type query: dict or None
+        :return: modified_count
+        :rtype: int
+        """
+        operations = self._diff_operations(orig, amended)
+        if operations is not None and not operations:
+            return 0
+
+        if query is None:
+            query = {'_id': orig['_id']}
+        if operations is None or len(encode(operations)) >= len(
+                encode(amended)):
+            result = self.db[collection].replace_one(query, amended,
+                                                     session=session)
+        else:
+            result = self.db[collection].update_one(query, operations,
+                                                    session=session)
+        self._invalidate_cache(collection, [orig['_id']])
+        return result.modified_count
+
+    def _diff_operations(self, orig: dict, amended: dict) -> dict | None:
+        """
+        | 元のドキュメントと変更後のドキュメントを比較し、
+        | $set, $unset, $pushの更新演算子を作成する
+        |
+        | 辞書は項目毎に比較し、変更された項目のみ$setする
+        | リストは末尾に追加されただけなら$push、同じ長さなら要素毎に比較し、
+        | それ以外はリスト全体を$setする
+        | ドット記法で表せないキーが含まれる場合はNoneを返す
+
+        :param dict orig:
+        :param dict amended:
+        :return: operations
+        :rtype: dict or None
+        """
+        operations: dict[str, dict] = {'$set': {}, '$unset': {}, '$push': {}}
+
+        def same(a, b) -> bool:
+            """
+            型も含めて同じ値か調べる(True == 1などを区別する)
+            """
+            if type(a) is not type(b):
+                return False
+            if isinstance(a, dict):
+                return a.keys() == b.keys() and all(
+                    same(a[k], b[k]) for k in a)
+            if isinstance(a, list):
+                return len(a) == len(b) and all(
+                    same(i, j) for i, j in zip(a, b))
+            return a == b
+
+        def diff_dict(before: dict, after: dict, path: str) -> None:
+            for key in before:
+                if key not in after:
+                    check_key(key)
+                    operations['$unset'][path + key] = ''
+            for key, value in after.items():
+                if key in before and same(before[key], value):
+                    continue
+                check_key(key)
+                if key in before and isinstance(value, dict) and isinstance(
+                        before[key], dict):
+                    diff_dict(before[key], value, f'{path}{key}.')
+                elif key in before and isinstance(
+                        value, list) and isinstance(before[key], list):
+                    diff_list(before[key], value, path + key)
+                else:
+                    operations['$set'][path + key] = value
+
+        def diff_list(before: list, after: list, path: str) -> None:
+            if len(after) > len(before) and same(after[:len(before)],
+                                                 before):
+                operations['$push'][path] = {'$each': after[len(before):]}
+            elif len(after) == len(before):
+                for i, (b, a) in enumerate(zip(before, after)):
+                    if same(b, a):
+                        continue
+                    if isinstance(a, dict) and isinstance(b, dict):
+                        diff_dict(b, a, f'{path}.{i}.')
+                    else:
+                        operations['$set'][f'{path}.{i}'] = a
+            else:
+                operations['$set'][path] = after
+
+        def check_key(key) -> None:
+            if not isinstance(key, str) or '.' in key or key.startswith(
+                    '$'):
+                raise ValueError(key)
+
+        try:
+            diff_dict(orig, amended, '')
+        except ValueError:
+            return None
+        return {k: v for k, v in operations.items() if v}
 
     def _merge_list(self, orig: list, amend: list) -> list:
         """
@@ -559,34 +1145,65 @@ class DB:
         return result
 
     def delete(self, oid: str | ObjectId, collection: str,
-               structure: str) -> bool:
+               structure: str, transaction=False) -> bool:
         """
         | ドキュメントを削除する
         | 指定のoidを含む下位のドキュメントを全削除
         | refで親が存在する時は親のchildリストから指定のoidを取り除く
+        | transactionがTrueの場合は全ての削除を1つのトランザクション内で行い、
+        | 失敗した場合はロールバックする
 
         :param oid:
         :type oid: str or ObjectId
         :param str collection:
         :param str structure:
+        :param bool transaction: default False
+        :return:
+        :rtype: bool
+        """
+        if transaction:
+            return self._run_in_transaction(
+                lambda session: self._delete(oid, collection, structure,
+                                             session=session))
+        return self._delete(oid, collection, structure)
+
+    def _delete(self, oid: str | ObjectId, collection: str, structure: str,
+                session=None) -> bool:
+        """
+        | ドキュメントを削除する
+        | 指定のoidを含む下位のドキュメントを全削除
+        | refで親が存在する時は親のchildリストから指定のoidを取り除く
+
+        :param oid:
+        :type oid: str or ObjectId
+        :param str collection:
+        :param str structure:
+        :param session: default None
+        :type session: ClientSession or None
         :return:
         :rtype: bool
         """
         oid = Utils.conv_objectid(oid)
-        db_result = self.db[collection].find_one({'_id': oid})
+        db_result = self.db[collection].find_one({'_id': oid},
+                                                 session=session)
         if db_result is None:
             raise EdmanInternalError('該当するドキュメントは存在しません')
 
         db_result = dict(db_result)
         if structure == 'emb':
             try:
-                result = self.db[collection].delete_one({'_id': oid})
+                result = self.db[collection].delete_one({'_id': oid},
+                                                        session=session)
+                self._invalidate_cache(collection, [oid])
                 if result.deleted_count:
+                    if self.oid_registry:
+                        self._unregister_oids([oid], session=session)
                     # 添付データがあればgridfsから削除
-                    file = File(self.get_db)
+                    file = File(self.get_db, cache=self.cache)
                     file.fs_delete(
                         sum([i for i in self._collect_emb_file_ref(
-                            db_result, self.file_ref)], []))
+                            db_result, self.file_ref)], []),
+                        session=session)
                     return True
                 else:
                     raise EdmanDbProcessError(
@@ -599,28 +1216,38 @@ class DB:
                 # 親ドキュメントがあれば子要素リストから削除する
                 if db_result.get(self.parent):
                     self._delete_reference_from_parent(db_result[self.parent],
-                                                       db_result['_id'])
+                                                       db_result['_id'],
+                                                       session=session)
                 # 対象のドキュメント以下のドキュメントと関連ファイルを削除する
-                self._delete_documents_and_files(db_result, collection)
+                self._delete_documents_and_files(db_result, collection,
+                                                 session=session)
                 return True
             except ValueError:
                 raise
         else:
             raise EdmanFormatError('structureはrefまたはembの指定が必要です')
 
-    def _delete_documents_and_files(self, db_result: dict,
-                                    collection: str) -> None:
+    def _delete_documents_and_files(self, db_result: dict, collection: str,
+                                    session=None) -> dict:
         """
-        指定のドキュメント以下の子ドキュメントと関連ファイルを削除する
+        | 指定のドキュメント以下の子ドキュメントと関連ファイルを削除する
+        |
+        | 子孫のoidは階層毎に$inでまとめて収集し、
+        | コレクション毎にdelete_manyで削除する
+        | 各段階の処理時間と件数はロガーに出力し、戻り値としても返す
 
         :param dict db_result:
         :param str collection:
-        :return:
+        :param session: default None
+        :type session: ClientSession or None
+        :return: report 段階毎の処理時間(秒)と件数
+        :rtype: dict
         """
+        start = time.perf_counter()
         delete_doc_id_dict: dict[str, list[ObjectId]] = {}
         delete_file_ref_list = []
-        for element in self._recursive_extract_elements_from_doc(db_result,
-                                                                 collection):
+        for element in self._extract_elements_by_level(db_result, collection,
+                                                       session=session):
             doc_collection = list(element.keys())[0]
             id_and_refs = list(element.values())[0]
 
@@ -632,65 +1259,94 @@ class DB:
 
                 if refs.get(self.file_ref):
                     delete_file_ref_list.extend(refs[self.file_ref])
+        collected = time.perf_counter()
 
-        self._delete_documents(delete_doc_id_dict)
-        # gridfsからファイルを消す
-        file = File(self.get_db)
-        file.fs_delete(delete_file_ref_list)
+        deleted_docs = self._delete_documents(delete_doc_id_dict,
+                                              session=session)
+        docs_deleted = time.perf_counter()
 
-    def _delete_documents(self, delete_doc_id_dict: dict) -> None:
-        """
-        繰り返し指定のドキュメントを削除する
+        # gridfsからファイルを消す
+        file = File(self.get_db, cache=self.cache)
+        deleted_files = file.fs_delete(delete_file_ref_list, session=session)
+        files_deleted = time.perf_counter()
+
+        report = {
+            'collect': {'seconds': collected - start,
+                        'docs': sum(len(i) for i in
+                                    delete_doc_id_dict.values()),
+                        'files': len(delete_file_ref_list)},
+            'docs': {'seconds': docs_deleted - collected,
+                     'deleted': deleted_docs},
+            'files': {'seconds': files_deleted - docs_deleted,
+                      'deleted': deleted_files},
+        }
+        for stage, stat in report.items():
+            self.logger.info(f'delete {stage}: {stat}')
+        return report
+
+    def _delete_documents(self, delete_doc_id_dict: dict, session=None,
+                          chunk_size=10000) -> int:
+        """
+        | 指定のドキュメントを削除する
+        | コレクション毎にdelete_manyでまとめて削除する
+        | コマンドやトランザクションのサイズ上限を超えないよう、
+        | chunk_size件毎に分割する
 
         :param dict delete_doc_id_dict:
-        :return:
+        :param session: default None
+        :type session: ClientSession or None
+        :param int chunk_size: default 10000
+        :return: deleted_doc_count
+        :rtype: int
         """
         del_doc_count = 0
         deleted_doc_count = 0
         for collection, del_list in delete_doc_id_dict.items():
             del_doc_count += len(del_list)
-            for oid in del_list:
-                del_doc_result = self.db[collection].delete_one({'_id': oid})
+            for i in range(0, len(del_list), chunk_size):
+                del_doc_result = self.db[collection].delete_many(
+                    {'_id': {'$in': del_list[i:i + chunk_size]}},
+                    session=session)
                 deleted_doc_count += del_doc_result.deleted_count
+                self._invalidate_cache(collection, del_list[i:i + chunk_size])
+                if self.oid_registry:
+                    self._unregister_oids(del_list[i:i + chunk_size],
+                                          session=session)
         if del_doc_count != deleted_doc_count:
             raise ValueError('削除対象と削除済みドキュメント数が一致しません')
+        return deleted_doc_count
 
-    def _delete_reference_from_parent(self, ref: DBRef,
-                                      del_oid: ObjectId) -> None:
+    def _delete_reference_from_parent(self, ref: DBRef, del_oid: ObjectId,
+                                      session=None) -> None:
         """
         親ドキュメントのリファレンスリストから指定のoidのリファレンスを取り除く
 
         :param DBRef ref:
         :param ObjectId del_oid:
+        :param session: default None
+        :type session: ClientSession or None
         :return:
         """
-        parent_doc = self.db[ref.collection].find_one({'_id': ref.id})
-        children = parent_doc[self.child]
-        target = None
-        for child in children:
-            if child.id == del_oid:
-                target = child
-                break
-        if target is None:
-            raise ValueError(
-                f'親となる{parent_doc["id"]}に{str(del_oid)}が登録されていません')
-        else:
+        def amend(parent_doc: dict) -> dict:
+            children = parent_doc.get(self.child, [])
+            target = None
+            for child in children:
+                if child.id == del_oid:
+                    target = child
+                    break
+            if target is None:
+                raise ValueError(
+                    f'親となる{ref.id}に{str(del_oid)}が登録されていません')
             children.remove(target)
-
-            # 子要素が登録されていればself.childを更新
-            if len(children) > 0:
-                result = self.db[ref.collection].update_one(
-                    {'_id': ref.id},
-                    {'$set': {self.child: children}})
             # 他に子要素がなければself.child自体を削除
-            else:
+            if not children:
                 del parent_doc[self.child]
-                result = self.db[ref.collection].replace_one(
-                    {'_id': ref.id}, parent_doc)
+            return parent_doc
 
-        if not result.modified_count:
-            raise ValueError(
-                f'親となる{parent_doc["id"]}は変更できませんでした')
+        # リビジョンを持つ親は他の書き込みと競合しないよう条件付きで書き込む
+        if not self._read_modify_write(ref.collection, ref.id, amend,
+                                       session=session, not_found=ValueError):
+            raise ValueError(f'親となる{ref.id}は変更できませんでした')
 
     def _extract_elements_from_doc(self, doc: dict, collection: str) -> dict:
         """
@@ -719,7 +1375,40 @@ class DB:
         if doc.get(self.child):
             for child_ref in doc[self.child]:
                 yield from self._recursive_extract_elements_from_doc(
-                    self.db.dereference(child_ref), child_ref.collection)
+                    self._dereference(child_ref), child_ref.collection)
+
+    def _extract_elements_by_level(self, doc: dict, collection: str,
+                                   session=None) -> Generator:
+        """
+        | 階層毎にまとめて
+        | コレクション別の、oidとファイルリファレンスの辞書を取り出すジェネレータ
+        |
+        | _recursive_extract_elements_from_doc()と同じ要素を返すが、
+        | 子孫は階層毎に_dereference_many()で取得する
+        | 取得する項目は子とファイルのリファレンスのみ
+
+        :param dict doc:
+        :param str collection:
+        :param session: default None
+        :type session: ClientSession or None
+        :return:
+        :rtype: Generator
+        """
+        projection = {self.child: 1, self.file_ref: 1}
+        yield self._extract_elements_from_doc(doc, collection)
+        refs = list(doc.get(self.child, []))
+        while refs:
+            fetched = self._dereference_many(refs, projection=projection,
+                                             session=session)
+            next_refs = []
+            for ref in refs:
+                child_doc = fetched.get((ref.collection, ref.id))
+                if child_doc is None:
+                    continue
+                yield self._extract_elements_from_doc(child_doc,
+                                                      ref.collection)
+                next_refs.extend(child_doc.get(self.child, []))
+            refs = next_refs
 
     def _collect_emb_file_ref(self, doc: dict, request_key: str) -> Generator:
         """
@@ -780,14 +1469,26 @@ class DB:
         return result
 
     def structure(self, collection: str, oid: ObjectId,
-                  structure_mode: str, new_collection: str) -> list:
+                  structure_mode: str, new_collection: str,
+                  transaction=False, max_bson_size=16 * 1024 * 1024) -> list:
         """
-        構造をrefからembへ、またはembからrefへ変更する
+        | 構造をrefからembへ、またはembからrefへ変更する
+        | transactionがTrueの場合は変換後のインサートを
+        | 1つのトランザクション内で行う
+        |
+        | refからembの場合は、子孫のドキュメントを取得する前に
+        | 埋め込み後のサイズを見積もり(_subtree_bson_size()を参照)、
+        | max_bson_sizeを超える場合は例外を送出する
+        | 埋め込みドキュメントは世代単位で取得しながら組み立てる
+        | (_build_emb_tree()を参照)
 
         :param str collection:
         :param ObjectId oid:
         :param str structure_mode:
         :param str new_collection:
+        :param bool transaction: default False
+        :param int max_bson_size: 埋め込み後のサイズの上限(byte)
+            default 16MB(MongoDBのドキュメントサイズの上限)
         :return: structured_result
         :rtype: list
         """
@@ -804,33 +1505,34 @@ class DB:
             reference_point_result = self.get_reference_point(
                 ref_result)
             if reference_point_result[self.child]:
-                # 子データを取り出し
-                children = self.get_child_all({collection: ref_result})
-
-                # 自分のリファレンスデータとidを削除
-                for del_key in (self.parent, self.child, '_id'):
-                    if del_key in ref_result:
-                        del ref_result[del_key]
-
-                # 子のリファレンスデータ削除
-                non_ref_children = self.delete_reference(children,
-                                                         ('_id', self.parent,
-                                                          self.child))
-                # 自分と子要素をマージする
-                ref_result.update(non_ref_children)
-
-                converted_edman = convert.dict_to_edman(
-                    {new_collection: ref_result}, mode='emb')
-                structured_result = self.insert(converted_edman)
+                if not Utils.collection_name_check(new_collection):
+                    raise EdmanFormatError(
+                        f'この名前は使用できません {new_collection}')
+                # 埋め込み後のサイズを事前に確認する
+                size = self._subtree_bson_size(ref_result)
+                if size is not None and size > max_bson_size:
+                    raise EdmanDbProcessError(
+                        f'埋め込み後のサイズが上限を超えるため変換できません '
+                        f'{collection}:{oid} {size} > {max_bson_size} bytes')
+
+                # 自分と子要素をリファレンスデータを除いて組み立てる
+                # 見積もりができなかった場合は組み立てながら確認する
+                emb_doc = self._build_emb_tree(
+                    ref_result, max_bson_size if size is None else None)
+                emb_doc.update({'_id': ObjectId()})
+                structured_result = self.insert([{new_collection: emb_doc}],
+                                                transaction=transaction)
             # 子が存在しないドキュメントの場合(新たなコレクションとして切り出す)
             else:
                 # 自分のリファレンスデータとidを削除
-                for del_key in (self.parent, '_id'):
+                for del_key in (self.parent, '_id', self.ancestors, self.root,
+                                self.depth, self.revision):
                     if del_key in ref_result:
                         del ref_result[del_key]
                 converted_edman = convert.dict_to_edman(
                     {new_collection: ref_result}, mode='emb')
-                structured_result = self.insert(converted_edman)
+                structured_result = self.insert(converted_edman,
+                                                transaction=transaction)
 
         # embからrefに変換
         elif structure_mode == 'ref':
@@ -838,7 +1540,8 @@ class DB:
             del emb_result['_id']
             converted_edman = convert.dict_to_edman(
                 {new_collection: emb_result}, mode='ref')
-            structured_result = self.insert(converted_edman)
+            structured_result = self.insert(converted_edman,
+                                            transaction=transaction)
             structured_result.reverse()
 
         else:
@@ -846,14 +1549,108 @@ class DB:
 
         return structured_result
 
-    def get_child_all(self, self_doc: dict) -> dict:
+    def _subtree_bson_size(self, doc: dict) -> int | None:
+        """
+        | 指定のドキュメントと子孫のドキュメントのBSONのサイズの合計を取得する
+        |
+        | 世代毎、コレクション毎に$bsonSizeで集計し、
+        | ドキュメント本体は転送しない
+        | 埋め込み後はリファレンスデータが無くなるため、実際のサイズより大きめになる
+        | サーバが$bsonSizeに対応していない場合(MongoDB 4.4未満)はNoneを返す
+
+        :param dict doc:
+        :return: size
+        :rtype: int or None
+        """
+        size = len(encode(doc))
+        refs = doc.get(self.child, [])
+        while refs:
+            ids_by_collection = defaultdict(list)
+            for ref in refs:
+                ids_by_collection[ref.collection].append(ref.id)
+            refs = []
+            for collection, ids in ids_by_collection.items():
+                try:
+                    for i in self.db[collection].aggregate([
+                        {'$match': {'_id': {'$in': ids}}},
+                        {'$project': {'_id': 0, self.child: 1,
+                                      'size': {'$bsonSize': '$$ROOT'}}}]):
+                        size += i['size']
+                        refs.extend(i.get(self.child, []))
+                except errors.OperationFailure as e:
+                    self.logger.info(f'$bsonSizeで集計できませんでした: {e}')
+                    return None
+        return size
+
+    def _build_emb_tree(self, doc: dict, max_bson_size=None) -> dict:
+        """
+        | refのドキュメントと子孫のドキュメントからembのドキュメントを組み立てる
+        |
+        | 子孫は世代単位でまとめて取得し、
+        | リファレンスデータを除いた辞書を親の辞書に直接追加する
+        | 保持するのは組み立て中のドキュメントと1世代分の取得結果のみ
+        | 同じコレクションの子はリストで囲む
+        | max_bson_sizeを指定すると、組み立て中のサイズが超えた時点で例外を送出する
+        | (事前のサイズの見積もりができない場合のため)
+
+        :param dict doc:
+        :param max_bson_size: default None
+        :type max_bson_size: int or None
+        :return: emb_doc
+        :rtype: dict
         """
-        子のドキュメントを再帰で全部取得
+        reference = (self.parent, self.child, '_id', self.ancestors,
+                     self.root, self.depth, self.revision)
+
+        def strip(d: dict) -> dict:
+            return {k: v for k, v in d.items() if k not in reference}
+
+        emb_doc = strip(doc)
+        size = len(encode(emb_doc)) if max_bson_size is not None else 0
+        generation = [(doc.get(self.child, []), emb_doc)]
+        while generation:
+            fetched = self._dereference_many(
+                [ref for refs, _ in generation for ref in refs])
+            next_generation = []
+            for refs, node in generation:
+                children = defaultdict(list)
+                for ref in refs:
+                    if (child := fetched.get(
+                            (ref.collection, ref.id))) is None:
+                        continue
+                    child_node = strip(child)
+                    if max_bson_size is not None:
+                        size += len(encode(child_node))
+                        if size > max_bson_size:
+                            raise EdmanDbProcessError(
+                                f'埋め込み後のサイズが上限を超えるため変換できません '
+                                f'{size} > {max_bson_size} bytes')
+                    children[ref.collection].append(child_node)
+                    if child.get(self.child):
+                        next_generation.append((child[self.child],
+                                                child_node))
+                node.update(children)
+            generation = next_generation
+        return emb_doc
+
+    def get_child_all(self, self_doc: dict, engine='recursive') -> dict:
+        """
+        | 子のドキュメントを再帰で全部取得
+        |
+        | engine='level'の場合は世代単位でまとめて取得する
+        | (1世代につきコレクション毎に1クエリ)
+        | engine='aggregate'の場合は$graphLookupでまとめて取得する
+        | engine='ancestors'の場合は祖先のリファレンス情報を利用して取得する
 
         :param dict self_doc:
+        :param str engine: recursive, level, aggregate or ancestors
+            default 'recursive'
         :return:
         :rtype: dict
         """
+        if engine != 'recursive':
+            return self._build_to_doc_child(
+                self._get_child_by_engine(self_doc, None, engine))
 
         def recursive(doc_list):
             # ここでデータを取得する
@@ -868,17 +1665,33 @@ class DB:
         recursive([self_doc])  # 再帰関数をシンプルにするため、初期データをリストで囲む
         return self._build_to_doc_child(result)  # 親子構造に組み立て
 
-    def get_child(self, self_doc: dict, depth: int) -> dict:
+    def get_child(self, self_doc: dict, depth: int,
+                  engine='recursive') -> dict:
         """
         | 子のドキュメントを取得
         |
         | depthで深度を設定し、階層分取得する
+        | engine='level'の場合は世代単位でまとめて取得する
+        | (1世代につきコレクション毎に1クエリ)
+        | engine='aggregate'の場合は$graphLookupでまとめて取得する
+        | engine='ancestors'の場合は祖先のリファレンス情報を利用して取得する
+        |
+        | engine='recursive'は子を持つ兄弟を辿る毎にdepthを減らすため、
+        | 複数の枝を持つツリーでは後の枝ほど浅い位置で打ち切られる
+        | recursive以外のengineは全ての枝をdepth世代まで取得する
+        | (depthがツリーの深さ以上なら、get_child_all()と同じ結果になる)
 
         :param dict self_doc:
         :param int depth:
+        :param str engine: recursive, level, aggregate or ancestors
+            default 'recursive'
         :return:
         :rtype: dict
         """
+        if engine != 'recursive':
+            level_data = self._get_child_by_engine(
+                self_doc, depth, engine) if depth > 0 else []
+            return self._build_to_doc_child(level_data) if level_data else {}
 
         def recursive(doc_list, d):
             """
@@ -917,10 +1730,385 @@ class DB:
         doc = list(doc.values())[0]  # {コレクション:ドキュメント}なのでドキュメントだけ分離
         if self.child in doc:
             children = [
-                {child_ref.collection: self.db.dereference(child_ref)}
+                {child_ref.collection: self._dereference(child_ref)}
                 for child_ref in doc[self.child]]
         return children
 
+    def get_subtree_aggregate(self, collection: str, oid: ObjectId | str,
+                              depth: int | None = None) -> dict:
+        """
+        | $graphLookupを利用して指定のドキュメント以下の子ドキュメントを取得する
+        |
+        | 同じコレクション内で続く子孫は1回のaggregateで取得し、
+        | 別のコレクションにまたがる場合はコレクション毎にaggregateを実行する
+        | aggregateで取得できなかった子は世代単位の取得で補完する
+        | 出力はget_child(), get_child_all()と同じ構造
+        | depthがNoneの場合は末端まで取得
+
+        :param str collection:
+        :param oid:
+        :type oid: ObjectId or str
+        :param depth: default None
+        :type depth: int or None
+        :return:
+        :rtype: dict
+        """
+        doc = self.db[collection].find_one({'_id': Utils.conv_objectid(oid)})
+        if doc is None:
+            raise EdmanInternalError('該当するドキュメントは存在しません')
+        if depth is not None and depth <= 0:
+            return {}
+
+        data = self._get_child_by_engine({collection: doc}, depth,
+                                         'aggregate')
+        return self._build_to_doc_child(data) if data else {}
+
+    def _get_child_by_engine(self, self_doc: dict, depth: int | None,
+                             engine: str) -> list:
+        """
+        指定のengineで子のドキュメントを取得し、世代単位の兄弟リストにする
+
+        :param dict self_doc:
+        :param depth:
+        :type depth: int or None
+        :param str engine: level, aggregate or ancestors
+        :return:
+        :rtype: list
+        """
+        if engine == 'level':
+            return self._get_child_by_level(self_doc, depth)
+        elif engine == 'aggregate':
+            return self._get_child_by_level(
+                self_doc, depth,
+                prefetched=self._aggregate_descendants(self_doc, depth))
+        elif engine == 'ancestors':
+            return self._get_child_by_level(
+                self_doc, depth,
+                prefetched=self._find_descendants_by_ancestors(self_doc,
+                                                               depth))
+        else:
+            raise EdmanFormatError(
+                'engineはrecursive, level, aggregateまたはancestorsの指定が必要です')
+
+    def _find_descendants_by_ancestors(self, self_doc: dict,
+                                       depth: int | None) -> dict:
+        """
+        | 祖先のリファレンス情報を利用して子孫ドキュメントをまとめて取得する
+        |
+        | コレクション毎に1クエリで取得する
+        | 祖先のリファレンス情報が付与されていないドキュメントの場合は空の辞書を返す
+
+        :param dict self_doc:
+        :param depth:
+        :type depth: int or None
+        :return: result (コレクション, ObjectId)をキーとする辞書
+        :rtype: dict
+        """
+        doc = list(self_doc.values())[0]
+        result: dict[tuple[str, ObjectId], dict] = {}
+        if self.depth not in doc or self.child not in doc:
+            return result
+
+        query: dict[str, Any] = {self.ancestors + '.$id': doc['_id']}
+        if depth is not None:
+            query.update({self.depth: {'$lte': doc[self.depth] + depth}})
+        for collection in self.get_collections():
+            for descendant in self.db[collection].find(query):
+                result[(collection, descendant['_id'])] = descendant
+        return result
+
+    def backfill_ancestors(self, collections=None) -> dict:
+        """
+        | 既存のref形式のツリーに祖先、ルートのリファレンスと深さを付与する
+        |
+        | 親がないドキュメントをルートとして、世代単位でまとめて書き込む
+        | 子がないルートのみのドキュメントにも祖先と深さを付与する
+        | collectionsを指定した場合は、そのコレクション内のルートのツリーのみ対象
+
+        :param collections: ルートを探すコレクションのリスト default None
+        :type collections: list or None
+        :return: result コレクション毎の更新ドキュメント数
+        :rtype: dict
+        """
+        result: dict[str, int] = defaultdict(int)
+        root_filter = {self.parent: {'$exists': False},
+                       self.child: {'$exists': True}}
+        for collection in (collections or self.get_collections()):
+            # ルートはまとめて書き込む(付与済みのドキュメントは除く)
+            result[collection] += self.db[collection].update_many(
+                {self.parent: {'$exists': False},
+                 '$or': [{self.ancestors: {'$ne': []}},
+                         {self.depth: {'$ne': 0}}]},
+                {'$set': {self.ancestors: [], self.depth: 0}}
+            ).modified_count
+            for root_doc in self.db[collection].find(
+                    root_filter, projection={self.child: 1}):
+                root_ref = DBRef(collection, root_doc['_id'])
+
+                # (ドキュメント, ルートから自分までのリファレンス)
+                generation = [(root_doc, [root_ref])]
+                while generation:
+                    refs = [ref for doc, _ in generation
+                            for ref in doc.get(self.child, [])]
+                    fetched = self._dereference_many(
+                        refs, projection={self.child: 1})
+                    requests = defaultdict(list)
+                    next_generation = []
+                    for doc, path in generation:
+                        for ref in doc.get(self.child, []):
+                            if (child := fetched.get(
+                                    (ref.collection, ref.id))) is None:
+                                continue
+                            requests[ref.collection].append(UpdateOne(
+                                {'_id': ref.id},
+                                {'$set': {self.ancestors: path,
+                                          self.root: root_ref,
+                                          self.depth: len(path)}}))
+                            next_generation.append((child, path + [ref]))
+
+                    for coll, ops in requests.items():
+                        result[coll] += self.db[coll].bulk_write(
+                            ops, ordered=False).modified_count
+                    generation = next_generation
+
+        self._invalidate_cache()
+        return dict(result)
+
+    def _aggregate_descendants(self, self_doc: dict,
+                               depth: int | None) -> dict:
+        """
+        | $graphLookupで子孫ドキュメントをまとめて取得する
+        |
+        | _ed_parentをたどり、同じコレクション内の子孫は1回のaggregateで取得する
+        | 別コレクションの子はコレクション毎にまとめて次のaggregateで取得する
+        | サーバ側で実行できない場合は空の辞書を返し、呼び出し側の世代単位の取得に任せる
+
+        :param dict self_doc:
+        :param depth:
+        :type depth: int or None
+        :return: result (コレクション, ObjectId)をキーとする辞書
+        :rtype: dict
+        """
+        start_key = '_ed_graph_start'
+        depth_key = '_ed_graph_depth'
+        result: dict[tuple[str, ObjectId], dict] = {}
+        levels: dict[tuple[str, ObjectId], int] = {}
+
+        # (DBRef, 世代)のリスト
+        frontier = [(ref, 1) for ref in
+                    list(self_doc.values())[0].get(self.child, [])]
+        try:
+            while frontier:
+                targets = defaultdict(list)
+                for ref, level in frontier:
+                    if depth is None or level <= depth:
+                        targets[ref.collection].append(ref.id)
+                        levels[(ref.collection, ref.id)] = level
+
+                fetched_keys = []
+                for collection, oids in targets.items():
+                    match = {'$match': {'_id': {'$in': oids}}}
+                    pipeline: list[dict] = [match]
+                    min_level = min(levels[(collection, i)] for i in oids)
+                    if depth is None or depth - min_level > 0:
+                        graph = {
+                            'from': collection,
+                            'startWith': '$_id',
+                            'connectFromField': '_id',
+                            'connectToField': self.parent + '.$id',
+                            'as': 'descendants',
+                            'depthField': depth_key,
+                            'restrictSearchWithMatch': {
+                                self.parent + '.$ref': collection}
+                        }
+                        if depth is not None:
+                            graph['maxDepth'] = depth - min_level - 1
+                        # $unwindと組み合わせて16MBの制限を回避する
+                        pipeline = [
+                            match,
+                            {'$graphLookup': graph},
+                            {'$unwind': '$descendants'},
+                            {'$replaceRoot': {'newRoot': {'$mergeObjects': [
+                                '$descendants', {start_key: '$_id'}]}}},
+                            {'$unionWith': {'coll': collection,
+                                            'pipeline': [match]}}
+                        ]
+
+                    for doc in self.db[collection].aggregate(
+                            pipeline, allowDiskUse=True):
+                        key = (collection, doc['_id'])
+                        if start_key in doc:
+                            level = levels[(collection,
+                                            doc.pop(start_key))] + (
+                                    doc.pop(depth_key) + 1)
+                            if depth is not None and level > depth:
+                                continue
+                            levels[key] = level
+                        result[key] = doc
+                        fetched_keys.append(key)
+
+                # コレクションをまたぐ子を次の取得対象にする
+                frontier = [
+                    (ref, levels[key] + 1) for key in fetched_keys
+                    for ref in result[key].get(self.child, [])
+                    if (ref.collection, ref.id) not in result]
+
+        except errors.OperationFailure as e:
+            self.logger.info(
+                f'aggregateで取得できないため世代単位で取得します: {e}')
+            result = {}
+
+        return result
+
+    def _get_child_by_level(self, self_doc: dict, depth: int | None,
+                            prefetched=None) -> list:
+        """
+        | 子のドキュメントを世代単位でまとめて取得する
+        |
+        | 同じ世代の子はコレクション毎に$inで1クエリにまとめて取得
+        | 出力は_child_storaged()の結果を並べたものと同じ形式で、
+        | _build_to_doc_child()で組み立てられる
+        | depthがNoneの場合は末端まで取得
+        | prefetchedに取得済みのドキュメントがあればDBへの問い合わせは行わない
+
+        :param dict self_doc:
+        :param depth:
+        :type depth: int or None
+        :param prefetched: (コレクション, ObjectId)をキーとする辞書
+        :type prefetched: dict or None
+        :return: data
+        :rtype: list
+        """
+        prefetched = prefetched or {}
+        data: list = []
+        generation = [self_doc]
+        level = 0
+        while generation and (depth is None or level < depth):
+            refs = [ref for doc in generation
+                    for ref in list(doc.values())[0].get(self.child, [])]
+            fetched = {(ref.collection, ref.id): prefetched[
+                (ref.collection, ref.id)] for ref in refs
+                if (ref.collection, ref.id) in prefetched}
+            fetched.update(self._dereference_many(
+                [ref for ref in refs
+                 if (ref.collection, ref.id) not in fetched]))
+
+            next_generation = []
+            for doc in generation:
+                children = [
+                    {ref.collection: fetched[(ref.collection, ref.id)]}
+                    for ref in list(doc.values())[0].get(self.child, [])
+                    if (ref.collection, ref.id) in fetched]
+                if children:
+                    data.append(children)
+                    next_generation.extend(children)
+            generation = next_generation
+            level += 1
+        return data
+
+    def _dereference(self, ref: DBRef, session=None) -> Any:
+        """
+        | DBRefからドキュメントを取得する
+        |
+        | キャッシュが設定されている場合はキャッシュから取得し、
+        | 存在しない場合はDBから取得してキャッシュに格納する
+        | セッション内の読み込みはキャッシュを利用しない
+
+        :param DBRef ref:
+        :param session: default None
+        :type session: ClientSession or None
+        :return: 存在しない場合はNone
+        :rtype: dict or None
+        """
+        if self.cache is None or session is not None:
+            return self.db.dereference(ref, session=session)
+        if (doc := self.cache.get(ref.collection, ref.id)) is None:
+            if (doc := self.db.dereference(ref)) is not None:
+                self.cache.put(ref.collection, ref.id, doc)
+        return doc
+
+    @property
+    def caches(self) -> list:
+        """
+        書き込みや削除の際に破棄するキャッシュのリスト(cacheとadd_cache()で登録したもの)
+
+        :return:
+        :rtype: list
+        """
+        caches = [self.cache] if self.cache is not None else []
+        return caches + [i for i in self._extra_caches if i is not self.cache]
+
+    def add_cache(self, cache) -> None:
+        """
+        | 書き込みや削除の際に該当のドキュメントを破棄するキャッシュを登録する
+        | 登録済みのキャッシュは無視する
+
+        :param cache: invalidate(), clear()を持つオブジェクト
+        :return:
+        """
+        if all(cache is not i for i in self.caches):
+            self._extra_caches.append(cache)
+
+    def _invalidate_cache(self, collection=None, oids=None) -> None:
+        """
+        | 各キャッシュ(cachesを参照)から指定のドキュメントを破棄する
+        | oidsがNoneの場合はコレクション単位、
+        | collectionもNoneの場合はキャッシュ全体を破棄する
+        | 階層の数のメモ(get_ref_depth()を参照)は常に全て破棄する
+
+        :param collection: default None
+        :type collection: str or None
+        :param oids: ObjectIdのリスト default None
+        :type oids: list or None
+        :return:
+        """
+        for cache in self.caches:
+            if collection is None:
+                cache.clear()
+            else:
+                cache.invalidate(collection, oids)
+        if self._depth_memoized and collection is not None:
+            memo = self._depth_memo_cache()
+            for reference_key in (self.parent, self.child):
+                memo.invalidate((self._depth_namespace, reference_key))
+
+    def _dereference_many(self, refs: list, projection=None,
+                          session=None) -> dict:
+        """
+        | DBRefのリストからドキュメントをまとめて取得する
+        |
+        | コレクション毎に$inで1クエリにまとめる
+        | 存在しないドキュメントは結果に含まれない
+        | projectionとsessionの指定がなければキャッシュを利用する
+
+        :param list refs: DBRefのリスト
+        :param projection: default None
+        :type projection: dict or None
+        :param session: default None
+        :type session: ClientSession or None
+        :return: result (コレクション, ObjectId)をキーとする辞書
+        :rtype: dict
+        """
+        use_cache = self.cache is not None and projection is None \
+            and session is None
+        result: dict[tuple[str, ObjectId], dict] = {}
+        oids = defaultdict(list)
+        for ref in refs:
+            if use_cache and (doc := self.cache.get(ref.collection,
+                                                    ref.id)) is not None:
+                result[(ref.collection, ref.id)] = doc
+            else:
+                oids[ref.collection].append(ref.id)
+
+        for collection, oid_list in oids.items():
+            for doc in self.db[collection].find({'_id': {'$in': oid_list}},
+                                                projection=projection,
+                                                session=session):
+                result[(collection, doc['_id'])] = doc
+                if use_cache:
+                    self.cache.put(collection, doc['_id'], doc)
+        return result
+
     def _build_to_doc_child(self, find_result: list) -> dict:
         """
         子の検索結果（リスト）を入れ子辞書に組み立てる
@@ -1026,28 +2214,48 @@ class DB:
         return emb_data
 
     def loop_exclusion_key_and_ref(self, collection: str, key: str,
-                                   exclusion: tuple) -> dict:
+                                   exclusion: tuple, batch_size=1000,
+                                   max_workers=None, checkpoint=None,
+                                   projection=None) -> dict:
         """
-        対象のコレクション内のドキュメントを全て、指定のキーの要素を抜き出してrefに変換してDBに入れる
-        また、取り出したデータ内の指定の要素を除外することもできる
+        | 対象のコレクション内のドキュメントを全て、指定のキーの要素を抜き出してrefに変換してDBに入れる
+        | また、取り出したデータ内の指定の要素を除外することもできる
+        |
+        | emb構造のドキュメントだけをサーバ側で絞り込み、_idの順に1回だけ読み込む
+        | 処理中にインサートしたドキュメント(keyとcollectionが同じ場合など)を
+        | 対象にしないよう、開始時の最後の_idまでに限定する
+        | projectionを指定すると読み込む項目を限定できる
+        | batch_size件分の変換結果をコレクション毎にまとめてインサートする
+        | max_workersを指定すると変換をスレッドで並列に行う
+        | バッチ毎に変換元の最後の_idをcheckpointに書き込み、
+        | 同じcheckpointを渡すと続きから再開する
+        | (インサート中に中断した場合は、そのバッチを再度インサートする)
 
         :param str collection: 変換対象のコレクション
         :param str key: refに変換開始する対象のキー
         :param tuple exclusion: 除外するキーの設定
+        :param int batch_size: 1回にインサートする変換元のドキュメント数
+            default 1000
+        :param max_workers: 並列で変換するスレッド数 default None
+        :type max_workers: int or None
+        :param checkpoint: コレクション毎の処理済みの最後の_id default None
+        :type checkpoint: dict or None
+        :param projection: 読み込む項目 default None
+        :type projection: dict or None
         :return:
         :rtype: dict
         """
+        if batch_size < 1:
+            raise EdmanFormatError('batch_sizeは1以上を指定してください')
+        if max_workers is not None and max_workers < 1:
+            raise EdmanFormatError('max_workersは1以上を指定してください')
 
         if self.db[collection].estimated_document_count() == 0:
             raise EdmanInternalError('該当するドキュメントは存在しません')
 
-        id_list = [doc['_id'] for doc in self.db[collection].find() if
-                   self.get_structure(collection, doc['_id']) == 'emb']
-
-        result_list = []
         convert = Convert()
-        for oid in id_list:
-            emb_result = self.db[collection].find_one({'_id': oid})
+
+        def convert_doc(emb_result: dict) -> list:
             del emb_result['_id']
             pull_result = convert.pullout_key(emb_result, key)
             if not pull_result:
@@ -1059,16 +2267,72 @@ class DB:
                         f'{list(exclusion)}は存在しません')
             else:
                 result = pull_result
+            return convert.dict_to_edman(result)
+
+        # embのドキュメントのみが対象
+        emb_filter = {'$nor': [{self.parent: {'$exists': True}},
+                               {self.child: {'$exists': True}}]}
+        last_id = (checkpoint or {}).get(collection)
+        end = self.db[collection].find_one(emb_filter, projection={'_id': 1},
+                                           sort=[('_id', DESCENDING)])
+        id_range = {'$lte': end['_id'] if end is not None else None}
+        if last_id is not None:
+            id_range['$gt'] = last_id
+        query = {'$and': [emb_filter, {'_id': id_range}]}
+        cursor = self.db[collection].find(query, projection=projection,
+                                          sort=[('_id', ASCENDING)],
+                                          batch_size=batch_size)
 
-            structured_result = self.insert(convert.dict_to_edman(result))
-            structured_result.reverse()
-            result_list.append(structured_result)
+        result_list = []
+        start = time.perf_counter()
+        executor = ThreadPoolExecutor(
+            max_workers=max_workers) if max_workers is not None else None
+        try:
+            while docs := list(itertools.islice(cursor, batch_size)):
+                last_id = docs[-1]['_id']
+                converted = list(executor.map(convert_doc, docs)
+                                 if executor is not None
+                                 else map(convert_doc, docs))
+
+                # コレクション毎にまとめてインサートする
+                merged: dict[str, list] = defaultdict(list)
+                for edman_data in converted:
+                    for i in edman_data:
+                        for coll, bulk_list in i.items():
+                            merged[coll].extend(
+                                [bulk_list] if isinstance(bulk_list, dict)
+                                else bulk_list)
+                self.insert([{coll: bulk_list}
+                             for coll, bulk_list in merged.items()])
+
+                # oidは変換時に付与されているので、変換元毎の結果を組み立てる
+                for edman_data in converted:
+                    structured_result = [
+                        {coll: [d['_id'] for d in (
+                            [bulk_list] if isinstance(bulk_list, dict)
+                            else bulk_list)]}
+                        for i in edman_data
+                        for coll, bulk_list in i.items()]
+                    structured_result.reverse()
+                    result_list.append(structured_result)
+
+                if checkpoint is not None:
+                    checkpoint[collection] = last_id
+                seconds = time.perf_counter() - start
+                rate = len(result_list) / seconds if seconds else 0.0
+                self.logger.info(
+                    f'loop_exclusion_key_and_ref {collection}: '
+                    f'{len(result_list)} docs, {rate:.1f} docs/s')
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
         return {'result': result_list} if result_list else {}
 
     def get_collections(self, coll_filter=None, gf_filter=True) -> list:
         """
-        コレクションを取得
+        | コレクションを取得
+        | gf_filterがTrueの場合はGrid.fsとoidの対応表のコレクションを除く
 
         :param dict or None coll_filter:
         :param bool gf_filter: default True
@@ -1079,7 +2343,8 @@ class DB:
                        self.db.list_collection_names(filter=coll_filter)]
         if gf_filter:
             result = list(
-                set(collections) - {Config.fs_files, Config.fs_chunks})
+                set(collections) - {Config.fs_files, Config.fs_chunks,
+                                    self.registry})
         else:
             result = collections
         result.sort()
@@ -1107,7 +2372,8 @@ class DB:
             types.extend([types[-1] for _ in range(len(target) - len(types))])
         return types
 
-    def bson_type(self, bson_data: dict, search_filters=None) -> dict:
+    def bson_type(self, bson_data: dict, search_filters=None,
+                  engine='python', batch_size=1000, checkpoint=None) -> dict:
         """
         DB内のデータをJSONに従って型変更をする
         DBにあってJSONにないキーは無視
@@ -1141,12 +2407,29 @@ class DB:
         |
         |   search_filtersを指定すると該当するドキュメントのみ変換する
         | search_filters = {'collection_name':{'_id':ObjectId('OBJECTID')}}
+        |
+        |   engine='python'の場合はドキュメント毎に変換、更新し、
+        |   ドキュメント毎の結果を返す
+        |   engine='bulk'または'server'の場合は_idの順にbatch_size件ずつ処理し、
+        |   コレクション毎の件数を返す(_bson_type_bulk()を参照)
 
         :param dict bson_data:
         :param search_filters: default None
+        :param str engine: python, bulk or server default 'python'
+        :param int batch_size: default 1000
+        :param checkpoint: コレクション毎の処理済みの最後の_id default None
+        :type checkpoint: dict or None
         :return: result
         :rtype: dict
         """
+        if engine in ('bulk', 'server'):
+            return self._bson_type_bulk(bson_data, search_filters,
+                                        engine == 'server', batch_size,
+                                        checkpoint)
+        if engine != 'python':
+            raise EdmanFormatError(
+                'engineはpython, bulkまたはserverの指定が必要です')
+
         result: dict[str, Any] = {}
 
         for collection, items in bson_data.items():
@@ -1163,67 +2446,12 @@ class DB:
             #     }]}
             # docs = self.db[collection].find(reference, projection=projection)
 
-            if search_filters is not None and isinstance(search_filters, dict):
-                search_filter = search_filters.get(collection, {})
-            else:
-                search_filter = {}
-            docs = self.db[collection].find(filter=search_filter,
-                                            projection=projection)
+            docs = self.db[collection].find(
+                filter=self._bson_type_filter(collection, search_filters),
+                projection=projection)
 
             for doc in docs:
-                update_params = {}
-                log_buff = []
-                for item_key in items_keys:
-                    if item_key in doc:
-                        db_value = doc[item_key]
-                        json_value = items[item_key]
-
-                        # JSONの値がリストの場合
-                        if isinstance(json_value, list):
-                            if isinstance(db_value, list):
-                                # JSONとDBのリストを同じ個数にパックする
-                                # JSON側が少ない時はJSON側の最後の値で埋める
-                                # DB側が少ない時はDBと同じ個数でJSON側を切り捨て
-                                j = self.pack_list(json_value, db_value)
-                                list_buff = []
-                                for idx, list_value in enumerate(db_value):
-                                    f = Utils.type_cast_conv(j[idx])
-
-                                    # datetimeからdatetimeには変換できない.
-                                    # その他もデータも念のために一度strに変換してからfに渡す
-                                    # Noneは変換しない
-                                    if list_value is not None:
-                                        if not isinstance(list_value, str):
-                                            list_value = str(list_value)
-                                        u_param = f(list_value)
-                                    else:
-                                        u_param = None
-                                    list_buff.append(u_param)
-                                param = {item_key: list_buff}
-                            else:
-                                # DB側がリストじゃない時は無視
-                                param = {}
-                        else:
-                            # JSONがリストじゃないのにDBがリストの時は無視
-                            if isinstance(db_value, list):
-                                param = {}
-                            else:
-                                # DBもJSONも単一の型の時
-                                f = Utils.type_cast_conv(json_value)
-
-                                # datetimeからdatetimeには変換できない.
-                                # その他もデータも念のために一度strに変換してからfに渡す
-                                # Noneは変換しない
-                                if db_value is not None:
-                                    if not isinstance(db_value, str):
-                                        db_value = str(db_value)
-                                    param = {item_key: f(db_value)}
-                                else:
-                                    param = {}
-
-                        if param:
-                            update_params.update(param)
-                            log_buff.append(item_key)
+                update_params, log_buff = self._bson_type_params(doc, items)
                 # update
                 if update_params:
                     res = self.db[collection].update_one(
@@ -1244,18 +2472,337 @@ class DB:
                     result[collection].update(out_buff)
                 else:
                     result.update({collection: out_buff})
+            self._invalidate_cache(collection)
 
         return result
 
-    def get_ref_depth(self, doc: dict, reference_key: str) -> int:
+    @staticmethod
+    def _bson_type_filter(collection: str, search_filters=None) -> dict:
+        """
+        search_filtersから対象コレクションのフィルタを取り出す
+
+        :param str collection:
+        :param search_filters: default None
+        :type search_filters: dict or None
+        :return:
+        :rtype: dict
+        """
+        if search_filters is not None and isinstance(search_filters, dict):
+            return search_filters.get(collection, {})
+        return {}
+
+    def _bson_type_params(self, doc: dict, items: dict) -> tuple[dict, list]:
         """
-        要素への階層の数を取得する
+        | 1ドキュメント分の型変換後の値を作成する
+        | 変換方法はbson_type()を参照
+
+        :param dict doc:
+        :param dict items: キーと変更する型
+        :return: update_params, log_buff 更新する値と対象のキーのリスト
+        :rtype: tuple
+        """
+        update_params = {}
+        log_buff = []
+        for item_key, json_value in items.items():
+            if item_key in doc:
+                db_value = doc[item_key]
+
+                # JSONの値がリストの場合
+                if isinstance(json_value, list):
+                    if isinstance(db_value, list):
+                        # JSONとDBのリストを同じ個数にパックする
+                        # JSON側が少ない時はJSON側の最後の値で埋める
+                        # DB側が少ない時はDBと同じ個数でJSON側を切り捨て
+                        j = self.pack_list(json_value, db_value)
+                        list_buff = []
+                        for idx, list_value in enumerate(db_value):
+                            f = Utils.type_cast_conv(j[idx])
+
+                            # datetimeからdatetimeには変換できない.
+                            # その他もデータも念のために一度strに変換してからfに渡す
+                            # Noneは変換しない
+                            if list_value is not None:
+                                if not isinstance(list_value, str):
+                                    list_value = str(list_value)
+                                u_param = f(list_value)
+                            else:
+                                u_param = None
+                            list_buff.append(u_param)
+                        param = {item_key: list_buff}
+                    else:
+                        # DB側がリストじゃない時は無視
+                        param = {}
+                else:
+                    # JSONがリストじゃないのにDBがリストの時は無視
+                    if isinstance(db_value, list):
+                        param = {}
+                    else:
+                        # DBもJSONも単一の型の時
+                        f = Utils.type_cast_conv(json_value)
+
+                        # datetimeからdatetimeには変換できない.
+                        # その他もデータも念のために一度strに変換してからfに渡す
+                        # Noneは変換しない
+                        if db_value is not None:
+                            if not isinstance(db_value, str):
+                                db_value = str(db_value)
+                            param = {item_key: f(db_value)}
+                        else:
+                            param = {}
+
+                if param:
+                    update_params.update(param)
+                    log_buff.append(item_key)
+        return update_params, log_buff
+
+    def _bson_type_bulk(self, bson_data: dict, search_filters=None,
+                        server=False, batch_size=1000,
+                        checkpoint=None) -> dict:
+        """
+        | bson_type()の一括処理版
+        |
+        | ドキュメントを_idの順にbatch_size件ずつ取得し、
+        | 変換後の値をUpdateOneにまとめてbulk_writeで更新する
+        | バッチ毎に処理済みの最後の_idをcheckpointに書き込み、進捗をロガーに出力する
+        | 同じcheckpointを渡すと続きから再開する
+        |
+        | serverがTrueの場合、JSON側が単一のint, float, bool, datetimeのキーは
+        | 文字列の値を集計パイプラインの更新でサーバ側で変換する
+        | (_server_cast()を参照)
+        | 文字列以外の値と、サーバ側で変換できなかった文字列の値(範囲外の整数や
+        | dateutilのみが解釈できる日付など)はUpdateOneで変換し、
+        | python engineと同じ結果にする
+        | それでも変換できなかった値はそのまま残り、その件数をunconvertedとして返す
+        |
+        |   結果例:
+        |   {'コレクション名': {'docs': 処理件数, 'modified': 更新件数,
+        |                      'unconverted': 0, 'last_id': ObjectId}}
+
+        :param dict bson_data:
+        :param search_filters: default None
+        :param bool server: default False
+        :param int batch_size: default 1000
+        :param checkpoint: コレクション毎の処理済みの最後の_id default None
+        :type checkpoint: dict or None
+        :return: result
+        :rtype: dict
+        """
+        if batch_size < 1:
+            raise EdmanFormatError('batch_sizeは1以上を指定してください')
+
+        result: dict[str, Any] = {}
+        for collection, items in bson_data.items():
+            search_filter = self._bson_type_filter(collection, search_filters)
+            server_items = {k: v for k, v in items.items()
+                            if server and isinstance(v, str)
+                            and v in self._server_cast_types}
+            projection = {k: 1 for k in items} or {'_id': 1}
+            pipeline = [{'$set': {k: self._server_cast(k, v)
+                                  for k, v in server_items.items()}}]
+
+            stats: dict[str, Any] = {'docs': 0, 'modified': 0,
+                                     'unconverted': 0, 'last_id': None}
+            last_id = (checkpoint or {}).get(collection)
+            start = time.perf_counter()
+            while True:
+                query = search_filter if last_id is None else {
+                    '$and': [search_filter, {'_id': {'$gt': last_id}}]}
+                docs = list(self.db[collection].find(
+                    query, projection=projection, sort=[('_id', ASCENDING)],
+                    limit=batch_size))
+                if not docs:
+                    break
+
+                if server_items:
+                    res = self.db[collection].update_many(
+                        {'$and': [search_filter,
+                                  {'_id': {'$gte': docs[0]['_id'],
+                                           '$lte': docs[-1]['_id']}}]},
+                        pipeline)
+                    stats['modified'] += res.modified_count
+
+                requests = []
+                for doc in docs:
+                    # サーバ側で変換した文字列の値以外を変換する
+                    doc = {k: v for k, v in doc.items()
+                           if k not in server_items
+                           or not isinstance(v, str)}
+                    update_params, _ = self._bson_type_params(doc, items)
+                    if update_params:
+                        requests.append(UpdateOne({'_id': doc['_id']},
+                                                  {'$set': update_params}))
+                if server_items:
+                    requests.extend(self._bson_type_unconverted(
+                        collection, [i['_id'] for i in docs], server_items))
+                if requests:
+                    stats['modified'] += self.db[collection].bulk_write(
+                        requests, ordered=False).modified_count
+
+                last_id = docs[-1]['_id']
+                stats['docs'] += len(docs)
+                stats['last_id'] = last_id
+                if checkpoint is not None:
+                    checkpoint[collection] = last_id
+                seconds = time.perf_counter() - start
+                rate = stats['docs'] / seconds if seconds else 0.0
+                self.logger.info(
+                    f'bson_type {collection}: {stats["docs"]} docs, '
+                    f'{stats["modified"]} modified, {rate:.1f} docs/s')
+
+            if server_items:
+                stats['unconverted'] = self.db[collection].count_documents(
+                    {'$and': [search_filter,
+                              {'$or': [{k: {'$type': 'string'}}
+                                       for k in server_items]}]})
+            self._invalidate_cache(collection)
+            result[collection] = stats
+        return result
+
+    def _bson_type_unconverted(self, collection: str, oids: list,
+                               items: dict) -> list:
+        """
+        | サーバ側で変換できずに文字列のまま残った値を変換するUpdateOneを作成する
+        | Pythonでも変換できない値はそのまま残す
+
+        :param str collection:
+        :param list oids: 処理中のバッチの_idのリスト
+        :param dict items: サーバ側で変換したキーと変更する型
+        :return: UpdateOneのリスト
+        :rtype: list
+        """
+        requests = []
+        for doc in self.db[collection].find(
+                {'_id': {'$in': oids},
+                 '$or': [{k: {'$type': 'string'}} for k in items]},
+                projection={k: 1 for k in items}):
+            update_params = {}
+            for key, value in doc.items():
+                if key not in items or not isinstance(value, str):
+                    continue
+                try:
+                    params, _ = self._bson_type_params({key: value}, items)
+                except (ValueError, OverflowError):
+                    continue
+                update_params.update(params)
+            if update_params:
+                requests.append(UpdateOne({'_id': doc['_id']},
+                                          {'$set': update_params}))
+        return requests
+
+    @classmethod
+    def _server_cast(cls, key: str, datatype: str) -> dict:
+        """
+        | 文字列の値をサーバ側で型変換する集計式を作成する
+        | 文字列以外の値と、変換できない値はそのまま残す
+        | boolはPythonのbool(str)と同じく、空文字以外をTrueとする
+        | intはPythonと同じく32bit整数とし、範囲外の値は変換しない
+
+        :param str key:
+        :param str datatype: int, float, datetime or bool
+        :return:
+        :rtype: dict
+        """
+        value = '$' + key
+        if datatype == 'bool':
+            cast: Any = {'$ne': [value, '']}
+        else:
+            cast = {'$convert': {'input': value,
+                                 'to': cls._server_cast_types[datatype],
+                                 'onError': value}}
+        return {'$cond': [{'$eq': [{'$type': value}, 'string']}, cast, value]}
+
+    def get_ref_depth(self, doc: dict, reference_key: str,
+                      engine='recursive', memoize=False,
+                      collection=None) -> int:
+        """
+        | 要素への階層の数を取得する
+        | 深さの情報が付与されている場合はそれを利用する
+        |
+        | engine='level'の場合は世代単位でまとめて取得する
+        | (_get_ref_depth_by_level()を参照)
+        | memoizeがTrueの場合は結果をドキュメント毎にキャッシュに保持し、
+        | 次回以降はDBを参照しない(_depth_memo_cache()を参照)
+        | memoizeにはdocが所属するcollectionの指定が必要
+        | doc自身と辿ったドキュメントをmembersとするため、それらが破棄される
+        | (ChangeStreamInvalidatorで他のプロセスの書き込みを反映する場合を含む)と
+        | 保持した結果も破棄される
+        | このインスタンスから書き込みや削除をした場合は全て破棄される
+        | 深さの情報を利用した場合は保持しない
 
         :param dict doc:
         :param str reference_key: DBRefが格納されているキー名 例:_ed_parent, _ed_child
+        :param str engine: recursive or level default 'recursive'
+        :param bool memoize: default False
+        :param collection: docが所属するコレクション default None
+        :type collection: str or None
+        :return:
+        :rtype: int
+        """
+        if engine not in ('recursive', 'level'):
+            raise EdmanFormatError('engineはrecursiveまたはlevelの指定が必要です')
+        if memoize and collection is None:
+            raise EdmanFormatError('memoizeにはcollectionの指定が必要です')
+
+        memoize = memoize and self.depth not in doc \
+            and doc.get('_id') is not None
+        memo_key = (self._depth_namespace, reference_key)
+        if memoize and (memo := self._depth_memo_cache().get(
+                memo_key, doc['_id'])) is not None:
+            return memo['depth']
+
+        visited: set | None = {(collection, doc['_id'])} \
+            if memoize else None
+        if self.depth in doc or engine == 'recursive':
+            result = self._get_ref_depth_recursive(doc, reference_key,
+                                                   visited)
+        else:
+            result = self._get_ref_depth_by_level(doc, reference_key,
+                                                  visited)
+
+        if memoize:
+            self._depth_memo_cache().put(memo_key, doc['_id'],
+                                         {'depth': result}, members=visited)
+            self._depth_memoized = True
+        return result
+
+    def _depth_memo_cache(self):
+        """
+        | get_ref_depth(memoize=True)の結果を格納するキャッシュを取得する
+        | cacheが指定されている場合はcacheに(_depth_namespace, reference_key)を
+        | コレクションとして格納する
+        | 指定されていない場合はサイズ上限付きのDocumentCacheを作成し、
+        | add_cache()で登録する
+
+        :return:
+        :rtype: DocumentCache
+        """
+        if self.cache is not None:
+            return self.cache
+        if self._depth_cache is None:
+            self._depth_cache = DocumentCache()
+            self.add_cache(self._depth_cache)
+        return self._depth_cache
+
+    def _get_ref_depth_recursive(self, doc: dict, reference_key: str,
+                                 visited=None) -> int:
+        """
+        | 再帰でリファレンスを辿り、要素への階層の数を取得する
+        | 深さの情報が付与されている場合はそれを利用する
+
+        :param dict doc:
+        :param str reference_key:
+        :param visited: 辿ったドキュメントの(コレクション, ObjectId)を追加する
+            default None
+        :type visited: set or None
         :return:
         :rtype: int
         """
+        if self.depth in doc:
+            if reference_key == self.parent:
+                return doc[self.depth]
+            elif reference_key == self.child:
+                return self._get_child_depth_by_ancestors(doc)
+
         result = 0
         if reference_key in doc:
             # 子要素の場合はリストで入っている
@@ -1265,28 +2812,104 @@ class DB:
                 result_list = []
                 for dbref_doc in doc[reference_key]:
                     # tmp = 1
-                    tmp = self.get_ref_depth(self.db.dereference(dbref_doc),
-                                             reference_key)
+                    if visited is not None:
+                        visited.add((dbref_doc.collection, dbref_doc.id))
+                    tmp = self._get_ref_depth_recursive(
+                        self._dereference(dbref_doc), reference_key, visited)
                     result_list.append(tmp)
                 result += max(result_list)
             else:
                 # 親要素はツリーを遡っていくだけ
                 result = 1
-                result += self.get_ref_depth(
-                    self.db.dereference(doc[reference_key]), reference_key)
+                dbref_doc = doc[reference_key]
+                if visited is not None:
+                    visited.add((dbref_doc.collection, dbref_doc.id))
+                result += self._get_ref_depth_recursive(
+                    self._dereference(dbref_doc), reference_key, visited)
+        return result
+
+    def _get_ref_depth_by_level(self, doc: dict, reference_key: str,
+                                visited=None) -> int:
+        """
+        | 世代単位でリファレンスを辿り、要素への階層の数を取得する
+        |
+        | 子要素は1世代につきコレクション毎に1クエリでまとめて取得する
+        | 親要素は1世代につき1クエリ
+        | いずれもリファレンスのみを取得する
+
+        :param dict doc:
+        :param str reference_key:
+        :param visited: 辿ったドキュメントの(コレクション, ObjectId)を追加する
+            default None
+        :type visited: set or None
+        :return: result
+        :rtype: int
+        """
+        result = 0
+        generation = [doc]
+        while refs := [ref for d in generation
+                       for ref in self._refs_of(d, reference_key)]:
+            if visited is not None:
+                visited.update((ref.collection, ref.id) for ref in refs)
+            generation = list(self._dereference_many(
+                refs, projection={reference_key: 1}).values())
+            if not generation:
+                break
+            result += 1
+        return result
+
+    @staticmethod
+    def _refs_of(doc: dict, reference_key: str) -> list:
+        """
+        ドキュメントのリファレンスをリストで取り出す
+
+        :param dict doc:
+        :param str reference_key:
+        :return:
+        :rtype: list
+        """
+        refs = doc.get(reference_key)
+        if refs is None:
+            return []
+        return refs if isinstance(refs, list) else [refs]
+
+    def _get_child_depth_by_ancestors(self, doc: dict) -> int:
+        """
+        | 祖先のリファレンス情報と深さを利用して、子要素への階層の数を取得する
+        |
+        | コレクション毎に最も深い子孫を1クエリで取得する
+
+        :param dict doc:
+        :return: result
+        :rtype: int
+        """
+        result = 0
+        if self.child not in doc:
+            return result
+
+        for collection in self.get_collections():
+            deepest = self.db[collection].find_one(
+                {self.ancestors + '.$id': doc['_id']},
+                projection={self.depth: 1},
+                sort=[(self.depth, -1)])
+            if deepest is not None and self.depth in deepest:
+                result = max(result, deepest[self.depth] - doc[self.depth])
         return result
 
     def get_root_dbref(self, doc: dict) -> None | DBRef:
         """
         ref形式のドキュメントのルートのDBRef要素を取得する
         ※root要素内にはparentのdbref要素は存在しないので、上から2階層目のparentのdbrefを取得する
+        ルートのリファレンス情報が付与されている場合はそれを利用する
         :param dict doc:
         :return: parent_ref
         :rtype: None or DBRef
         """
+        if self.root in doc:
+            return doc[self.root]
         if (parent_ref := doc.get(Config.parent)) is not None:
             if (over_first_degree_ref := self.get_root_dbref(
-                    self.db.dereference(doc[Config.parent]))) is not None:
+                    self._dereference(doc[Config.parent]))) is not None:
                 parent_ref = over_first_degree_ref
         return parent_ref
 
@@ -1306,3 +2929,5 @@ class DB:
             if after_collections := self.get_collections(gf_filter=False):
                 raise EdmanDbProcessError(
                     f'削除できないコレクションがあります {after_collections}')
+        finally:
+            self._invalidate_cache()
@@ -1,20 +1,26 @@
 import binascii
 import copy
 import datetime
-import gzip
+import hashlib
+import itertools
 import json
 import os
-import shutil
+import posixpath
+import threading
+import time
 import zipfile
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from logging import INFO, getLogger
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from typing import IO, Any, Iterator, List, Tuple
+from typing import IO, Any, Iterable, Iterator, List, Tuple
 
 import gridfs
 import jmespath
 from bson import ObjectId
 from gridfs.errors import GridFSError, NoFile
+from pymongo import errors
 
 from edman import Config
 from edman.exceptions import (EdmanDbProcessError, EdmanFormatError,
@@ -22,17 +28,53 @@ from edman.exceptions import (EdmanDbProcessError, EdmanFormatError,
 from edman.utils import Utils
 
 
+class ByteRateLimiter:
+    """
+    | 転送量の上限(byte/s)を設けるクラス
+    | 複数のスレッドで共有し、合計の転送速度が上限を超えないよう待機する
+    """
+
+    def __init__(self, max_bytes_per_sec: int) -> None:
+        if max_bytes_per_sec < 1:
+            raise EdmanFormatError('max_bytes_per_secは1以上を指定してください')
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._total = 0
+
+    def consume(self, size: int) -> None:
+        """
+        | 転送したバイト数を加算する
+        | 開始からの平均速度が上限を超える場合は、上限に収まるまで待機する
+
+        :param int size:
+        :return:
+        """
+        with self._lock:
+            self._total += size
+            wait = self._total / self.max_bytes_per_sec - (
+                time.monotonic() - self._start)
+        if wait > 0:
+            time.sleep(wait)
+
+
 class File:
     """
-    ファイル取扱クラス
+    | ファイル取扱クラス
+    |
+    | cacheを指定した場合は、ドキュメントを書き換えた際に
+    | 該当のドキュメントをキャッシュから破棄する
     """
 
-    def __init__(self, db=None) -> None:
+    def __init__(self, db=None, cache=None) -> None:
 
         if db is not None:
             self.db = db
             self.fs = gridfs.GridFS(self.db)
+        self.cache = cache
         self.file_ref = Config.file
+        self.revision = Config.revision
+        self.refcount = Config.fs_refcount
         # self.comp_level = Config.gzip_compress_level
         self.file_attachment = Config.file_attachment
 
@@ -59,9 +101,12 @@ class File:
             yield file.name, fp
 
     def delete(self, delete_oid: ObjectId, collection: str,
-               oid: ObjectId | str, structure: str, query=None) -> bool:
+               oid: ObjectId | str, structure: str, query=None,
+               revision=False, max_retries=3) -> bool:
         """
-        該当のoidをファイルリファレンスから削除し、GridFSからファイルを削除
+        | 該当のoidをファイルリファレンスから削除し、GridFSからファイルを削除
+        | revisionがTrueの場合はリビジョンを条件に書き込み、
+        | 他の書き込みと競合した時はmax_retries回まで読み込みからやり直す
 
         :param ObjectId delete_oid:
         :param str collection:
@@ -69,6 +114,8 @@ class File:
         :param str structure:
         :param query:
         :type query: list or None
+        :param bool revision: default False
+        :param int max_retries: default 3
         :return:
         :rtype: bool
         """
@@ -81,43 +128,115 @@ class File:
             raise EdmanInternalError(
                 '対象のコレクション、またはドキュメントが存在しません')
 
-        # ファイルリスト取得
-        files_list = self.get_file_ref(doc, structure, query)
-        if len(files_list) == 0:
-            raise EdmanDbProcessError('ファイルが存在しません')
+        def amend(doc: dict) -> dict:
+            # ファイルリスト取得
+            files_list = self.get_file_ref(doc, structure, query)
+            if len(files_list) == 0:
+                raise EdmanDbProcessError('ファイルが存在しません')
 
-        # リファレンスデータを編集
-        # 何らかの原因で重複があった場合を避けるため一度setにする
-        files_list = list(set(files_list))
-        files_list.remove(delete_oid)
+            # リファレンスデータを編集
+            # 何らかの原因で重複があった場合を避けるため一度setにする
+            files_list = list(set(files_list))
+            files_list.remove(delete_oid)
+
+            # ドキュメントを新しいファイルリファレンスに置き換える
+            try:
+                if structure == 'ref':
+                    new_doc = self.file_list_replace(doc, files_list)
+                else:
+                    new_doc = Utils.doc_traverse(doc, files_list, query,
+                                                 self.file_list_replace)
+            except Exception:
+                raise
+            return new_doc
 
-        # ドキュメントを新しいファイルリファレンスに置き換える
-        try:
-            if structure == 'ref':
-                new_doc = self.file_list_replace(doc, files_list)
-            else:
-                new_doc = Utils.doc_traverse(doc, files_list, query,
-                                             self.file_list_replace)
-        except Exception:
-            raise
-        replace_result = self.db[collection].replace_one({'_id': oid}, new_doc)
         # fsから該当ファイルを削除
-        if replace_result.modified_count:
+        if self._replace_doc(collection, doc, amend, revision, max_retries):
             self.fs_delete([delete_oid])
+            # 重複排除で共有されているファイルは参照数が減るだけで残る
+            return True
 
         # ファイルが削除されればOK
         return False if self.fs.exists(delete_oid) else True
 
-    def fs_delete(self, oids: list) -> None:
+    def fs_delete(self, oids: list, session=None, chunk_size=10000) -> int:
         """
-        fsからファイル削除
+        | fsからファイル削除
+        | filesとchunksをそれぞれdelete_manyでまとめて削除する
+        | コマンドやトランザクションのサイズ上限を超えないよう、
+        | chunk_size件毎に分割する
+        | 重複排除で共有されているファイルは参照数を減らし、
+        | 最後の参照が無くなった時だけ削除する
+        | oidsに同じoidが複数含まれる場合は、その数だけ参照を減らす
 
         :param list oids:
-        :return:
+        :param session: default None
+        :type session: ClientSession or None
+        :param int chunk_size: default 10000
+        :return: 削除したファイル数
+        :rtype: int
         """
-        for oid in oids:
-            if self.fs.exists(oid):
-                self.fs.delete(oid)
+        counts = Counter(oids)
+        unique_oids = list(counts)
+        deleted_count = 0
+        for i in range(0, len(unique_oids), chunk_size):
+            chunk, deleted_shared = self._release_shared_files(
+                unique_oids[i:i + chunk_size], counts, session)
+            deleted_count += deleted_shared
+            if not chunk:
+                continue
+            result = self.db[Config.fs_files].delete_many(
+                {'_id': {'$in': chunk}}, session=session)
+            self.db[Config.fs_chunks].delete_many(
+                {'files_id': {'$in': chunk}}, session=session)
+            deleted_count += result.deleted_count
+        return deleted_count
+
+    def _release_shared_files(self, oids: list, counts: Counter,
+                              session=None) -> tuple[list, int]:
+        """
+        | 参照数を持つファイルは参照数を減らし、最後の参照であれば削除する
+        |
+        | 参照数は読み込んだ値を条件に書き換え、削除も読み込んだ値が
+        | 変わっていない場合のみ行う
+        | 同時に重複排除で参照が増えた場合は読み込みからやり直す
+
+        :param list oids:
+        :param Counter counts: oid毎に減らす参照数
+        :param session: default None
+        :type session: ClientSession or None
+        :return: 参照数を持たないファイルのoidのリストと、
+            削除した参照数を持つファイルの数
+        :rtype: tuple
+        """
+        files = self.db[Config.fs_files]
+        shared = {i['_id']: i[self.refcount] for i in files.find(
+            {'_id': {'$in': oids}, self.refcount: {'$exists': True}},
+            {self.refcount: 1}, session=session)}
+        released = 0
+        deleted = []
+        for oid, current in shared.items():
+            while current is not None:
+                if current > counts[oid]:
+                    if files.update_one(
+                            {'_id': oid, self.refcount: current},
+                            {'$inc': {self.refcount: -counts[oid]}},
+                            session=session).modified_count:
+                        released += 1
+                        break
+                elif files.delete_one({'_id': oid, self.refcount: current},
+                                      session=session).deleted_count:
+                    deleted.append(oid)
+                    break
+                doc = files.find_one({'_id': oid}, {self.refcount: 1},
+                                     session=session)
+                current = doc.get(self.refcount) if doc else None
+        if deleted:
+            self.db[Config.fs_chunks].delete_many(
+                {'files_id': {'$in': deleted}}, session=session)
+        if released:
+            self.logger.info(f'fs_delete: released {released} shared files')
+        return [i for i in oids if i not in shared], len(deleted)
 
     def get_file_ref(self, doc: dict, structure: str, query=None) -> list:
         """
@@ -156,6 +275,7 @@ class File:
         """
         ファイル一覧を取得
         ファイルが存在しなければ空の辞書を返す
+        ファイル名はfs.filesから$inでまとめて1クエリで取得する
 
         :param str collection:
         :param str oid:
@@ -173,38 +293,59 @@ class File:
             raise EdmanDbProcessError(
                 f'ドキュメントまたはコレクションが存在しません oid:{oid} collection:{collection}')
 
-        # gridfsからファイル名を取り出す
-        for file_oid in self.get_file_ref(doc, structure, query):
-            try:
-                fs_out = self.fs.get(file_oid)
-            except gridfs.errors.NoFile:
-                continue
-            else:
-                result.update({file_oid: fs_out.filename})
+        # gridfsのメタデータからファイル名を取り出す
+        file_oids = self.get_file_ref(doc, structure, query)
+        filenames = {i['_id']: i.get('filename')
+                     for i in self.db[Config.fs_files].find(
+                         {'_id': {'$in': file_oids}},
+                         projection={'filename': 1})}
+        for file_oid in file_oids:
+            if file_oid in filenames:
+                result.update({file_oid: filenames[file_oid]})
         return result
 
-    def download(self, file_oid: list[ObjectId], path: str | Path) -> bool:
+    def download(self, file_oid: list[ObjectId], path: str | Path,
+                 max_workers=None, max_bytes_per_sec=None,
+                 decompress=False) -> bool:
         """
-        Gridfsからデータをダウンロードし、ファイルに保存
+        | Gridfsからデータをダウンロードし、ファイルに保存
+        | max_workersを指定すると複数のファイルを並列にダウンロードする
+        | max_bytes_per_secを指定すると合計の転送速度を制限する
+        | decompressがTrueの場合、gzip圧縮されたファイルは逐次解凍して保存する
 
         :param list file_oid:
         :param path:
         :type path: str or Path
+        :param max_workers: 並列数 default None
+        :type max_workers: int or None
+        :param max_bytes_per_sec: 転送速度の上限(byte/s) default None
+        :type max_bytes_per_sec: int or None
+        :param bool decompress: default False
         :return: result
         :rtype: bool
         """
         # 定型的な前処理があればここに追加する
-        return self._grid_out(file_oid, path)
+        return self._grid_out(file_oid, path, max_workers, max_bytes_per_sec,
+                              decompress)
 
-    def _grid_out(self, file_oid_list: List[ObjectId],
-                  path: str | Path) -> bool:
+    def _grid_out(self, file_oid_list: List[ObjectId], path: str | Path,
+                  max_workers=None, max_bytes_per_sec=None,
+                  decompress=False) -> bool:
         """
-        Gridfsからデータを取得し、ファイルに保存
-        複数のファイルを指定すると、複数のファイルが作成される
+        | Gridfsからデータを取得し、ファイルに保存
+        | 複数のファイルを指定すると、複数のファイルが作成される
+        | ファイルの存在確認とメタデータの取得はfs.filesへの1クエリで行い、
+        | データはチャンク毎に書き込む
+        | decompressがTrueの場合、gzip圧縮されたファイルは逐次解凍して保存する
 
         :param list file_oid_list:
         :param path:
         :type path: str or Path
+        :param max_workers: 並列数 default None
+        :type max_workers: int or None
+        :param max_bytes_per_sec: 転送速度の上限(byte/s) default None
+        :type max_bytes_per_sec: int or None
+        :param bool decompress: default False
         :return: result
         :rtype: bool
         """
@@ -216,32 +357,82 @@ class File:
         if not p.exists():
             raise FileNotFoundError
         # ファイルが存在するか検証
-        if False in map(self.fs.exists, file_oid_list):
+        grid_outs = {i._id: i for i in self.fs.find(
+            {'_id': {'$in': list(file_oid_list)}})}
+        if any(i not in grid_outs for i in file_oid_list):
             raise EdmanDbProcessError('指定のファイルはDBに存在しません')
 
-        # ダウンロード処理
-        results = []
-        for file_oid in file_oid_list:
-            fs_out = self.fs.get(file_oid)
+        limiter = ByteRateLimiter(
+            max_bytes_per_sec) if max_bytes_per_sec is not None else None
+
+        def save(file_oid: ObjectId) -> bool:
+            fs_out = grid_outs[file_oid]
             save_path = p / fs_out.filename
+            chunks = self._iter_chunks(fs_out)
+            if decompress:
+                chunks = self._iter_decompressed(chunks, fs_out.filename)
             try:
                 with save_path.open('wb') as f:
-                    tmp = fs_out.read()
-                    f.write(tmp)
+                    for chunk in chunks:
+                        f.write(chunk)
+                        if limiter is not None:
+                            limiter.consume(len(chunk))
                     f.flush()
                     os.fsync(f.fileno())
             except IOError:
                 raise
-            results.append(save_path.exists())
+            return save_path.exists()
+
+        # ダウンロード処理
+        results = self._map_files(save, file_oid_list, max_workers)
 
         return all(results)
 
+    @staticmethod
+    def _iter_chunks(content: gridfs.GridOut) -> Iterator[bytes]:
+        """
+        | GridOutをチャンク単位で返すイテレータ
+        | GridOutを直接イテレートすると改行区切りになり、
+        | 改行を含まないバイナリは全体が1つになるため、readchunk()を使う
+
+        :param gridfs.GridOut content:
+        :return:
+        :rtype: Iterator
+        """
+        return iter(content.readchunk, b'')
+
+    @staticmethod
+    def _map_files(func, items: list | tuple, max_workers=None) -> list:
+        """
+        | itemsの各要素にfuncを適用し、結果を入力順のリストで返す
+        | max_workersを指定した場合はスレッドで並列に処理する
+
+        :param func:
+        :type func: Callable
+        :param items:
+        :type items: list or tuple
+        :param max_workers: 並列数 default None
+        :type max_workers: int or None
+        :return:
+        :rtype: list
+        """
+        if max_workers is None:
+            return [func(i) for i in items]
+        if max_workers < 1:
+            raise EdmanFormatError('max_workersは1以上を指定してください')
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(func, items))
+
     def upload(self, collection: str, oid: ObjectId | str,
                file_path: Tuple[Path], structure: str,
-               query=None) -> bool:
+               query=None, revision=False, max_retries=3, max_workers=None,
+               max_bytes_per_sec=None, dedup=False) -> bool:
         """
         ドキュメントにファイルリファレンスを追加する
         ファイルのインサート処理なども行う
+        revisionがTrueの場合はリビジョンを条件に書き込み、
+        他の書き込みと競合した時はmax_retries回まで読み込みからやり直す
+        max_workers, max_bytes_per_sec, dedupはgrid_in()を参照
         :param str collection:
         :param oid:
         :type oid: ObjectId or str
@@ -249,6 +440,13 @@ class File:
         :param str structure:
         :param query:
         :type query: list or None
+        :param bool revision: default False
+        :param int max_retries: default 3
+        :param max_workers: 並列数 default None
+        :type max_workers: int or None
+        :param max_bytes_per_sec: 転送速度の上限(byte/s) default None
+        :type max_bytes_per_sec: int or None
+        :param bool dedup: default False
         :return:
         :rtype: bool
         """
@@ -267,47 +465,212 @@ class File:
                     '対象のドキュメントに対してクエリーが一致しません.')
 
         # ファイルのインサート
-        inserted_file_oids = self.grid_in(file_path)
-        if structure == 'ref':
-            new_doc = self.file_list_attachment(doc, inserted_file_oids)
-        else:
-            try:
-                new_doc = Utils.doc_traverse(doc, inserted_file_oids, query,
-                                             self.file_list_attachment)
-            except Exception:
-                raise
+        inserted_file_oids = self.grid_in(
+            file_path, max_workers=max_workers,
+            max_bytes_per_sec=max_bytes_per_sec, dedup=dedup)
+
+        def amend(doc: dict) -> dict:
+            if structure == 'ref':
+                new_doc = self.file_list_attachment(doc,
+                                                    list(inserted_file_oids))
+            else:
+                try:
+                    new_doc = Utils.doc_traverse(doc,
+                                                 list(inserted_file_oids),
+                                                 query,
+                                                 self.file_list_attachment)
+                except Exception:
+                    raise
+            return new_doc
 
         # ドキュメント差し替え
-        replace_result = self.db[collection].replace_one({'_id': oid}, new_doc)
-        if replace_result.modified_count == 1:
-            result = True
-        else:  # 差し替えができなかった時は添付ファイルは削除
+        try:
+            result = self._replace_doc(collection, doc, amend, revision,
+                                       max_retries)
+        except EdmanDbProcessError:
+            self.fs_delete(inserted_file_oids)
+            raise
+        if not result:  # 差し替えができなかった時は添付ファイルは削除
             self.fs_delete(inserted_file_oids)
-            result = False
+        elif dedup:
+            # リファレンスは重複しないため、同じファイルを指す分の参照数を戻す
+            existing = set(self.get_file_ref(doc, structure, query))
+            duplicates = list(
+                (Counter(inserted_file_oids)
+                 - Counter(set(inserted_file_oids) - existing)).elements())
+            if duplicates:
+                self.fs_delete(duplicates)
 
         return result
 
-    def grid_in(self, files: Tuple[Path, ...]) -> list[ObjectId]:
+    def _replace_doc(self, collection: str, doc: dict, amend,
+                     revision=False, max_retries=3) -> bool:
         """
-        Gridfsへ複数のデータをアップロード
+        | amendで変更したドキュメントに差し替える
+        | リビジョンの扱いはUtils.read_modify_write()を参照
+
+        :param str collection:
+        :param dict doc: 読み込み済みのドキュメント
+        :param amend: ドキュメントのコピーを受け取り変更後のドキュメントを返す関数
+        :type amend: Callable
+        :param bool revision: default False
+        :param int max_retries: default 3
+        :return: 差し替えできればTrue
+        :rtype: bool
+        """
+        oid = doc['_id']
+
+        def write(doc: dict, new_doc: dict, query) -> int:
+            replace_result = self.db[collection].replace_one(
+                query or {'_id': oid}, new_doc)
+            if self.cache is not None:
+                self.cache.invalidate(collection, [oid])
+            return replace_result.modified_count
+
+        return Utils.read_modify_write(
+            self.db[collection], oid, amend, write, revision=revision,
+            max_retries=max_retries, doc=doc, not_found=EdmanInternalError,
+            logger=self.logger) == 1
+
+    def grid_in(self, files: Tuple[Path, ...], chunk_size=None,
+                max_workers=None, max_bytes_per_sec=None,
+                dedup=False) -> list[ObjectId]:
+        """
+        | Gridfsへ複数のデータをアップロード
+        | ファイル全体をメモリに読み込まず、chunk_size毎に読み込みながら書き込む
+        | max_workersを指定すると複数のファイルを並列にアップロードする
+        | max_bytes_per_secを指定すると合計の転送速度を制限する
+        | dedupがTrueの場合、SHA-256とサイズが同じファイルが既にあれば
+        | そのファイルの参照数を増やして再利用する(_dedup_file()を参照)
+        | 結果は入力の順番で返す
 
         :param tuple files:
+        :param chunk_size: GridFSのチャンクサイズ(byte) default None(255KB)
+        :type chunk_size: int or None
+        :param max_workers: 並列数 default None
+        :type max_workers: int or None
+        :param max_bytes_per_sec: 転送速度の上限(byte/s) default None
+        :type max_bytes_per_sec: int or None
+        :param bool dedup: default False
         :return: inserted
         :rtype: list
         """
-        inserted = []
-        for file in files:
+        limiter = ByteRateLimiter(
+            max_bytes_per_sec) if max_bytes_per_sec is not None else None
+        if dedup:
+            self._create_dedup_index()
+
+        def put(file: Path) -> ObjectId:
             try:
                 with file.open('rb') as f:
-                    fb = f.read()
-                    metadata = {'filename': os.path.basename(f.name)}
+                    return self._grid_in_stream(
+                        f, os.path.basename(f.name), chunk_size, limiter,
+                        dedup)
             except (IOError, OSError) as e:
                 raise EdmanDbProcessError(e)
+
+        return self._map_files(put, files, max_workers)
+
+    def _grid_in_stream(self, fp: IO, filename: str, chunk_size=None,
+                        limiter=None, dedup=False) -> ObjectId:
+        """
+        | ファイルオブジェクトからchunk_size毎に読み込み、Gridfsへ書き込む
+        | 書き込みながらSHA-256を計算し、fs.filesのsha256に保存する
+        | 転送量と速度はロガーに出力する
+        | 失敗した場合は書き込み途中のチャンクを削除する
+
+        :param IO fp: バイナリモードのファイルオブジェクト
+        :param str filename:
+        :param chunk_size: GridFSのチャンクサイズ(byte) default None(255KB)
+        :type chunk_size: int or None
+        :param limiter: 転送速度の制限 default None
+        :type limiter: ByteRateLimiter or None
+        :param bool dedup: default False
+        :return: oid
+        :rtype: ObjectId
+        """
+        kwargs: dict[str, Any] = {'filename': filename}
+        if chunk_size is not None:
+            kwargs.update({'chunk_size': chunk_size})
+        read_size = chunk_size or gridfs.DEFAULT_CHUNK_SIZE
+
+        start = time.perf_counter()
+        sha256 = hashlib.sha256()
+        grid_file = self.fs.new_file(**kwargs)
+        try:
+            while chunk := fp.read(read_size):
+                sha256.update(chunk)
+                grid_file.write(chunk)
+                if limiter is not None:
+                    limiter.consume(len(chunk))
+            grid_file.sha256 = sha256.hexdigest()
+            grid_file.close()
+        except (IOError, OSError, GridFSError) as e:
+            grid_file.abort()
+            raise EdmanDbProcessError(e)
+        except BaseException:
+            # PyMongoErrorや中断の場合も書き込み途中のチャンクを残さない
+            grid_file.abort()
+            raise
+
+        seconds = time.perf_counter() - start
+        rate = grid_file.length / seconds if seconds else 0.0
+        self.logger.info(f'grid_in {filename}: {grid_file.length} bytes, '
+                         f'{seconds:.3f}s, {rate:.1f} bytes/s')
+        if dedup:
+            return self._dedup_file(grid_file._id, grid_file.sha256,
+                                    grid_file.length)
+        return grid_file._id
+
+    def _create_dedup_index(self) -> None:
+        """
+        | 重複排除用にfs.filesのsha256とlengthにインデックスを作成する
+        | 参照数を持つファイル(正本)が内容毎に1つになるよう一意とする
+
+        :return:
+        """
+        self.db[Config.fs_files].create_index(
+            [('sha256', 1), ('length', 1)], unique=True,
+            partialFilterExpression={self.refcount: {'$exists': True}})
+
+    def _dedup_file(self, oid: ObjectId, digest: str,
+                    length: int) -> ObjectId:
+        """
+        | SHA-256とサイズが同じで、参照数を持つ既存のファイル(正本)があれば
+        | その参照数を増やし、書き込んだばかりのファイルを削除する
+        | なければ書き込んだファイルに参照数1を付与して正本とする
+        |
+        | 内容はストリーミングしながらハッシュ化するため、
+        | 重複の判定は書き込み後に行う
+        | 書き込んだファイルは正本になるまで参照数を持たないため、
+        | 同じ内容を同時に書き込んでも互いを参照して両方削除することはない
+        | 正本は一意なインデックス(_create_dedup_index()を参照)で1つに限られ、
+        | 付与に失敗した場合は先に正本となったファイルを利用する
+        | 参照数を持たない(重複排除を使わずに登録した)ファイルは対象外
+
+        :param ObjectId oid: 書き込んだファイルのoid
+        :param str digest: SHA-256
+        :param int length:
+        :return: 利用するファイルのoid
+        :rtype: ObjectId
+        """
+        files = self.db[Config.fs_files]
+        while True:
+            existing = files.find_one_and_update(
+                {'sha256': digest, 'length': length,
+                 self.refcount: {'$gte': 1}},
+                {'$inc': {self.refcount: 1}}, projection={'_id': 1})
+            if existing is not None:
+                self.fs.delete(oid)
+                self.logger.info(
+                    f'grid_in dedup: {oid} -> {existing["_id"]}')
+                return existing['_id']
             try:
-                inserted.append(self.fs.put(fb, **metadata))
-            except GridFSError as e:
-                raise EdmanDbProcessError(e)
-        return inserted
+                files.update_one({'_id': oid}, {'$set': {self.refcount: 1}})
+                return oid
+            except errors.DuplicateKeyError:
+                # 他の書き込みが先に正本になったので、そちらを利用する
+                continue
 
     def file_list_attachment(self, doc: dict,
                              files_oid: List[ObjectId]) -> dict:
@@ -315,6 +678,7 @@ class File:
         辞書データにファイルのoidを挿入する
         docにself.file_refがあれば、追加する処理
         oidが重複していないものだけ追加
+        (files_oid内の重複も除く。重複排除で同じoidが複数返る場合があるため)
         ファイルが同じでも別のoidが与えられていれば追加される
 
         :param dict doc:
@@ -325,6 +689,8 @@ class File:
         if self.file_ref in doc:
             doc[self.file_ref].extend(files_oid)
             files_oid = sorted(list(set(doc[self.file_ref])))
+        else:
+            files_oid = list(dict.fromkeys(files_oid))
         # self.file_refがなければ作成してfiles_oidを値として更新
         if files_oid:
             doc.update({self.file_ref: files_oid})
@@ -385,9 +751,10 @@ class File:
     def zipped_contents(self, downloads: dict, json_tree_file_name: str,
                         encoded_json: bytes, p: Path) -> str:
         """
-        jsonと添付ファイルを含むzipファイルを生成
-        zipファイル内部にjson_tree_file_name.jsonのjsonファイルを含む
-        添付ファイルがなく、jsonファイルだけ取得したい場合はzipped_jsonを利用
+        | jsonと添付ファイルを含むzipファイルを生成
+        | zipファイル内部にjson_tree_file_name.jsonのjsonファイルを含む
+        | 添付ファイルがなく、jsonファイルだけ取得したい場合はzipped_jsonを利用
+        | 一時ファイルは作成せず、p/dl.zipに直接書き込む
 
         :param dict downloads:
         :param str json_tree_file_name:
@@ -396,59 +763,127 @@ class File:
         :rtype: str
         :return:
         """
-        work = p
-        p = work / 'archives'
-        p.mkdir()
-        for file_refs, dir_path in zip([i for i in downloads.values()],
-                                       [p / str(doc_oid) for doc_oid in
-                                        downloads]):
-            os.mkdir(dir_path)
-            for file_ref in file_refs:
-                # 添付ファイルをダウンロード
-                try:
-                    content = self.fs.get(file_ref)
-                except NoFile:
-                    raise EdmanDbProcessError(
-                        '指定の関連ファイルが存在しません')
-                except GridFSError:
-                    raise
-
-                # 添付ファイルを保存
-                filepath = dir_path / content.name
+        zip_filepath = p / 'dl.zip'
+        try:
+            with zip_filepath.open('wb') as f:
+                self.write_zipped_contents(downloads, json_tree_file_name,
+                                           encoded_json, f)
+        except (FileNotFoundError, IOError) as e:
+            raise EdmanInternalError(
+                'zipファイルを保存することが出来ませんでした: ' + str(e))
+        return str(zip_filepath)
 
-                content_data = content.read()
-                try:
-                    # gzip圧縮されている場合は解凍する
-                    if binascii.hexlify(content_data[:2]) == b'1f8b':
-                        content_data = gzip.decompress(content_data)
-                except binascii.Error:
-                    EdmanInternalError(
-                        'gzipファイルの解凍に失敗しました: ' + content.name)
-                try:
-                    with open(filepath, 'wb') as f:
-                        f.write(content_data)
-                except (FileNotFoundError, IOError):
-                    EdmanInternalError(
-                        'ファイルを保存することが出来ませんでした: ' + content.name)
+    def write_zipped_contents(self, downloads: dict,
+                              json_tree_file_name: str, encoded_json: bytes,
+                              stream: IO) -> None:
+        """
+        | jsonと添付ファイルを含むzipファイルを書き込み可能なストリームに出力する
+        | 添付ファイルはGridFSのチャンク単位でzipに書き込むため、
+        | ファイル全体をメモリに読み込まない
+        | streamはシーク不可能なもの(HTTPレスポンス等)でもよい
+        |
+        | zip内部の構成
+        | json_tree_file_name.json
+        | ドキュメントのoid/添付ファイル
+
+        :param dict downloads: {ドキュメントのoid: [添付ファイルのoid,...]}
+        :param str json_tree_file_name:
+        :param bytes encoded_json:
+        :param IO stream: 書き込み可能なバイナリストリーム
+        :return:
+        """
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for doc_oid, file_refs in downloads.items():
+                for file_ref in file_refs:
+                    # 添付ファイルを取得
+                    try:
+                        content = self.fs.get(file_ref)
+                    except NoFile:
+                        raise EdmanDbProcessError(
+                            '指定の関連ファイルが存在しません')
+                    except GridFSError:
+                        raise
+                    self._write_zip_member(
+                        zf, str(doc_oid) + '/' + content.name, content)
 
             # jsonファイルを保存
-            json_file = json_tree_file_name + '.json'
-            json_path = p / json_file
-            try:
-                with json_path.open('wb') as f:
-                    f.write(encoded_json)
-            except (FileNotFoundError, IOError):
-                EdmanInternalError(
-                    'JSONファイルを保存することが出来ませんでした')
-
-        # 最終的にDLするzipファイルを作成
-        base = work / 'dl'
+            zf.writestr(json_tree_file_name + '.json', encoded_json)
+
+    @classmethod
+    def _write_zip_member(cls, zf: zipfile.ZipFile, arcname: str,
+                          content: gridfs.GridOut) -> None:
+        """
+        | GridOutをチャンク毎(_iter_chunks()を参照)にzipファイルに書き込む
+        | gzip圧縮されている場合は逐次解凍しながら書き込む
+
+        :param zipfile.ZipFile zf:
+        :param str arcname: zip内のパス
+        :param gridfs.GridOut content:
+        :return:
+        """
+        zinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.file_size = content.length
+        # 解凍後のサイズは事前にわからないため、常にzip64で書き込む
+        with zf.open(zinfo, 'w', force_zip64=True) as dest:
+            for chunk in cls._iter_decompressed(cls._iter_chunks(content),
+                                                content.name):
+                dest.write(chunk)
+
+    @staticmethod
+    def _iter_decompressed(chunks: Iterable[bytes], name='',
+                           max_size=64 * 1024) -> Iterator[bytes]:
+        """
+        | チャンクを順に受け取り、gzip圧縮されていれば逐次解凍して返す
+        | gzip圧縮されていなければそのまま返す
+        | 連結された複数のgzipメンバーにも対応する
+        |
+        | 解凍したデータはmax_sizeずつ返すため、圧縮率が高くても
+        | メモリ使用量は入力のチャンクサイズとmax_sizeで抑えられる
+        | GridOutは改行区切りでイテレートされるため、
+        | _iter_chunks()でチャンク単位にしてから渡すこと
+
+        :param Iterable chunks: バイト列のイテラブル
+        :param str name: エラー表示用のファイル名
+        :param int max_size: 1回に返す解凍後のデータの上限(byte)
+            default 64KiB
+        :return:
+        :rtype: Iterator
+        """
+        chunks = iter(chunks)
+        head = b''
+        for chunk in chunks:  # 判定用に先頭の2byteを確保する
+            head += chunk
+            if len(head) >= 2:
+                break
+        if binascii.hexlify(head[:2]) != b'1f8b':
+            if head:
+                yield head
+            yield from chunks
+            return
+
+        # wbits=31でgzipヘッダ付きのデータとして解凍する
+        decompressor = zlib.decompressobj(wbits=31)
+        pending = False
         try:
-            zip_filepath = shutil.make_archive(str(base), format='zip',
-                                               root_dir=str(p))
-        except Exception:
-            raise
-        return zip_filepath
+            for chunk in itertools.chain((head,), chunks):
+                data = b''
+                # 上限まで出力した場合は、残りの入力がなくても続きを取り出す
+                while chunk or len(data) == max_size:
+                    pending = True
+                    if data := decompressor.decompress(chunk, max_size):
+                        yield data
+                    chunk = decompressor.unconsumed_tail
+                    if decompressor.eof:
+                        # 後続のgzipメンバーがあれば新たに解凍する
+                        chunk = decompressor.unused_data
+                        decompressor = zlib.decompressobj(wbits=31)
+                        pending = False
+                        data = b''
+        except zlib.error:
+            raise EdmanInternalError('gzipファイルの解凍に失敗しました: ' + name)
+        if pending:
+            raise EdmanInternalError('gzipファイルが途中で終了しています: ' + name)
 
     @staticmethod
     def zipped_json(encoded_json: bytes, json_tree_file_name: str,
@@ -538,50 +973,64 @@ class File:
         new_docs = recursive(docs)
         return new_docs, dl_list
 
-    def upload_zipped(self, zip_file: IO) -> dict | None:
+    def upload_zipped(self, zip_file: IO, max_workers=None,
+                      max_bytes_per_sec=None, dedup=False) -> dict | None:
         """
-        zipファイルを解凍し、ファイルをgridfsに格納、結果のoidを含めたjsonを返す
+        | zipファイル内のファイルをgridfsに格納、結果のoidを含めたjsonを返す
+        | zipファイルは解凍せず、各ファイルをzipから直接gridfsに書き込む
+        | max_workers, max_bytes_per_sec, dedupはgrid_in()を参照
 
         :param IO zip_file: アップロードされたzipファイル
+        :param max_workers: 並列数 default None
+        :type max_workers: int or None
+        :param max_bytes_per_sec: 転送速度の上限(byte/s) default None
+        :type max_bytes_per_sec: int or None
+        :param bool dedup: default False
         :return:
         :rtype: dict
         """
-        entry_json = None
-
-        with TemporaryDirectory() as td:
-            p = Path(td)
-            with zipfile.ZipFile(zip_file) as ex_zip:
-                ex_zip.extractall(td)
-
-            json_list = list(p.glob('*.json'))
+        if dedup:
+            self._create_dedup_index()
+        with zipfile.ZipFile(zip_file) as ex_zip:
+            names = {i.filename for i in ex_zip.infolist()
+                     if not i.is_dir()}
+            json_list = [i for i in names
+                         if '/' not in i and i.endswith('.json')]
             if not json_list:
                 raise EdmanInternalError('jsonファイルが存在しません')
             if len(json_list) > 1:
                 raise EdmanInternalError(
                     'jsonファイルは一つだけしか含めることはできません')
-            target_json = json_list[0]
             # jsonデータ取り出し
-            with target_json.open() as f:
+            with ex_zip.open(json_list[0]) as f:
                 json_data = json.load(f)
-            try:
-                # 添付ファイルを取り出す
-                files_list = self.generate_upload_list(json_data)
-                # 解凍したデータ内に、実際にデータが存在するか照合する(ダウンロードするパスを接合する)
-                path_list = self.generate_file_path_dict(files_list, p)
-                # gridfsにファイルを格納するために専用のタプルを作成
-                paths = tuple([v for v in path_list.values()])
-                # grid.fsに入れる
-                grid_in_results = self.grid_in(paths)
-                # grid_inはinserted_idしか返さないため、jsonのファイルパスをキーとしてinserted_oidをバリューとする辞書を作成する
-                gf_inserted_dict = {i: j for i, j in
-                                    zip(path_list, grid_in_results)}
-            except Exception:
-                raise
-            else:
-                # jsonデータにoidを書き加え、添付ファイル用キーを削除
-                entry_json = self.json_rewrite(json_data, gf_inserted_dict)
 
-        return entry_json
+            # 添付ファイルを取り出す
+            files_list = self.generate_upload_list(json_data)
+            # zip内に、実際にデータが存在するか照合する
+            member_dict = self.generate_archive_member_dict(files_list, names)
+
+            limiter = ByteRateLimiter(
+                max_bytes_per_sec) if max_bytes_per_sec is not None else None
+
+            def put(member: str) -> ObjectId:
+                try:
+                    with ex_zip.open(member) as f:
+                        return self._grid_in_stream(
+                            f, posixpath.basename(member), limiter=limiter,
+                            dedup=dedup)
+                except (IOError, OSError, zipfile.BadZipFile) as e:
+                    raise EdmanDbProcessError(e)
+
+            # grid.fsに入れる
+            grid_in_results = self._map_files(
+                put, list(member_dict.values()), max_workers)
+
+        # jsonのファイルパスをキーとしてinserted_oidをバリューとする辞書を作成する
+        gf_inserted_dict = {i: j for i, j in
+                            zip(member_dict, grid_in_results)}
+        # jsonデータにoidを書き加え、添付ファイル用キーを削除
+        return self.json_rewrite(json_data, gf_inserted_dict)
 
     def generate_upload_list(self, data: dict) -> list[str]:
         """
@@ -643,6 +1092,30 @@ class File:
                 result.update({key: value})
         return result
 
+    @staticmethod
+    def generate_archive_member_dict(files_list: list,
+                                     names: set) -> dict[str, str]:
+        """
+        | files_listの添付ファイルがzip内に存在するか確認し、
+        | zip内のファイル名を値とする辞書を作成
+        | zipの外を指すパス(絶対パスや..を含むもの)は受け付けない
+
+        :param list files_list:
+        :param set names: zip内のファイル名
+        :return: result
+        :rtype: dict
+        """
+        result = {}
+        for json_file_path in files_list:
+            member = posixpath.normpath(
+                str(json_file_path).replace('\\', '/'))
+            if posixpath.isabs(member) or member.split('/')[0] == '..' \
+                    or member not in names:
+                raise EdmanInternalError(
+                    'JSON内のパスとファイル配置に違いがありましたので中止します')
+            result.update({json_file_path: member})
+        return result
+
     @staticmethod
     def generate_file_path_dict(files_list: list, p: Path) -> dict[str, Path]:
         """
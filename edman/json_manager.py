@@ -1,8 +1,12 @@
+import codecs
+import json
 import os
+import re
 from datetime import datetime
 from enum import Enum, auto
 from logging import INFO, getLogger
 from pathlib import Path
+from typing import IO, Any, Iterator
 
 from bson.json_util import dumps
 
@@ -47,6 +51,162 @@ class JsonManager:
             file.flush()
             os.fsync(file.fileno())
 
+    @staticmethod
+    def iter_events(fp: IO, buffer_size=65536) -> Iterator[tuple[str, Any]]:
+        """
+        | JSONをファイルオブジェクトから少しずつ読み込み、イベントとして返すジェネレータ
+        | JSON全体をメモリに展開しないため、巨大なファイルでも利用できる
+        |
+        | イベントは(イベント名, 値)のタプル
+        | start_map, map_key, end_map, start_array, end_array, value
+        | 値はmap_keyとvalueの時のみ入る
+        | ファイルオブジェクトはテキスト、バイナリ(UTF-8)のどちらでも可
+        | JSONの文法(区切り文字の位置、ルートの値の後の文字など)に
+        | 合わない場合はEdmanFormatErrorを送出する
+
+        :param fp: 読み込み対象のファイルオブジェクト
+        :type fp: IO
+        :param int buffer_size: 1回に読み込むサイズ default 65536
+        :return: (event, value)
+        :rtype: Iterator
+        """
+        whitespace = re.compile(r'[ \t\n\r]*')
+        # 数値とリテラルに使われない文字で区切る
+        delimiter = re.compile(r'[^0-9a-zA-Z+\-.]')
+        number = re.compile(
+            r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?')
+        literals = {'true': True, 'false': False, 'null': None}
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        json_decoder = json.JSONDecoder()
+        buf = ''
+        pos = 0
+
+        def fill() -> bool:
+            """
+            バッファに続きを読み込む 読み込むものがなければFalse
+            """
+            nonlocal buf, pos
+            while True:
+                chunk = fp.read(buffer_size)
+                if not isinstance(chunk, bytes):
+                    break
+                # マルチバイト文字の途中で区切られた場合は空になるので続けて読む
+                try:
+                    text = decoder.decode(chunk, final=not chunk)
+                except UnicodeDecodeError:
+                    raise EdmanFormatError('JSONの文字コードが不正です')
+                if text or not chunk:
+                    chunk = text
+                    break
+            if not chunk:
+                return False
+            buf = buf[pos:] + chunk
+            pos = 0
+            return True
+
+        def error(token: str) -> EdmanFormatError:
+            return EdmanFormatError(f'JSONの構造が不正です {token}')
+
+        # 次に許されるトークン
+        # value, value_or_close, key, key_or_close, colon, comma_or_close,
+        # end(ルートの値の後)
+        stack: list[str] = []
+        state = 'value'
+
+        def after_value() -> str:
+            return 'comma_or_close' if stack else 'end'
+
+        while True:
+            pos = whitespace.match(buf, pos).end()  # type: ignore[union-attr]
+            if pos == len(buf):
+                if fill():
+                    continue
+                break
+            c = buf[pos]
+            if state == 'end':
+                raise EdmanFormatError(f'JSONの末尾に不正な値があります {c}')
+            if c in '{[':
+                if state not in ('value', 'value_or_close'):
+                    raise error(c)
+                pos += 1
+                if c == '{':
+                    stack.append('map')
+                    state = 'key_or_close'
+                    yield 'start_map', None
+                else:
+                    stack.append('array')
+                    state = 'value_or_close'
+                    yield 'start_array', None
+            elif c in '}]':
+                closing = 'map' if c == '}' else 'array'
+                allowed = ('comma_or_close', 'key_or_close'
+                           if closing == 'map' else 'value_or_close')
+                if not stack or stack[-1] != closing or state not in allowed:
+                    raise error(c)
+                pos += 1
+                stack.pop()
+                state = after_value()
+                yield 'end_' + closing, None
+            elif c == ',':
+                if state != 'comma_or_close':
+                    raise error(c)
+                pos += 1
+                state = 'key' if stack[-1] == 'map' else 'value'
+            elif c == ':':
+                if state != 'colon':
+                    raise error(c)
+                pos += 1
+                state = 'value'
+            elif c == '"':
+                if state not in ('key', 'key_or_close', 'value',
+                                 'value_or_close'):
+                    raise error(c)
+                while True:
+                    try:
+                        string, end = json_decoder.raw_decode(buf, pos)
+                        break
+                    except json.JSONDecodeError as e:
+                        # 文字列がバッファの境界をまたいでいる場合のみ続きを読む
+                        # 改行などの制御文字で止まるため、閉じられていない文字列で
+                        # ファイルの残りを全て読み込むことはない
+                        if not (e.msg.startswith('Unterminated string')
+                                or e.pos >= len(buf) - 6) or not fill():
+                            raise EdmanFormatError(
+                                f'JSONの文字列が不正です {e.msg}')
+                pos = end
+                if state.startswith('key'):
+                    state = 'colon'
+                    yield 'map_key', string
+                else:
+                    state = after_value()
+                    yield 'value', string
+            else:
+                if state not in ('value', 'value_or_close'):
+                    raise error(c)
+                m = delimiter.search(buf, pos)
+                while m is None:
+                    # 数値などがバッファの境界をまたいでいる
+                    if not fill():
+                        break
+                    m = delimiter.search(buf, pos)
+                end = m.start() if m else len(buf)
+                token = buf[pos:end]
+                if not token:
+                    raise error(c)
+                pos = end
+                if token in literals:
+                    value: Any = literals[token]
+                elif n := number.fullmatch(token):
+                    value = (float(token) if n.group(1) or n.group(2)
+                             else int(token))
+                else:
+                    raise EdmanFormatError(f'JSONの値が不正です {token}')
+                state = after_value()
+                yield 'value', value
+
+        if state != 'end':
+            raise EdmanFormatError('JSONが途中で終了しています')
+
 
 class GetJsonStructure(Enum):
     manual_select = auto()
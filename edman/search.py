@@ -1,5 +1,6 @@
 from datetime import datetime
 from logging import INFO, getLogger
+from typing import Generator
 
 from bson import DBRef, ObjectId
 from bson import errors as bson_errors
@@ -15,17 +16,32 @@ from edman.utils import Utils
 
 class Search:
     """
-    検索関連クラス
-
+    | 検索関連クラス
+    |
+    | tree_cacheにDocumentCacheなどを指定した場合は
+    | get_tree()の結果をキャッシュする
+    | ツリーは(_tree_namespace, コレクション)をコレクションとして格納するため、
+    | DB(cache=...)と同じキャッシュを指定してもドキュメントと衝突しない
+    | tree_cacheはDB.add_cache()で登録するため、このDBからの書き込みや削除で
+    | ツリー内のいずれかのドキュメントが破棄されるとツリーも破棄される
+    | 他のプロセスの書き込みはChangeStreamInvalidatorで反映する
     """
 
-    def __init__(self, db=None) -> None:
+    # tree_cacheに格納するツリーのキーの接頭辞
+    _tree_namespace = '__tree__'
+
+    def __init__(self, db=None, tree_cache=None) -> None:
         config = Config()  # システム環境用の設定を読み込む
         self.parent = config.parent
         self.child = config.child
+        self.ancestors = config.ancestors
+        self.root = config.root
+        self.depth = config.depth
+        self.revision = config.revision
         self.date = config.date
         self.file = config.file
         self.db = db
+        self.tree_cache = tree_cache
 
         # ログ設定(トップに伝搬し、利用側でログとして取得してもらう)
         self.logger = getLogger(__name__)
@@ -34,9 +50,11 @@ class Search:
 
         if self.db is not None:
             self.connected_db = db.get_db
+            if self.tree_cache is not None:
+                self.db.add_cache(self.tree_cache)
 
     def find(self, collection: str, query: dict, parent_depth=0,
-             child_depth=0, exclusion=None) -> dict:
+             child_depth=0, exclusion=None, engine='recursive') -> dict:
         """
         検索用メソッド
 
@@ -45,6 +63,8 @@ class Search:
         :param int parent_depth: 親の指定深度
         :param int child_depth: 子の指定深度
         :param None or list exclusion:除外するリファレンスキー 例 ['_ed_file']
+        :param str engine: 子の取得方法 recursive, level, aggregate
+            or ancestors default 'recursive'
         :return: result 親 + 自分 + 子の階層構造となった辞書データ
         :rtype: dict
         """
@@ -67,7 +87,8 @@ class Search:
 
         children_result = None
         if reference_point_result[self.child]:
-            children_result = self.db.get_child(self_result, child_depth)
+            children_result = self.db.get_child(self_result, child_depth,
+                                                engine=engine)
 
         # 親も子も存在しない時はselfのみ
         result = self_result
@@ -155,6 +176,7 @@ class Search:
         """
         | 親となるドキュメントを取得
         | depthで深度を設定し、階層分取得する
+        | 祖先のリファレンス情報が付与されている場合はまとめて取得する
 
         :param dict self_doc:
         :param int depth:
@@ -168,7 +190,7 @@ class Search:
             DBReferenceを利用し、設定されている深度を減らしながら再帰
             """
             if self.parent in doc:
-                parent = self.connected_db.dereference(doc[self.parent])
+                parent = self.db._dereference(doc[self.parent])
                 parent_collection = doc[self.parent].collection
                 data.append({parent_collection: parent})
                 nonlocal depth
@@ -178,7 +200,16 @@ class Search:
 
         if depth > 0:
             data: list = []  # recによって書き換えられる
-            recursive(list(self_doc.values())[0])
+            doc = list(self_doc.values())[0]
+            if self.ancestors in doc:
+                # 親に近い方から順番に並べる
+                refs = list(reversed(doc[self.ancestors]))[:depth]
+                fetched = self.db._dereference_many(refs)
+                data = [{ref.collection: fetched[(ref.collection, ref.id)]}
+                        for ref in refs
+                        if (ref.collection, ref.id) in fetched]
+            else:
+                recursive(doc)
             result = self._build_to_doc_parent(data)
         else:
             result = None
@@ -268,17 +299,27 @@ class Search:
 
         return result
 
-    def get_tree(self, collection: str, oid: ObjectId, include=None) -> dict:
+    def get_tree(self, collection: str, oid: ObjectId, include=None,
+                 engine='recursive') -> dict:
         """
-        oidで指定するドキュメントが所属するツリーを全て取得する
+        | oidで指定するドキュメントが所属するツリーを全て取得する
+        | tree_cacheが設定されている場合はキャッシュから取得する
 
         :param str collection:
         :param ObjectId oid:
         :param None or list include: e.g. ['_id', 'parent', 'child', 'file']
+        :param str engine: 子の取得方法 recursive, level, aggregate
+            or ancestors default 'recursive'
         :return: result
         :rtype: dict
         """
 
+        oid = Utils.conv_objectid(oid)
+        tree_key = (self._tree_namespace, collection)
+        if self.tree_cache is not None and (
+                tree := self.tree_cache.get(tree_key, oid)) is not None:
+            return self.generate_json_dict(tree, include=include)
+
         self_doc = self.doc2(collection, oid)
         root_ref = self.db.get_root_dbref(self_doc)
 
@@ -289,7 +330,8 @@ class Search:
         else:
             root_doc = self.doc2(root_ref.collection, root_ref.id)
 
-        children = self.db.get_child_all({root_ref.collection: root_doc})
+        children = self.db.get_child_all({root_ref.collection: root_doc},
+                                         engine=engine)
 
         parents = []
         for d in list(children.values()):
@@ -299,6 +341,9 @@ class Search:
         if all([i for i in parents if i == root_ref]):
             result_docs = dict(**root_doc, **children)
             tree = {root_ref.collection: result_docs}
+            if self.tree_cache is not None:
+                self.tree_cache.put(tree_key, oid, tree,
+                                    members=list(self._tree_members(tree)))
             result = self.generate_json_dict(tree, include=include)
 
         else:
@@ -308,6 +353,23 @@ class Search:
 
         return result
 
+    @classmethod
+    def _tree_members(cls, data: dict) -> Generator:
+        """
+        | ツリーに含まれるドキュメントの(コレクション, ObjectId)を取り出すジェネレータ
+        | {コレクション: ドキュメント}または{コレクション: [ドキュメント]}を辿る
+
+        :param dict data:
+        :return:
+        :rtype: Generator
+        """
+        for key, value in data.items():
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict):
+                    if isinstance(item.get('_id'), ObjectId):
+                        yield key, item['_id']
+                    yield from cls._tree_members(item)
+
     def generate_json_dict(self, result_dict: dict, include=None) -> dict:
         """
         edman依存の項目を処理する::
@@ -323,7 +385,9 @@ class Search:
         :return: result_dict
         :rtype: dict
         """
-        default_refs = ['_id', self.parent, self.child, self.file]
+        default_refs = ['_id', self.parent, self.child, self.file,
+                        self.ancestors, self.root, self.depth,
+                        self.revision]
         if include is None:
             refs = tuple(default_refs)
         else:
@@ -1,3 +1,4 @@
+import copy
 import re
 from collections import defaultdict
 from datetime import datetime
@@ -7,6 +8,9 @@ from typing import Any, Callable, Generator
 import dateutil.parser
 from bson import ObjectId, errors
 
+from edman import Config
+from edman.exceptions import EdmanDbProcessError
+
 
 class Utils:
     """
@@ -334,3 +338,67 @@ class Utils:
                     s += '.'
                 s += i
         return s
+
+    @staticmethod
+    def read_modify_write(collection: Any, oid: ObjectId, amend: Callable,
+                          write: Callable, revision=False, max_retries=3,
+                          doc=None, session=None,
+                          not_found=EdmanDbProcessError,
+                          logger=None) -> int:
+        """
+        | ドキュメントを読み込み、amendで変更してwriteで書き込む
+        |
+        | revisionがTrueの場合、またはドキュメントがリビジョンを持つ場合は
+        | 読み込んだ時のリビジョンを条件に書き込み、リビジョンを1つ増やす
+        | (リビジョンを条件に書き込む他の処理と競合しないように、
+        | リビジョンを持つドキュメントは常にリビジョンを増やす)
+        | 他の書き込みによってリビジョンが変わっていた場合は
+        | max_retries回まで読み込みからやり直し、それでも競合した場合は例外を送出する
+        |
+        | writeは(元のドキュメント, 変更後のドキュメント, 書き込みの条件)を受け取り、
+        | modified_countを返す関数
+        | 書き込みの条件がNoneの場合は_idのみを条件とする
+
+        :param Collection collection: pymongoのコレクション
+        :param ObjectId oid:
+        :param amend: ドキュメントのコピーを受け取り変更後のドキュメントを返す関数
+        :type amend: Callable
+        :param write:
+        :type write: Callable
+        :param bool revision: default False
+        :param int max_retries: default 3
+        :param doc: 読み込み済みのドキュメント default None
+        :type doc: dict or None
+        :param session: default None
+        :type session: ClientSession or None
+        :param not_found: ドキュメントが存在しない時の例外
+            default EdmanDbProcessError
+        :type not_found: type
+        :param logger: 競合を出力するロガー default None
+        :type logger: Logger or None
+        :return: modified_count
+        :rtype: int
+        """
+        for attempt in range(max_retries + 1):
+            if doc is None or attempt:
+                doc = collection.find_one({'_id': oid}, session=session)
+                if doc is None:
+                    raise not_found('該当するドキュメントは存在しません')
+            amended = amend(copy.deepcopy(doc))
+            current = doc.get(Config.revision)
+            if not revision and current is None:
+                return write(doc, amended, None)
+
+            amended[Config.revision] = (current or 0) + 1
+            query = {'_id': oid, Config.revision: current} \
+                if current is not None \
+                else {'_id': oid, Config.revision: {'$exists': False}}
+            # リビジョンは必ず変わるため、書き込めなかった場合は競合
+            if modified_count := write(doc, amended, query):
+                return modified_count
+            if logger is not None:
+                logger.info(f'revision conflict {collection.name}:{oid} '
+                            f'retry {attempt + 1}')
+
+        raise EdmanDbProcessError(
+            f'他の書き込みと競合したため更新できませんでした {collection.name}:{oid}')
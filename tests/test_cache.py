@@ -0,0 +1,193 @@
+import time
+from logging import ERROR, StreamHandler, getLogger
+from unittest import TestCase
+
+from bson import DBRef, ObjectId
+
+from edman import DB, ChangeStreamInvalidator, Config, DocumentCache
+
+
+class TestDocumentCache(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.logger = getLogger()
+
+        # ログを画面に出力
+        ch = StreamHandler()
+        ch.setLevel(ERROR)  # ハンドラーにもそれぞれログレベル、フォーマットの設定が可能
+        cls.logger.addHandler(ch)  # StreamHandlerの追加
+
+    def test___init__(self):
+        with self.assertRaises(ValueError):
+            DocumentCache(maxsize=0)
+        with self.assertRaises(ValueError):
+            DocumentCache(ttl=0)
+
+    def test_get(self):
+        cache = DocumentCache()
+        oid = ObjectId()
+        self.assertIsNone(cache.get('c', oid))
+
+        cache.put('c', oid, {'_id': oid, 'list': [1]})
+        actual = cache.get('c', oid)
+        self.assertDictEqual({'_id': oid, 'list': [1]}, actual)
+
+        # 取得したドキュメントを変更してもキャッシュは変わらない
+        actual['list'].append(2)
+        self.assertDictEqual({'_id': oid, 'list': [1]}, cache.get('c', oid))
+
+        # コレクションが異なれば別のキー
+        self.assertIsNone(cache.get('other', oid))
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(2, cache.misses)
+
+    def test_put(self):
+        cache = DocumentCache(maxsize=2)
+        oids = [ObjectId() for _ in range(3)]
+        doc = {'name': 'a'}
+        cache.put('c', oids[0], doc)
+        doc['name'] = 'b'
+        self.assertDictEqual({'name': 'a'}, cache.get('c', oids[0]))
+
+        # 最も長く参照されていないドキュメントから破棄される
+        cache.put('c', oids[1], {'name': 'b'})
+        cache.get('c', oids[0])
+        cache.put('c', oids[2], {'name': 'c'})
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('c', oids[1]))
+        self.assertIsNotNone(cache.get('c', oids[0]))
+        self.assertIsNotNone(cache.get('c', oids[2]))
+
+        # ttlを過ぎたドキュメントは破棄される
+        cache = DocumentCache(ttl=0.05)
+        cache.put('c', oids[0], {'name': 'a'})
+        self.assertIsNotNone(cache.get('c', oids[0]))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('c', oids[0]))
+        self.assertEqual(0, len(cache))
+
+    def test_invalidate(self):
+        cache = DocumentCache()
+        oids = [ObjectId() for _ in range(3)]
+        for oid in oids:
+            cache.put('a', oid, {'_id': oid})
+        cache.put('b', oids[0], {'_id': oids[0]})
+
+        cache.invalidate('a', [oids[0], ObjectId()])
+        self.assertIsNone(cache.get('a', oids[0]))
+        self.assertIsNotNone(cache.get('a', oids[1]))
+        self.assertIsNotNone(cache.get('b', oids[0]))
+
+        # oidsがNoneの場合はコレクション単位
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a', oids[1]))
+        self.assertIsNone(cache.get('a', oids[2]))
+        self.assertIsNotNone(cache.get('b', oids[0]))
+
+        # membersを含む項目もまとめて破棄される
+        cache.put('tree', oids[0], {},
+                  members=[('b', oids[1]), ('c', oids[2])])
+        cache.put('tree', oids[1], {}, members=[('c', oids[2])])
+        cache.invalidate('b', [oids[1]])
+        self.assertIsNone(cache.get('tree', oids[0]))
+        self.assertIsNotNone(cache.get('tree', oids[1]))
+        cache.invalidate('c')
+        self.assertIsNone(cache.get('tree', oids[1]))
+        self.assertDictEqual({}, cache._index)
+
+    def test_clear(self):
+        cache = DocumentCache()
+        cache.put('c', ObjectId(), {})
+        cache.get('c', ObjectId())
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(1, cache.misses)
+
+    def test_stats(self):
+        cache = DocumentCache(maxsize=10)
+        oid = ObjectId()
+        cache.put('c', oid, {})
+        cache.get('c', oid)
+        cache.get('c', ObjectId())
+        self.assertDictEqual(
+            {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 10},
+            cache.stats())
+
+
+class TestChangeStreamInvalidator(TestCase):
+
+    def setUp(self):
+        self.cache = DocumentCache()
+        self.invalidator = ChangeStreamInvalidator(DB(cache=self.cache))
+
+    def test___init__(self):
+        self.assertListEqual([self.cache], self.invalidator.caches)
+        self.assertListEqual([], ChangeStreamInvalidator(DB()).caches)
+
+        # DB.add_cache()で登録したキャッシュも対象とする
+        db = DB(cache=self.cache)
+        tree_cache = DocumentCache()
+        db.add_cache(tree_cache)
+        db.add_cache(tree_cache)
+        self.assertListEqual([self.cache, tree_cache],
+                             ChangeStreamInvalidator(db).caches)
+
+    def test_handle(self):
+        oids = [ObjectId() for _ in range(4)]
+        for oid in oids:
+            self.cache.put('a', oid, {'_id': oid})
+        self.cache.put('b', oids[0], {'_id': oids[0]})
+        self.cache.put('tree', oids[0], {}, members=[('a', oids[3])])
+
+        # 変更されたドキュメントを破棄する
+        self.invalidator.handle({'operationType': 'update',
+                                 'ns': {'db': 'db', 'coll': 'a'},
+                                 'documentKey': {'_id': oids[0]},
+                                 'updateDescription': {
+                                     'updatedFields': {'v': 1},
+                                     'removedFields': []}})
+        self.assertIsNone(self.cache.get('a', oids[0]))
+        self.assertIsNotNone(self.cache.get('a', oids[1]))
+
+        # リファレンスが変更された場合は参照先も破棄する
+        self.invalidator.handle({'operationType': 'update',
+                                 'ns': {'db': 'db', 'coll': 'b'},
+                                 'documentKey': {'_id': oids[0]},
+                                 'updateDescription': {
+                                     'updatedFields': {
+                                         Config.child: [
+                                             DBRef('a', oids[1])],
+                                         Config.parent + '.$id': 1},
+                                     'removedFields': []}})
+        self.assertIsNone(self.cache.get('b', oids[0]))
+        self.assertIsNone(self.cache.get('a', oids[1]))
+        self.assertIsNotNone(self.cache.get('a', oids[2]))
+
+        # ツリーに含まれるドキュメントが変更された場合はツリーも破棄する
+        self.invalidator.handle({'operationType': 'insert',
+                                 'ns': {'db': 'db', 'coll': 'c'},
+                                 'documentKey': {'_id': ObjectId()},
+                                 'fullDocument': {
+                                     Config.parent: DBRef('a', oids[3])}})
+        self.assertIsNone(self.cache.get('tree', oids[0]))
+        self.assertIsNotNone(self.cache.get('a', oids[2]))
+
+        self.invalidator.handle({'operationType': 'drop',
+                                 'ns': {'db': 'db', 'coll': 'a'}})
+        self.assertIsNone(self.cache.get('a', oids[2]))
+
+        self.cache.put('b', oids[0], {'_id': oids[0]})
+        self.invalidator.handle({'operationType': 'dropDatabase',
+                                 'ns': {'db': 'db'}})
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(5, self.invalidator.events)
+
+    def test__dbrefs(self):
+        refs = [DBRef('a', ObjectId()), DBRef('b', ObjectId())]
+        self.assertListEqual(
+            refs[:1], list(ChangeStreamInvalidator._dbrefs(refs[0])))
+        self.assertListEqual(
+            refs, list(ChangeStreamInvalidator._dbrefs(refs + [1])))
+        self.assertListEqual(
+            [], list(ChangeStreamInvalidator._dbrefs(ObjectId())))
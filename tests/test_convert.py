@@ -1,3 +1,5 @@
+import io
+import json
 from datetime import datetime
 # from logging import getLogger,  FileHandler, ERROR
 from logging import ERROR, StreamHandler, getLogger
@@ -6,6 +8,7 @@ from unittest import TestCase
 from bson import DBRef, ObjectId
 
 from edman import Config, Convert
+from edman.exceptions import EdmanFormatError
 
 
 class TestConvert(TestCase):
@@ -56,6 +59,63 @@ class TestConvert(TestCase):
         actual = self.convert._get_child_reference(test_data)
         self.assertEqual(2, len(list(actual.values())[0]))
 
+    def test__get_ancestors_reference(self):
+
+        root_ref = DBRef('root_col', ObjectId())
+        parent_ref = DBRef('parent_col', ObjectId())
+        self_ref = DBRef('self_col', ObjectId())
+
+        # ルートの場合
+        actual = self.convert._get_ancestors_reference([root_ref])
+        expected = {Config.ancestors: [], Config.depth: 0}
+        self.assertDictEqual(expected, actual)
+
+        # 子孫の場合はルートから親までのリファレンスが入る
+        actual = self.convert._get_ancestors_reference(
+            [root_ref, parent_ref, self_ref])
+        expected = {
+            Config.ancestors: [root_ref, parent_ref],
+            Config.depth: 2,
+            Config.root: root_ref
+        }
+        self.assertDictEqual(expected, actual)
+
+        # ancestorsを指定して変換した場合は全てのドキュメントに付与される
+        data = {
+            'root_col': {
+                'data': 'root',
+                'child_col': [
+                    {'data': 'child1', 'grandchild_col': {'data': 'gc'}},
+                    {'data': 'child2'}
+                ]
+            }
+        }
+        converted = self.convert.dict_to_edman(data, ancestors=True)
+        docs = {collection: doc_list for collection, doc_list in
+                converted[0].items()}
+        root_oid = docs['root_col'][0]['_id']
+        self.assertEqual(0, docs['root_col'][0][Config.depth])
+        self.assertNotIn(Config.root, docs['root_col'][0])
+        for doc in docs['child_col']:
+            with self.subTest(doc=doc):
+                self.assertEqual(1, doc[Config.depth])
+                self.assertEqual(root_oid, doc[Config.root].id)
+                self.assertListEqual([doc[self.parent]],
+                                     doc[Config.ancestors])
+        grandchild = docs['grandchild_col'][0]
+        self.assertEqual(2, grandchild[Config.depth])
+        self.assertEqual(root_oid, grandchild[Config.ancestors][0].id)
+        self.assertEqual(grandchild[self.parent],
+                         grandchild[Config.ancestors][-1])
+
+        # 指定しない場合は付与されない
+        converted = self.convert.dict_to_edman(data)
+        for doc_list in converted[0].values():
+            for doc in doc_list:
+                with self.subTest(doc=doc):
+                    self.assertNotIn(Config.ancestors, doc)
+                    self.assertNotIn(Config.depth, doc)
+
     def test__convert_datetime(self):
         # データ構造のテスト
         test_data = {'start_date': {'#date': '1981-04-23'}}
@@ -140,6 +200,66 @@ class TestConvert(TestCase):
         actual = self.convert._date_replace(list_data)
         self.assertListEqual(expected, actual)
 
+    def test_stream_to_edman(self):
+
+        data = {
+            'root_col': {
+                'data': 'root',
+                'start': {'#date': '2020-01-02'},
+                'values': [1, 2, 3],
+                'child_col': [
+                    {'data': 'child1', 'grandchild_col': {'data': 'gc'}},
+                    {'data': 'child2'}
+                ],
+                'other_col': {'data': 'other'}
+            }
+        }
+        fp = io.StringIO(json.dumps(data))
+        batches = list(self.convert.stream_to_edman(fp, batch_size=2,
+                                                    ancestors=True))
+
+        # batch_size毎に分割される
+        self.assertListEqual(
+            [2, 2, 1],
+            [sum(len(docs) for docs in i[0].values()) for i in batches])
+
+        docs = {}
+        for batch in batches:
+            for collection, doc_list in batch[0].items():
+                for doc in doc_list:
+                    docs[doc['data']] = (collection, doc)
+
+        # dict_to_edman()と同じ変換になる
+        expected = self.convert.dict_to_edman(data, ancestors=True)[0]
+        for collection, doc_list in expected.items():
+            for doc in doc_list:
+                with self.subTest(data=doc['data']):
+                    actual_collection, actual = docs[doc['data']]
+                    self.assertEqual(collection, actual_collection)
+                    self.assertListEqual(sorted(doc.keys()),
+                                         sorted(actual.keys()))
+
+        root = docs['root'][1]
+        self.assertEqual(datetime(2020, 1, 2), root['start'])
+        self.assertListEqual([1, 2, 3], root['values'])
+        self.assertListEqual(
+            [DBRef('child_col', docs['child1'][1]['_id']),
+             DBRef('child_col', docs['child2'][1]['_id']),
+             DBRef('other_col', docs['other'][1]['_id'])],
+            root[self.child])
+        gc = docs['gc'][1]
+        self.assertEqual(DBRef('child_col', docs['child1'][1]['_id']),
+                         gc[self.parent])
+        self.assertEqual(DBRef('root_col', root['_id']), gc[Config.root])
+        self.assertEqual(2, gc[Config.depth])
+
+        # 異常系
+        for i in ['[1, 2]', '{"root": 1}', '{"root": {"l": [1, {"a": 1}]}}',
+                  '{"root": {"l": [[1]]}}', '{"root": {"a": 1}']:
+            with self.subTest(i=i):
+                with self.assertRaises(EdmanFormatError):
+                    list(self.convert.stream_to_edman(io.StringIO(i)))
+
     def test_pullout_key(self):
 
         data = {
@@ -1,6 +1,7 @@
 import configparser
 import copy
 import tempfile
+import time
 from datetime import datetime
 # from logging import getLogger,  FileHandler, ERROR
 from logging import ERROR, StreamHandler, getLogger
@@ -9,11 +10,13 @@ from unittest import TestCase
 
 import dateutil.parser
 import gridfs
-from bson import DBRef, ObjectId
+from bson import DBRef, ObjectId, encode
 from pymongo import MongoClient, errors
 
-from edman import DB, Config, Convert, File, Search
-from edman.exceptions import EdmanDbProcessError
+from edman import (DB, ChangeStreamInvalidator, Config, Convert,
+                   DocumentCache, File, Search)
+from edman.exceptions import (EdmanDbProcessError, EdmanFormatError,
+                              EdmanInternalError)
 
 
 class TestDB(TestCase):
@@ -191,6 +194,129 @@ class TestDB(TestCase):
         #     }
         # ]
 
+    def test_insert_batches(self):
+        if not self.db_server_connect:
+            return
+
+        # 分割してインサートしても結果は1コレクションにまとまる
+        data = [{'insert_batches': [{'value': i} for i in range(5)]}]
+        actual = self.db.insert(data, batch_size=2)
+        self.assertEqual(1, len(actual))
+        self.assertEqual(5, len(actual[0]['insert_batches']))
+        self.assertEqual(
+            5, self.testdb['insert_batches'].count_documents({}))
+
+        # ordered=Falseの場合は重複したoid以外はインサートされる
+        dup_oid = actual[0]['insert_batches'][0]
+        data = [{'insert_batches': [{'value': 5}, {'_id': dup_oid},
+                                    {'value': 6}]}]
+        with self.assertRaises(EdmanDbProcessError) as cm:
+            self.db.insert(data, batch_size=2, ordered=False)
+        self.assertEqual(
+            7, self.testdb['insert_batches'].count_documents({}))
+        for doc in (data[0]['insert_batches'][0],
+                    data[0]['insert_batches'][2]):
+            with self.subTest(doc=doc):
+                self.assertIn(str(doc['_id']), str(cm.exception))
+
+        # 異常系
+        with self.assertRaises(EdmanFormatError):
+            self.db.insert(data, batch_size=0)
+
+    def test_insert_parallel(self):
+        if not self.db_server_connect:
+            return
+
+        data = [{f'insert_parallel{i}': [{'value': i, 'no': j}
+                                         for j in range(3)]}
+                for i in range(6)]
+        actual = self.db.insert(data, batch_size=2, max_workers=3)
+
+        # 元の順番で返ってくる
+        self.assertListEqual([list(i.keys())[0] for i in data],
+                             [list(i.keys())[0] for i in actual])
+        for i in actual:
+            for collection, oids in i.items():
+                with self.subTest(collection=collection):
+                    docs = list(self.testdb[collection].find(
+                        {'_id': {'$in': oids}}))
+                    self.assertEqual(3, len(docs))
+
+        # 異常系
+        with self.assertRaises(EdmanFormatError):
+            self.db.insert(data, max_workers=0)
+
+    def test_insert_transaction(self):
+        if not self.db_server_connect:
+            return
+
+        data = [{'insert_transaction1': [{'value': 1}]}]
+
+        # 異常系
+        with self.assertRaises(EdmanFormatError):
+            self.db.insert(data, transaction=True, max_workers=2)
+
+        # トランザクションはレプリカセットかシャードクラスタのみ
+        hello = self.client.admin.command('hello')
+        if 'setName' not in hello and hello.get('msg') != 'isdbgrid':
+            return
+
+        # 正常系
+        actual = self.db.insert(data, transaction=True)
+        oid = actual[0]['insert_transaction1'][0]
+        self.assertIsNotNone(
+            self.testdb['insert_transaction1'].find_one({'_id': oid}))
+
+        # 途中で失敗した場合は全てロールバックされる
+        data = [{'insert_transaction2': [{'value': 2}]},
+                {'insert_transaction1': [{'_id': oid}]}]
+        with self.assertRaises(EdmanDbProcessError):
+            self.db.insert(data, transaction=True)
+        self.assertEqual(
+            0, self.testdb['insert_transaction2'].count_documents({}))
+
+        # orderedがFalseでも失敗した時点で中断し、ロールバックしたoidは含めない
+        with self.assertRaises(EdmanDbProcessError) as cm:
+            self.db.insert(data, transaction=True, ordered=False)
+        self.assertNotIn('インサート結果', str(cm.exception))
+        self.assertEqual(
+            0, self.testdb['insert_transaction2'].count_documents({}))
+
+        # delete, update
+        collection = 'delete_transaction'
+        converted_edman = Convert().dict_to_edman(
+            {collection: {'name': 'root', 'child_col': [{'name': 'c1'}]}})
+        inserted = self.db.insert(converted_edman)
+        root_oid = inserted[-1][collection][0]
+        self.assertTrue(self.db.update(collection, root_oid,
+                                       {'name': 'new'}, 'ref',
+                                       transaction=True))
+        self.assertTrue(self.db.delete(root_oid, collection, 'ref',
+                                       transaction=True))
+        self.assertEqual(0, self.testdb['child_col'].count_documents({}))
+
+    def test__split_insert_batches(self):
+
+        docs = [{'value': 'a' * 10} for _ in range(5)]
+
+        # 指定がない場合はそのまま
+        actual = list(DB._split_insert_batches(docs))
+        self.assertListEqual([docs], actual)
+
+        # ドキュメント数で分割
+        actual = list(DB._split_insert_batches(docs, batch_size=2))
+        self.assertListEqual([2, 2, 1], [len(i) for i in actual])
+
+        # バイト数で分割
+        doc_size = len(encode(docs[0]))
+        actual = list(DB._split_insert_batches(
+            docs, batch_bytes=doc_size * 2 + 1))
+        self.assertListEqual([2, 2, 1], [len(i) for i in actual])
+
+        # 1ドキュメントで上限を超える場合は単独
+        actual = list(DB._split_insert_batches(docs, batch_bytes=1))
+        self.assertListEqual([1] * 5, [len(i) for i in actual])
+
     def test_doc(self):
         if not self.db_server_connect:
             return
@@ -435,6 +561,145 @@ class TestDB(TestCase):
         self.assertIsInstance(db_result['date_list'][1], datetime)
         self.assertIsInstance(db_result['date_data'], datetime)
 
+    def test__read_modify_write(self):
+        if not self.db_server_connect:
+            return
+
+        collection = 'test_read_modify_write'
+        oid = self.testdb[collection].insert_one({'value': 0}).inserted_id
+
+        def increment(doc):
+            doc['value'] += 1
+            return doc
+
+        # リビジョンが付与され、書き込み毎に増える
+        for _ in range(2):
+            self.assertEqual(1, self.db._read_modify_write(
+                collection, oid, increment, revision=True))
+        doc = self.testdb[collection].find_one({'_id': oid})
+        self.assertEqual(2, doc['value'])
+        self.assertEqual(2, doc[Config.revision])
+
+        # 競合した場合は読み込みからやり直す
+        calls = []
+
+        def conflict_once(doc):
+            calls.append(doc[Config.revision])
+            if len(calls) == 1:  # 他の書き込み
+                self.testdb[collection].update_one(
+                    {'_id': oid}, {'$inc': {Config.revision: 1}})
+            return increment(doc)
+
+        self.assertEqual(1, self.db._read_modify_write(
+            collection, oid, conflict_once, revision=True))
+        self.assertListEqual([2, 3], calls)
+        doc = self.testdb[collection].find_one({'_id': oid})
+        self.assertEqual(3, doc['value'])
+        self.assertEqual(4, doc[Config.revision])
+
+        # リトライの上限を超えた場合
+        def conflict(doc):
+            self.testdb[collection].update_one(
+                {'_id': oid}, {'$inc': {Config.revision: 1}})
+            return increment(doc)
+
+        with self.assertRaises(EdmanDbProcessError):
+            self.db._read_modify_write(collection, oid, conflict,
+                                       revision=True, max_retries=2)
+
+        # revisionを指定しなくてもリビジョンを持つドキュメントはリビジョンを増やす
+        doc = self.testdb[collection].find_one({'_id': oid})
+        self.db._read_modify_write(collection, oid, increment)
+        actual = self.testdb[collection].find_one({'_id': oid})
+        self.assertEqual(doc[Config.revision] + 1, actual[Config.revision])
+
+        # リビジョンを持たないドキュメントにはリビジョンを付与しない
+        oid = self.testdb[collection].insert_one({'value': 0}).inserted_id
+        self.db._read_modify_write(collection, oid, increment)
+        self.assertNotIn(Config.revision,
+                         self.testdb[collection].find_one({'_id': oid}))
+
+        # 親のリファレンスを取り除く場合もリビジョンを増やす
+        parent = self.testdb[collection].insert_one(
+            {self.child: [DBRef(collection, oid)],
+             Config.revision: 1}).inserted_id
+        self.db._delete_reference_from_parent(DBRef(collection, parent), oid)
+        actual = self.testdb[collection].find_one({'_id': parent})
+        self.assertNotIn(self.child, actual)
+        self.assertEqual(2, actual[Config.revision])
+
+    def test__diff_operations(self):
+
+        orig = {
+            '_id': ObjectId(),
+            'name': 'NSX',
+            'power': 280,
+            'flag': 1,
+            'spec': {'engine': 'V6', 'weight': 1350},
+            'tags': ['a', 'b'],
+            'parts': [{'name': 'tire', 'size': 17}, {'name': 'seat'}],
+            'old': 'x'
+        }
+        amended = copy.deepcopy(orig)
+        amended['power'] = 300
+        amended['flag'] = True
+        amended['spec']['weight'] = 1230
+        amended['tags'].extend(['c', 'd'])
+        amended['parts'][0]['size'] = 18
+        amended['year'] = 1990
+        del amended['old']
+        expected = {
+            '$set': {'power': 300, 'flag': True, 'spec.weight': 1230,
+                     'parts.0.size': 18, 'year': 1990},
+            '$unset': {'old': ''},
+            '$push': {'tags': {'$each': ['c', 'd']}}
+        }
+        actual = self.db._diff_operations(orig, amended)
+        self.assertDictEqual(expected, actual)
+
+        # 差分なし
+        self.assertDictEqual({}, self.db._diff_operations(orig, orig))
+
+        # 要素が減ったリストは全体を置き換える
+        amended = copy.deepcopy(orig)
+        amended['tags'] = ['a']
+        actual = self.db._diff_operations(orig, amended)
+        self.assertDictEqual({'$set': {'tags': ['a']}}, actual)
+
+        # ドット記法で表せないキーがある場合
+        amended = copy.deepcopy(orig)
+        amended['spec']['a.b'] = 1
+        self.assertIsNone(self.db._diff_operations(orig, amended))
+
+    def test__write_diff(self):
+        if not self.db_server_connect:
+            return
+
+        collection = 'test_write_diff'
+        doc = {'name': 'NSX', 'spec': {'engine': 'V6', 'weight': 1350},
+               'tags': ['a'], 'big': 'x' * 1000}
+        oid = self.testdb[collection].insert_one(doc).inserted_id
+        orig = self.testdb[collection].find_one({'_id': oid})
+
+        # 差分で書き込み
+        amended = copy.deepcopy(orig)
+        amended['spec']['weight'] = 1230
+        amended['tags'].append('b')
+        self.assertEqual(1, self.db._write_diff(collection, orig, amended))
+        self.assertDictEqual(
+            amended, self.testdb[collection].find_one({'_id': oid}))
+
+        # 差分がない場合は書き込まない
+        self.assertEqual(0, self.db._write_diff(collection, amended,
+                                                amended))
+
+        # 置き換えにフォールバックする場合
+        replaced = {'_id': oid, 'name': 'S2000', 'c.d': 1}
+        self.assertEqual(1, self.db._write_diff(collection, amended,
+                                                replaced))
+        self.assertDictEqual(
+            replaced, self.testdb[collection].find_one({'_id': oid}))
+
     def test__merge(self):
         # 正常系
         orig = {'beamtime': [{'name': 'NSX'}, {'spec': {'power': 280}}]}
@@ -710,6 +975,47 @@ class TestDB(TestCase):
         expected = ['1', '2', {'A': '4'}, '3', '4']
         self.assertListEqual(expected, actual)
 
+    def test_ensure_indexes(self):
+        if not self.db_server_connect:
+            return
+
+        d = {'Beamtime': {'data': 'root', 'expInfo': {'data': 'exp'}}}
+        convert = Convert()
+        self.db.insert(convert.dict_to_edman(d))
+
+        expected = ['edman_parent', 'edman_child', 'edman_file',
+                    'edman_ancestors']
+        actual = self.db.ensure_indexes()
+        self.assertListEqual(['Beamtime', 'expInfo'], sorted(actual))
+        for collection in ('Beamtime', 'expInfo'):
+            with self.subTest(collection=collection):
+                self.assertListEqual(expected, actual[collection])
+                index_info = self.testdb[collection].index_information()
+                for name in expected:
+                    self.assertIn(name, index_info)
+                self.assertEqual([(self.parent + '.$id', 1)],
+                                 list(index_info['edman_parent']['key']))
+
+        # 作成済みでも例外にならない
+        actual = self.db.ensure_indexes(['Beamtime'])
+        self.assertListEqual(expected, actual['Beamtime'])
+
+    def test_index_stats(self):
+        if not self.db_server_connect:
+            return
+
+        d = {'Beamtime': {'data': 'root', 'expInfo': {'data': 'exp'}}}
+        convert = Convert()
+        self.db.insert(convert.dict_to_edman(d))
+        self.db.ensure_indexes()
+        root = self.testdb['Beamtime'].find_one()
+        _ = list(self.testdb['expInfo'].find(
+            {self.parent + '.$id': root['_id']}).hint('edman_parent'))
+
+        actual = self.db.index_stats(['expInfo'])
+        self.assertIn('edman_parent', actual['expInfo'])
+        self.assertGreaterEqual(actual['expInfo']['edman_parent']['ops'], 1)
+
     def test_find_collection_from_objectid(self):
         if not self.db_server_connect:
             return
@@ -730,6 +1036,84 @@ class TestDB(TestCase):
         actual = self.db.find_collection_from_objectid(str_oid)
         self.assertEqual(actual, collection)
 
+    def test_oid_registry(self):
+        if not self.db_server_connect:
+            return
+
+        self.db.oid_registry = True
+        try:
+            # インサートで登録される
+            insert_data = {'parent': {'name': 'p',
+                                      'child': {'name': 'c'}}}
+            convert = Convert()
+            converted = convert.dict_to_edman(insert_data)
+            results = self.db.insert(converted)
+            oids = {list(i.keys())[0]: list(i.values())[0][0]
+                    for i in results}
+            for collection, oid in oids.items():
+                with self.subTest(collection=collection):
+                    self.assertEqual(
+                        collection,
+                        self.testdb[Config.registry].find_one(
+                            {'_id': oid})['collection'])
+                    self.assertEqual(
+                        collection,
+                        self.db.find_collection_from_objectid(oid))
+
+            # 対応表に無いドキュメントは全コレクションを検索して登録する
+            oid = self.testdb['not_registered'].insert_one(
+                {'name': 'x'}).inserted_id
+            self.assertEqual('not_registered',
+                             self.db.find_collection_from_objectid(oid))
+            self.assertIsNotNone(
+                self.testdb[Config.registry].find_one({'_id': oid}))
+            self.assertNotIn(Config.registry, self.db.get_collections())
+
+            # 対応表の登録先に無いドキュメントは対応表から外して再検索する
+            self.testdb[Config.registry].update_one(
+                {'_id': oid}, {'$set': {'collection': 'moved'}})
+            self.assertEqual('not_registered',
+                             self.db.find_collection_from_objectid(oid))
+            self.assertEqual('not_registered', self.testdb[
+                Config.registry].find_one({'_id': oid})['collection'])
+            self.testdb['not_registered'].delete_one({'_id': oid})
+            self.assertIsNone(self.db.find_collection_from_objectid(oid))
+            self.assertIsNone(
+                self.testdb[Config.registry].find_one({'_id': oid}))
+
+            # 削除で対応表からも削除される
+            self.db.delete(oids['parent'], 'parent', 'ref')
+            for oid in oids.values():
+                with self.subTest(oid=oid):
+                    self.assertIsNone(
+                        self.testdb[Config.registry].find_one({'_id': oid}))
+        finally:
+            self.db.oid_registry = False
+
+    def test_rebuild_oid_registry(self):
+        if not self.db_server_connect:
+            return
+
+        a_ids = self.testdb['a'].insert_many(
+            [{'v': i} for i in range(5)]).inserted_ids
+        b_ids = self.testdb['b'].insert_many(
+            [{'v': i} for i in range(2)]).inserted_ids
+        self.testdb[Config.registry].insert_one(
+            {'_id': ObjectId(), 'collection': 'deleted'})
+
+        actual = self.db.rebuild_oid_registry(batch_size=2)
+        self.assertDictEqual({'a': 5, 'b': 2}, actual)
+        self.assertEqual(7, self.testdb[Config.registry].count_documents({}))
+        for collection, ids in (('a', a_ids), ('b', b_ids)):
+            self.assertEqual(len(ids), self.testdb[
+                Config.registry].count_documents(
+                {'_id': {'$in': ids}, 'collection': collection}))
+
+        # コレクションを指定した場合は該当コレクションのみ作り直す
+        self.testdb['b'].delete_one({'_id': b_ids[0]})
+        self.assertDictEqual({'b': 1}, self.db.rebuild_oid_registry(['b']))
+        self.assertEqual(6, self.testdb[Config.registry].count_documents({}))
+
     def test__convert_datetime_dict(self):
 
         # 正常系
@@ -1006,9 +1390,10 @@ class TestDB(TestCase):
                 else:
                     delete_doc_id_dict.update({doc_collection: [oid]})
 
-        self.db._delete_documents(delete_doc_id_dict)
+        actual = self.db._delete_documents(delete_doc_id_dict)
         doc = self.testdb[collection].find_one({'_id': doc['_id']})
         self.assertIsNone(doc)
+        self.assertEqual(5, actual)
 
     def test__delete_reference_from_parent(self):
         if not self.db_server_connect:
@@ -1127,6 +1512,47 @@ class TestDB(TestCase):
         self.assertListEqual(sorted(expected_oid_list),
                              sorted(actual_oid_list))
 
+    def test__extract_elements_by_level(self):
+        if not self.db_server_connect:
+            return
+
+        fs = gridfs.GridFS(self.testdb)
+        fs_inserted_oid = fs.put(b'hello, world', filename='sample.txt')
+        fs_inserted_oid2 = fs.put(b'hello, world2', filename='sample2.txt')
+        collection = 'delete_ref_fs_sample'
+        data = {
+            collection: {
+                'name': 'NSX',
+                'st2': [
+                    {'name': 'GT-R', 'power': '280'},
+                    {'name': '180SX', 'power': '220', 'engine':
+                        [
+                            {'type': 'turbo', '_ed_file': [fs_inserted_oid2]},
+                            {'type': 'NA'}
+                        ],
+                     '_ed_file': [fs_inserted_oid]
+                     }
+                ],
+                'type': 'R'
+            }
+        }
+        convert = Convert()
+        converted_edman = convert.dict_to_edman(data, mode='ref')
+        inserted_report = self.db.insert(converted_edman)
+        doc = self.testdb[collection].find_one(
+            {'_id': inserted_report[2][collection][0]})
+        actual = [i for i in self.db._extract_elements_by_level(
+            doc, collection)]
+        expected = [i for i in self.db._recursive_extract_elements_from_doc(
+            doc, collection)]
+
+        # 取り出す要素は再帰版と同じで、順番は階層順
+        self.assertCountEqual(expected, actual)
+        self.assertDictEqual({collection: {doc['_id']: {
+            '_ed_file': {}}}}, actual[0])
+        self.assertEqual('st2', list(actual[1].keys())[0])
+        self.assertEqual('engine', list(actual[-1].keys())[0])
+
     def test__collect_emb_file_ref(self):
 
         # 正常系
@@ -1359,6 +1785,54 @@ class TestDB(TestCase):
         del result['_id']
         self.assertDictEqual(result, data['sample2'])
 
+        # 異常系 埋め込み後のサイズが上限を超える場合
+        with self.assertRaises(EdmanDbProcessError):
+            self.db.structure('new_collection',
+                              actual[0]['new_collection'][0],
+                              structure_mode='emb',
+                              new_collection='new_collection3',
+                              max_bson_size=100)
+        self.assertIsNone(self.testdb['new_collection3'].find_one())
+
+    def test__subtree_bson_size(self):
+        if not self.db_server_connect:
+            return
+
+        data = {'root': {'name': 'r', 'child1': [{'v': 1}, {'v': 2}],
+                         'child2': {'v': 3, 'child3': {'v': 4}}}}
+        inserted = self.db.insert(Convert().dict_to_edman(data))
+        expected = sum(len(encode(doc)) for i in inserted
+                       for collection, ids in i.items()
+                       for doc in self.testdb[collection].find(
+                           {'_id': {'$in': ids}}))
+        root = self.testdb['root'].find_one()
+        self.assertEqual(expected, self.db._subtree_bson_size(root))
+
+        # 子が存在しない場合は自分のサイズ
+        leaf = self.testdb['child3'].find_one()
+        self.assertEqual(len(encode(leaf)),
+                         self.db._subtree_bson_size(leaf))
+
+    def test__build_emb_tree(self):
+        if not self.db_server_connect:
+            return
+
+        data = {'root': {'name': 'r', 'child1': [{'v': 1}, {'v': 2}],
+                         'child2': {'v': 3, 'child3': [{'v': 4}]}}}
+        self.db.insert(Convert().dict_to_edman(data, ancestors=True))
+        root = self.testdb['root'].find_one()
+
+        expected = {'name': 'r', 'child1': [{'v': 1}, {'v': 2}],
+                    'child2': [{'v': 3, 'child3': [{'v': 4}]}]}
+        actual = self.db._build_emb_tree(root)
+        self.assertDictEqual(expected, actual)
+        # 組み立て元のドキュメントは変更しない
+        self.assertIn(self.child, root)
+
+        # 上限を超えた時点で中断する
+        with self.assertRaises(EdmanDbProcessError):
+            self.db._build_emb_tree(root, max_bson_size=40)
+
     def test_get_child_all(self):
         if not self.db_server_connect:
             return
@@ -1446,6 +1920,16 @@ class TestDB(TestCase):
         # print(actual)
         self.assertDictEqual(expected, actual)
 
+        # 世代単位で取得しても同じ構造になる
+        actual = self.db.get_child_all({parent_col: parent_data},
+                                       engine='level')
+        self.assertDictEqual(expected, actual)
+
+        # engineの指定ミス
+        with self.assertRaises(EdmanFormatError):
+            _ = self.db.get_child_all({parent_col: parent_data},
+                                      engine='test')
+
     def test_get_child(self):
         if not self.db_server_connect:
             return
@@ -1586,6 +2070,226 @@ class TestDB(TestCase):
             with self.subTest(a=a, t=t):
                 self.assertEqual(a, t)
 
+    def test__get_child_by_level(self):
+        if not self.db_server_connect:
+            return
+
+        parent_col = 'Beamtime'
+        target_col = 'expInfo'
+        d = {
+            parent_col: {
+                "test_data": "test",
+                target_col: [
+                    {
+                        "layer_test1b": "data",
+                        "layer_test1a": [{
+                            "test2_data": "data",
+                            "layer_test2": [{"layer_test3a": "data"}]
+                        }]
+                    },
+                    {"layer_test1b": "data2"}
+                ]
+            }
+        }
+        convert = Convert()
+        insert_result = self.db.insert(convert.dict_to_edman(d))
+        root_oid = [v for i in insert_result for k, v in i.items()
+                    if k == parent_col][0][0]
+        doc = self.db.doc(parent_col, root_oid, query=None,
+                          reference_delete=False)
+
+        # 世代ごとに兄弟単位のリストが作成される
+        actual = self.db._get_child_by_level({parent_col: doc}, None)
+        self.assertEqual(3, len(actual))
+        self.assertEqual(2, len(actual[0]))
+        for a in actual[0]:
+            with self.subTest(a=a):
+                self.assertIn(target_col, a)
+
+        # depthの分だけ取得する
+        actual = self.db._get_child_by_level({parent_col: doc}, 1)
+        self.assertEqual(1, len(actual))
+
+        # 再帰で取得した場合と同じ構造に組み立てられる
+        expected = self.db.get_child_all({parent_col: doc})
+        actual = self.db._build_to_doc_child(
+            self.db._get_child_by_level({parent_col: doc}, None))
+        self.assertDictEqual(expected, actual)
+
+        # 複数の枝がある場合、recursiveは後の枝が打ち切られるが
+        # levelは全ての枝をdepth世代まで取得する
+        d = {'r': {'a': [{'v': 1, 'b': {'v': 2, 'c': {'v': 3}}},
+                         {'v': 4, 'b': {'v': 5, 'c': {'v': 6}}}]}}
+        insert_result = self.db.insert(convert.dict_to_edman(d))
+        root_oid = [v for i in insert_result for k, v in i.items()
+                    if k == 'r'][0][0]
+        doc = self.db.doc('r', root_oid, query=None, reference_delete=False)
+        expected = self.db.get_child_all({'r': copy.deepcopy(doc)})
+        self.assertDictEqual(expected, self.db.get_child(
+            {'r': copy.deepcopy(doc)}, 3, engine='level'))
+        recursive_result = self.db.get_child({'r': copy.deepcopy(doc)}, 3)
+        self.assertNotEqual(expected, recursive_result)
+        self.assertNotIn('c', recursive_result['a'][1]['b'][0])
+
+    def test_get_subtree_aggregate(self):
+        if not self.db_server_connect:
+            return
+
+        # 同じコレクションが続く部分と別コレクションにまたがる部分を含むツリー
+        root_col = 'node'
+        d = {
+            root_col: {
+                'v': 0,
+                root_col: [
+                    {
+                        'v': 1,
+                        root_col: [{
+                            'v': 2,
+                            'other': {'w': 1, root_col: {'v': 3}}
+                        }]
+                    },
+                    {'v': 4}
+                ]
+            }
+        }
+        convert = Convert()
+        self.db.insert(convert.dict_to_edman(d))
+        doc = self.testdb[root_col].find_one(
+            {'v': 0, self.parent: {'$exists': False}})
+
+        # 全て取得した場合は再帰で取得した結果と一致する
+        expected = self.db.get_child_all({root_col: copy.deepcopy(doc)})
+        actual = self.db.get_subtree_aggregate(root_col, doc['_id'])
+        self.assertDictEqual(expected, actual)
+
+        # depthを指定した場合は世代単位で取得した結果と一致する
+        for depth in range(1, 5):
+            with self.subTest(depth=depth):
+                expected = self.db.get_child({root_col: copy.deepcopy(doc)},
+                                             depth, engine='level')
+                actual = self.db.get_subtree_aggregate(root_col, doc['_id'],
+                                                       depth)
+                self.assertDictEqual(expected, actual)
+
+        # depthが0の場合は取得しない
+        self.assertDictEqual(
+            {}, self.db.get_subtree_aggregate(root_col, doc['_id'], 0))
+
+        # ドキュメントが存在しない
+        with self.assertRaises(EdmanInternalError):
+            _ = self.db.get_subtree_aggregate(root_col, ObjectId())
+
+    def test__dereference_many(self):
+        if not self.db_server_connect:
+            return
+
+        db = self.client[self.test_ini['db']]
+        ids1 = [ObjectId(), ObjectId()]
+        ids2 = [ObjectId()]
+        db['col1'].insert_many([{'_id': i, 'data': 'col1'} for i in ids1])
+        db['col2'].insert_many([{'_id': i, 'data': 'col2'} for i in ids2])
+        refs = [DBRef('col1', i) for i in ids1] + [
+            DBRef('col2', i) for i in ids2] + [DBRef('col2', ObjectId())]
+
+        actual = self.db._dereference_many(refs)
+        # 存在しないドキュメントは含まれない
+        self.assertEqual(3, len(actual))
+        for ref in refs[:3]:
+            with self.subTest(ref=ref):
+                self.assertEqual(ref.id,
+                                 actual[(ref.collection, ref.id)]['_id'])
+
+        # 空リスト
+        self.assertDictEqual({}, self.db._dereference_many([]))
+
+    def test__dereference(self):
+        if not self.db_server_connect:
+            return
+
+        self.db.cache = DocumentCache()
+        try:
+            insert_data = {'parent': {'name': 'p', 'memo': 'm',
+                                      'child': [{'name': 'c1'},
+                                                {'name': 'c2'}]}}
+            convert = Convert()
+            results = {k: v for i in self.db.insert(
+                convert.dict_to_edman(insert_data)) for k, v in i.items()}
+            parent_id = results['parent'][0]
+            child_ids = results['child']
+            parent_ref = DBRef('parent', parent_id)
+
+            # 2回目はキャッシュから取得する
+            self.assertEqual('p', self.db._dereference(parent_ref)['name'])
+            self.assertEqual('p', self.db._dereference(parent_ref)['name'])
+            self.assertEqual(1, self.db.cache.hits)
+            self.assertEqual(1, self.db.cache.misses)
+
+            # _dereference_many()もキャッシュを共有する
+            fetched = self.db._dereference_many(
+                [parent_ref] + [DBRef('child', i) for i in child_ids])
+            self.assertEqual(3, len(fetched))
+            self.assertEqual(2, self.db.cache.hits)
+            self.assertEqual(3, len(self.db.cache))
+
+            # 存在しないドキュメントは格納しない
+            self.assertIsNone(
+                self.db._dereference(DBRef('parent', ObjectId())))
+            self.assertEqual(3, len(self.db.cache))
+
+            # 書き込むとキャッシュから破棄される
+            self.db.update('parent', parent_id, {'name': 'q'}, 'ref')
+            self.assertEqual('q', self.db._dereference(parent_ref)['name'])
+            self.db.item_delete('parent', parent_id, 'memo', None)
+            self.assertNotIn('memo', self.db._dereference(parent_ref))
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                p = Path(tmp_dir) / 'file.txt'
+                p.write_text('test')
+                file = File(self.db.get_db, cache=self.db.cache)
+                self.assertTrue(file.upload('parent', parent_id, (p,), 'ref'))
+            self.assertIn(self.file, self.db._dereference(parent_ref))
+
+            self.db.delete(child_ids[0], 'child', 'ref')
+            self.assertIsNone(
+                self.db._dereference(DBRef('child', child_ids[0])))
+            self.assertListEqual(
+                [DBRef('child', child_ids[1])],
+                self.db._dereference(parent_ref)[self.child])
+        finally:
+            self.db.cache = None
+
+    def test_change_stream_invalidator(self):
+        if not self.db_server_connect:
+            return
+        # チェンジストリームはレプリカセットのみ
+        try:
+            with self.testdb.watch(max_await_time_ms=1):
+                pass
+        except errors.OperationFailure:
+            return
+
+        cache = DocumentCache()
+        self.db.cache = cache
+        invalidator = ChangeStreamInvalidator(self.db,
+                                              max_await_time_ms=100)
+        invalidator.start()
+        try:
+            oid = self.testdb['col'].insert_one({'v': 1}).inserted_id
+            ref = DBRef('col', oid)
+            self.assertEqual(1, self.db._dereference(ref)['v'])
+
+            # 他の接続からの書き込みでキャッシュから破棄される
+            self.testdb['col'].update_one({'_id': oid}, {'$set': {'v': 2}})
+            for _ in range(100):
+                if not len(cache):
+                    break
+                time.sleep(0.1)
+            self.assertEqual(0, len(cache))
+            self.assertEqual(2, self.db._dereference(ref)['v'])
+        finally:
+            invalidator.stop()
+            self.db.cache = None
+
     def test__build_to_doc_child(self):
         # データ構造のテスト
         parent_id = ObjectId()
@@ -1782,6 +2486,67 @@ class TestDB(TestCase):
         }
         self.assertDictEqual(expect, actual)
 
+    def test_loop_exclusion_key_and_ref(self):
+        if not self.db_server_connect:
+            return
+
+        collection = 'loop_exclusion_emb'
+        emb_docs = [{'wrap': {'sample': {'name': f's{i}', 'memo': {'m': 1},
+                                         'item': [{'v': i}, {'v': i + 1}]}}}
+                    for i in range(5)]
+        self.testdb[collection].insert_many(emb_docs)
+        # refのドキュメントは対象外
+        self.testdb[collection].insert_one(
+            {'sample': {'name': 'ref'}, self.child: []})
+
+        checkpoint: dict = {}
+        actual = self.db.loop_exclusion_key_and_ref(
+            collection, 'sample', ('memo',), batch_size=2, max_workers=2,
+            checkpoint=checkpoint)
+
+        self.assertEqual(5, len(actual['result']))
+        for i, structured_result in enumerate(actual['result']):
+            with self.subTest(i=i):
+                self.assertListEqual(['sample', 'item'],
+                                     [list(j.keys())[0]
+                                      for j in structured_result])
+                sample_oid = structured_result[0]['sample'][0]
+                doc = self.testdb['sample'].find_one({'_id': sample_oid})
+                self.assertEqual(f's{i}', doc['name'])
+                self.assertNotIn('memo', doc)
+                self.assertIsNone(self.testdb['memo'].find_one())
+                items = list(self.testdb['item'].find(
+                    {'_id': {'$in': structured_result[1]['item']}}))
+                self.assertListEqual([i, i + 1],
+                                     sorted(j['v'] for j in items))
+                self.assertTrue(all(j[self.parent].id == sample_oid
+                                    for j in items))
+        self.assertEqual(5, self.testdb['sample'].count_documents({}))
+        last_id = self.testdb[collection].find_one(
+            {self.child: {'$exists': False}}, sort=[('_id', -1)])['_id']
+        self.assertEqual(last_id, checkpoint[collection])
+
+        # checkpointから再開すると処理済みのドキュメントは対象外
+        self.assertDictEqual({}, self.db.loop_exclusion_key_and_ref(
+            collection, 'sample', ('memo',), checkpoint=checkpoint))
+        self.assertEqual(5, self.testdb['sample'].count_documents({}))
+
+        # keyとcollectionが同じ場合も、インサートしたドキュメントは対象外
+        collection = 'loop_exclusion_same'
+        self.testdb[collection].insert_many(
+            [{collection: {'name': f's{i}'}} for i in range(3)])
+        actual = self.db.loop_exclusion_key_and_ref(collection, collection,
+                                                    (), batch_size=1)
+        self.assertEqual(3, len(actual['result']))
+        self.assertEqual(6, self.testdb[collection].count_documents({}))
+
+        # 異常系
+        with self.assertRaises(EdmanInternalError):
+            self.db.loop_exclusion_key_and_ref('loop_exclusion_emb', 'not_exists', ())
+        with self.assertRaises(EdmanInternalError):
+            self.db.loop_exclusion_key_and_ref('empty_collection',
+                                               'sample', ())
+
     def test_get_collections(self):
         if not self.db_server_connect:
             return
@@ -2206,6 +2971,94 @@ class TestDB(TestCase):
             expected.update({k: type_cast(v)})
         self.assertDictEqual(expected, after_result)
 
+    def test_bson_type_bulk(self):
+        if not self.db_server_connect:
+            return
+
+        data = [
+            {'int_data': '12', 'float_data': '25.1', 'bool_data': 'True',
+             'datetime_data': '2018-02-21 21:46:39', 'str_data': 3,
+             'list_data': ['1', '2', '3'], 'null_data': None},
+            {'int_data': 13, 'float_data': '2', 'bool_data': '',
+             'datetime_data': '2020-01-01 00:00:00', 'str_data': 'a',
+             'list_data': ['4', 'x']},
+            {'int_data': '-7', 'bool_data': 'False'},
+        ]
+        types = {'int_data': 'int', 'float_data': 'float',
+                 'bool_data': 'bool', 'datetime_data': 'datetime',
+                 'str_data': 'str', 'list_data': ['int', 'str'],
+                 'null_data': 'int'}
+        for collection in ('python_engine', 'bulk_engine', 'server_engine'):
+            self.testdb[collection].insert_many(copy.deepcopy(data))
+
+        self.db.bson_type({'python_engine': types})
+        expected = list(self.testdb['python_engine'].find(
+            {}, {'_id': 0}, sort=[('_id', 1)]))
+
+        # python engineと同じ結果になる
+        for engine in ('bulk', 'server'):
+            collection = engine + '_engine'
+            checkpoint: dict = {}
+            actual = self.db.bson_type({collection: types}, engine=engine,
+                                       batch_size=2, checkpoint=checkpoint)
+            with self.subTest(engine=engine):
+                self.assertEqual(3, actual[collection]['docs'])
+                self.assertEqual(0, actual[collection]['unconverted'])
+                self.assertListEqual(expected, list(self.testdb[
+                    collection].find({}, {'_id': 0}, sort=[('_id', 1)])))
+                last_id = self.testdb[collection].find_one(
+                    sort=[('_id', -1)])['_id']
+                self.assertEqual(last_id, checkpoint[collection])
+                self.assertEqual(last_id, actual[collection]['last_id'])
+
+                # checkpointから再開すると処理済みのドキュメントは対象外
+                actual = self.db.bson_type({collection: types},
+                                           engine=engine,
+                                           checkpoint=checkpoint)
+                self.assertEqual(0, actual[collection]['docs'])
+
+        # search_filtersで対象を絞り込む
+        collection = 'filtered_engine'
+        ids = self.testdb[collection].insert_many(
+            [{'v': '1'}, {'v': '2'}]).inserted_ids
+        actual = self.db.bson_type(
+            {collection: {'v': 'int'}},
+            search_filters={collection: {'_id': ids[1]}}, engine='server')
+        self.assertEqual(1, actual[collection]['docs'])
+        self.assertListEqual(['1', 2], [i['v'] for i in self.testdb[
+            collection].find(sort=[('_id', 1)])])
+
+        # サーバ側で変換できない値はそのまま残す
+        collection = 'unconverted_engine'
+        self.testdb[collection].insert_many([{'v': 'abc'}, {'v': '5'}])
+        actual = self.db.bson_type({collection: {'v': 'int'}},
+                                   engine='server')
+        self.assertEqual(1, actual[collection]['unconverted'])
+        self.assertListEqual(['abc', 5], [i['v'] for i in self.testdb[
+            collection].find(sort=[('_id', 1)])])
+
+        # 文字列以外の値とサーバ側で変換できない値はpython engineで変換する
+        data = [{'i': 5, 'f': 5, 'd': 'Feb 21 2018 21:46:39'},
+                {'i': '3000000000', 'f': '2.5', 'd': '2018-02-21'}]
+        types = {'i': 'int', 'f': 'float', 'd': 'datetime'}
+        for collection in ('python_mixed', 'server_mixed'):
+            self.testdb[collection].insert_many(copy.deepcopy(data))
+        self.db.bson_type({'python_mixed': types})
+        actual = self.db.bson_type({'server_mixed': types}, engine='server')
+        self.assertEqual(0, actual['server_mixed']['unconverted'])
+        expected = list(self.testdb['python_mixed'].find(
+            {}, {'_id': 0}, sort=[('_id', 1)]))
+        self.assertListEqual(expected, list(self.testdb['server_mixed'].find(
+            {}, {'_id': 0}, sort=[('_id', 1)])))
+        self.assertIsInstance(expected[0]['f'], float)
+
+        # 異常系
+        with self.assertRaises(EdmanFormatError):
+            self.db.bson_type({collection: {'v': 'int'}}, engine='other')
+        with self.assertRaises(EdmanFormatError):
+            self.db.bson_type({collection: {'v': 'int'}}, engine='bulk',
+                              batch_size=0)
+
     def test_create_user_and_role(self):
         if not self.db_server_connect:
             return
@@ -2490,6 +3343,73 @@ class TestDB(TestCase):
         expected = 0
         self.assertEqual(expected, actual)
 
+        # engine='level'は再帰と同じ結果
+        r, a, b = ObjectId(), ObjectId(), ObjectId()
+        self.testdb['r'].insert_one({'_id': r, self.child: [DBRef('a', a)]})
+        self.testdb['a'].insert_one({'_id': a, self.parent: DBRef('r', r),
+                                     self.child: [DBRef('b', b)]})
+        self.testdb['b'].insert_one({'_id': b, self.parent: DBRef('a', a)})
+        root_doc = self.testdb['r'].find_one({'_id': r})
+        leaf_doc = self.testdb['b'].find_one({'_id': b})
+        for engine in ('recursive', 'level'):
+            with self.subTest(engine=engine):
+                self.assertEqual(2, self.db.get_ref_depth(
+                    root_doc, self.child, engine=engine))
+                self.assertEqual(2, self.db.get_ref_depth(
+                    leaf_doc, self.parent, engine=engine))
+        with self.assertRaises(EdmanFormatError):
+            self.db.get_ref_depth(root_doc, self.child, engine='x')
+
+        # memoizeの場合は2回目以降DBを参照しない
+        self.assertEqual(2, self.db.get_ref_depth(
+            root_doc, self.child, memoize=True, collection='r'))
+        self.testdb['b'].update_one(
+            {'_id': b}, {'$set': {self.child: [DBRef('c', ObjectId())]}})
+        self.testdb['c'].insert_one(
+            {'_id': self.testdb['b'].find_one({'_id': b})[self.child][0].id})
+        self.assertEqual(2, self.db.get_ref_depth(
+            root_doc, self.child, memoize=True, collection='r'))
+        self.assertEqual(3, self.db.get_ref_depth(root_doc, self.child))
+
+        # このインスタンスから書き込むとメモは破棄される
+        self.db.update('a', a, {'v': 1}, 'ref')
+        self.assertEqual(3, self.db.get_ref_depth(
+            root_doc, self.child, memoize=True, collection='r'))
+
+        # 辿ったドキュメントが(他のプロセスの書き込みなどで)破棄されると
+        # メモも破棄される
+        self.testdb['b'].update_one({'_id': b}, {'$unset': {self.child: 1}})
+        self.assertEqual(3, self.db.get_ref_depth(
+            root_doc, self.child, memoize=True, collection='r'))
+        self.db._depth_memo_cache().invalidate('b', [b])
+        self.assertEqual(2, self.db.get_ref_depth(
+            root_doc, self.child, memoize=True, collection='r'))
+
+        # ドキュメント自身が破棄された場合もメモは破棄される
+        leaf_doc = self.testdb['b'].find_one({'_id': b})
+        self.assertEqual(0, self.db.get_ref_depth(
+            leaf_doc, self.child, memoize=True, collection='b'))
+        self.testdb['b'].update_one(
+            {'_id': b}, {'$set': {self.child: [
+                DBRef('c', self.testdb['c'].find_one()['_id'])]}})
+        self.db._depth_memo_cache().invalidate('b', [b])
+        self.assertEqual(1, self.db.get_ref_depth(
+            self.testdb['b'].find_one({'_id': b}), self.child,
+            memoize=True, collection='b'))
+        self.testdb['b'].update_one({'_id': b}, {'$unset': {self.child: 1}})
+        with self.assertRaises(EdmanFormatError):
+            self.db.get_ref_depth(leaf_doc, self.child, memoize=True)
+
+        # cacheを指定した場合はcacheに保持する
+        self.db.cache = DocumentCache(maxsize=2)
+        try:
+            self.assertEqual(2, self.db.get_ref_depth(
+                leaf_doc, self.parent, memoize=True, collection='b'))
+            self.assertIsNotNone(self.db.cache.get(
+                (DB._depth_namespace, self.parent), b))
+        finally:
+            self.db.cache = None
+
         # # 深い階層
         # parent_col = 'Beamtime'
         # target_col = 'expInfo'
@@ -2729,6 +3649,46 @@ class TestDB(TestCase):
     #     # test_tree = self.db.get_tree('layer_test5', self_doc_id, include=['_id'])
     #     # print(test_tree)
 
+    def test__get_ref_depth_by_level(self):
+        if not self.db_server_connect:
+            return
+
+        # r -> a1 -> b -> c, r -> a2
+        r, a1, a2, b, c = [ObjectId() for _ in range(5)]
+        self.testdb['r'].insert_one(
+            {'_id': r, self.child: [DBRef('a', a1), DBRef('a', a2)]})
+        self.testdb['a'].insert_many([
+            {'_id': a1, self.parent: DBRef('r', r),
+             self.child: [DBRef('b', b)]},
+            {'_id': a2, self.parent: DBRef('r', r)}])
+        self.testdb['b'].insert_one({'_id': b, self.parent: DBRef('a', a1),
+                                     self.child: [DBRef('c', c)]})
+        self.testdb['c'].insert_one({'_id': c, self.parent: DBRef('b', b)})
+
+        root_doc = self.testdb['r'].find_one({'_id': r})
+        leaf_doc = self.testdb['c'].find_one({'_id': c})
+        self.assertEqual(3, self.db._get_ref_depth_by_level(root_doc,
+                                                            self.child))
+        self.assertEqual(3, self.db._get_ref_depth_by_level(leaf_doc,
+                                                            self.parent))
+        self.assertEqual(0, self.db._get_ref_depth_by_level(leaf_doc,
+                                                            self.child))
+        self.assertEqual(0, self.db._get_ref_depth_by_level(root_doc,
+                                                            self.parent))
+
+        # 存在しないドキュメントへのリファレンスは数えない
+        self.testdb['c'].delete_one({'_id': c})
+        self.assertEqual(2, self.db._get_ref_depth_by_level(root_doc,
+                                                            self.child))
+
+    def test__refs_of(self):
+        refs = [DBRef('a', ObjectId()), DBRef('b', ObjectId())]
+        self.assertListEqual(
+            refs, DB._refs_of({self.child: refs}, self.child))
+        self.assertListEqual(
+            refs[:1], DB._refs_of({self.parent: refs[0]}, self.parent))
+        self.assertListEqual([], DB._refs_of({}, self.parent))
+
     def test__get_root_dbref(self):
         if not self.db_server_connect:
             return
@@ -2788,6 +3748,61 @@ class TestDB(TestCase):
         expected = None
         self.assertEqual(expected, actual)
 
+    def test_backfill_ancestors(self):
+        if not self.db_server_connect:
+            return
+
+        d = {
+            'Beamtime': {
+                'data': 'root',
+                'expInfo': [
+                    {'data': 'exp1', 'sample': {'data': 'sample1'}},
+                    {'data': 'exp2'}
+                ]
+            }
+        }
+        convert = Convert()
+        self.db.insert(convert.dict_to_edman(d))
+        # 子がないルートのみのドキュメント
+        self.db.insert(convert.dict_to_edman({'Beamtime': {'data': 'alone'}}))
+
+        actual = self.db.backfill_ancestors()
+        expected = {'Beamtime': 2, 'expInfo': 2, 'sample': 1}
+        self.assertDictEqual(expected, actual)
+        alone = self.testdb['Beamtime'].find_one({'data': 'alone'})
+        self.assertEqual(0, alone[self.config.depth])
+        self.assertListEqual([], alone[self.config.ancestors])
+
+        # 変換時に付与した場合と同じ情報が付与される
+        root = self.testdb['Beamtime'].find_one({'data': 'root'})
+        root_ref = DBRef('Beamtime', root['_id'])
+        self.assertEqual(0, root[self.config.depth])
+        self.assertListEqual([], root[self.config.ancestors])
+        sample = self.testdb['sample'].find_one()
+        self.assertEqual(2, sample[self.config.depth])
+        self.assertEqual(root_ref, sample[self.config.root])
+        self.assertListEqual(
+            [root_ref, sample[self.parent]], sample[self.config.ancestors])
+
+        # 付与された情報からルートと深さを取得できる
+        self.assertEqual(root_ref, self.db.get_root_dbref(sample))
+        self.assertEqual(2, self.db.get_ref_depth(sample, self.parent))
+        self.assertEqual(2, self.db.get_ref_depth(root, self.child))
+
+        # 付与された情報を利用して子要素を取得しても同じ構造になる
+        expected = self.db.get_child_all({'Beamtime': copy.deepcopy(root)})
+        actual = self.db.get_child_all({'Beamtime': copy.deepcopy(root)},
+                                       engine='ancestors')
+        self.assertDictEqual(expected, actual)
+        found = self.db._find_descendants_by_ancestors({'Beamtime': root},
+                                                       1)
+        self.assertEqual(2, len(found))
+
+        # 2回目は変更なし
+        actual = self.db.backfill_ancestors(['Beamtime'])
+        self.assertDictEqual({'Beamtime': 0, 'expInfo': 0, 'sample': 0},
+                             actual)
+
     def test__delete_collections(self):
         if not self.db_server_connect:
             return
@@ -1,10 +1,13 @@
 import configparser
 import datetime
 import gzip
+import hashlib
+import io
 import json
 import os
 import shutil
 import tempfile
+import time
 import zipfile
 # from logging import getLogger,  FileHandler, ERROR
 from logging import ERROR, StreamHandler, getLogger
@@ -17,7 +20,9 @@ from bson.json_util import dumps
 from pymongo import MongoClient, errors
 
 from edman import DB, Config, Convert, File, Search
-from edman.exceptions import EdmanDbProcessError
+from edman.exceptions import (EdmanDbProcessError, EdmanFormatError,
+                              EdmanInternalError)
+from edman.file import ByteRateLimiter
 
 
 class TestFile(TestCase):
@@ -154,6 +159,12 @@ class TestFile(TestCase):
         expected = {'name': 'NSX', 'ddd': 'aaa', self.config.file: files_oid}
         self.assertDictEqual(expected, actual)
 
+        # 同じoidは1つにまとめる
+        doc = {'name': 'NSX'}
+        actual = self.file.file_list_attachment(
+            doc, [files_oid[0], files_oid[1], files_oid[0]])
+        self.assertListEqual(files_oid, actual[self.config.file])
+
         # _ed_fileがすでに存在する場合
         oid1 = ObjectId()
         oid2 = ObjectId()
@@ -204,10 +215,154 @@ class TestFile(TestCase):
                     fs_oids.append(
                         self.fs.put(f.read(), filename=str(i.name)))
 
-            self.file.fs_delete(fs_oids)
+            actual = self.file.fs_delete(fs_oids)
+            self.assertEqual(2, actual)
             for i in fs_oids:
                 with self.subTest(i=i):
                     self.assertFalse(self.fs.exists(i))
+                    self.assertIsNone(self.testdb['fs.chunks'].find_one(
+                        {'files_id': i}))
+
+            # 存在しないファイルは数えない
+            self.assertEqual(0, self.file.fs_delete(fs_oids))
+            self.assertEqual(0, self.file.fs_delete([]))
+
+        # 重複排除で共有されているファイルは最後の参照で削除する
+        shared_oid = self.fs.put(b'shared', filename='shared.txt',
+                                 **{Config.fs_refcount: 3})
+        self.assertEqual(0, self.file.fs_delete([shared_oid]))
+        self.assertEqual(2, self.testdb['fs.files'].find_one(
+            {'_id': shared_oid})[Config.fs_refcount])
+        self.assertEqual(1, self.file.fs_delete([shared_oid, shared_oid]))
+        self.assertFalse(self.fs.exists(shared_oid))
+
+    def test_upload_dedup(self):
+        if not self.db_server_connect:
+            return
+
+        collection = 'test_upload_dedup'
+        oid = self.testdb[collection].insert_one({'name': 'doc'}).inserted_id
+        self.fs = gridfs.GridFS(self.testdb)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_a, file_b = [Path(tmp_dir) / i for i in ('a.txt', 'b.txt')]
+            for i in (file_a, file_b):
+                with i.open('w') as f:
+                    f.write('same content')
+
+            # 同じ内容のファイルは1つのファイルを参照する
+            self.assertTrue(self.file.upload(collection, oid,
+                                             (file_a, file_b), 'ref',
+                                             dedup=True))
+            # 添付済みのファイルと同じ内容の場合はドキュメントは変わらない
+            self.assertFalse(self.file.upload(collection, oid, (file_a,),
+                                              'ref', dedup=True))
+        doc = self.testdb[collection].find_one({'_id': oid})
+        self.assertEqual(1, len(doc[Config.file]))
+        file_oid = doc[Config.file][0]
+        self.assertEqual(1, self.testdb['fs.files'].find_one(
+            {'_id': file_oid})[Config.fs_refcount])
+
+
+        # 1回のアップロードに同じ内容のファイルが含まれても参照は1つ
+        other = self.testdb[collection].insert_one(
+            {'name': 'other'}).inserted_id
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_a, file_b = [Path(tmp_dir) / i for i in ('a.txt', 'b.txt')]
+            for i in (file_a, file_b):
+                with i.open('w') as f:
+                    f.write('same content')
+            self.assertTrue(self.file.upload(collection, other,
+                                             (file_a, file_b), 'ref',
+                                             dedup=True))
+        doc = self.testdb[collection].find_one({'_id': other})
+        self.assertListEqual([file_oid], doc[Config.file])
+        self.assertEqual(2, self.testdb['fs.files'].find_one(
+            {'_id': file_oid})[Config.fs_refcount])
+
+        # 他のドキュメントが参照している間はファイルを削除しない
+        self.assertTrue(self.file.delete(file_oid, collection, other, 'ref'))
+        self.assertTrue(self.fs.exists(file_oid))
+
+        # 最後の参照が無くなればファイルを削除する
+        self.assertTrue(self.file.delete(file_oid, collection, oid, 'ref'))
+        self.assertFalse(self.fs.exists(file_oid))
+
+    def test__dedup_file(self):
+        if not self.db_server_connect:
+            return
+
+        self.fs = gridfs.GridFS(self.testdb)
+        self.file._create_dedup_index()
+        digest = hashlib.sha256(b'same').hexdigest()
+        # 同時に書き込まれた同じ内容のファイル(参照数はまだ持たない)
+        file_a, file_b = [self.fs.put(b'same', sha256=digest)
+                          for _ in range(2)]
+
+        # 先に判定した方が正本になり、後の方はそれを参照する
+        self.assertEqual(file_a, self.file._dedup_file(file_a, digest, 4))
+        self.assertEqual(file_a, self.file._dedup_file(file_b, digest, 4))
+        self.assertTrue(self.fs.exists(file_a))
+        self.assertFalse(self.fs.exists(file_b))
+        self.assertEqual(2, self.testdb['fs.files'].find_one(
+            {'_id': file_a})[Config.fs_refcount])
+
+        # 正本は内容毎に1つに限られる
+        file_c = self.fs.put(b'same', sha256=digest)
+        with self.assertRaises(errors.DuplicateKeyError):
+            self.testdb['fs.files'].update_one(
+                {'_id': file_c}, {'$set': {Config.fs_refcount: 1}})
+
+        # 参照数を減らし、最後の参照で削除する
+        self.assertEqual(0, self.file.fs_delete([file_a]))
+        self.assertEqual(2, self.file.fs_delete([file_a, file_c]))
+        self.assertFalse(self.fs.exists(file_a))
+        self.assertEqual(0, self.testdb['fs.chunks'].count_documents(
+            {'files_id': file_a}))
+
+    def test__replace_doc(self):
+        if not self.db_server_connect:
+            return
+
+        collection = 'test_replace_doc'
+        oid = self.testdb[collection].insert_one({'value': 0}).inserted_id
+        doc = self.testdb[collection].find_one({'_id': oid})
+
+        def increment(d):
+            d['value'] += 1
+            return d
+
+        # 競合した場合は読み込みからやり直す
+        calls = []
+
+        def conflict_once(d):
+            calls.append(1)
+            if len(calls) == 1:  # 他の書き込み
+                self.testdb[collection].update_one(
+                    {'_id': oid}, {'$set': {Config.revision: 5}})
+            return increment(d)
+
+        self.assertTrue(self.file._replace_doc(collection, doc,
+                                               conflict_once, revision=True))
+        self.assertEqual(2, len(calls))
+        actual = self.testdb[collection].find_one({'_id': oid})
+        self.assertEqual(1, actual['value'])
+        self.assertEqual(6, actual[Config.revision])
+
+        # リトライの上限を超えた場合
+        def conflict(d):
+            self.testdb[collection].update_one(
+                {'_id': oid}, {'$inc': {Config.revision: 1}})
+            return increment(d)
+
+        with self.assertRaises(EdmanDbProcessError):
+            self.file._replace_doc(collection, actual, conflict,
+                                   revision=True, max_retries=1)
+
+        # revisionを指定しなくてもリビジョンを持つドキュメントはリビジョンを増やす
+        actual = self.testdb[collection].find_one({'_id': oid})
+        self.assertTrue(self.file._replace_doc(collection, actual, increment))
+        self.assertEqual(actual[Config.revision] + 1, self.testdb[
+            collection].find_one({'_id': oid})[Config.revision])
 
     def test_get_file_names(self):
         if not self.db_server_connect:
@@ -248,6 +403,13 @@ class TestFile(TestCase):
                                               query)
             expected = dict(zip(files_oid, [i.name for i in files]))
             self.assertDictEqual(actual, expected)
+            self.assertListEqual(files_oid, list(actual.keys()))
+
+            # GridFSに存在しないファイルは含まれない
+            self.fs.delete(files_oid[0])
+            actual = self.file.get_file_names('structure_emb', oid, 'emb',
+                                              query)
+            self.assertDictEqual({files_oid[1]: files[1].name}, actual)
 
             # 正常系 ファイルがなかった場合 →空のリストを出力
             doc = {
@@ -683,6 +845,51 @@ class TestFile(TestCase):
 
 
 
+    def test_write_zipped_contents(self):
+        if not self.db_server_connect:
+            return
+
+        class UnseekableStream(io.RawIOBase):
+            # HTTPレスポンスのようなシーク不可能なストリーム
+            def __init__(self):
+                self.buffer = bytearray()
+
+            def writable(self):
+                return True
+
+            def write(self, b):
+                self.buffer.extend(b)
+                return len(b)
+
+        self.fs = gridfs.GridFS(self.testdb)
+        doc_oid = ObjectId()
+        # 改行を含まないチャンクサイズより大きいバイナリ
+        content = b'\x00' * (1024 * 10 + 1)
+        compressed_text = b'compressed text'
+        files_oid = [
+            self.fs.put(content, filename='plain.bin', chunk_size=1024),
+            self.fs.put(gzip.compress(compressed_text), filename='gz.txt',
+                        chunk_size=1)]
+        encoded_json = json.dumps({'test': 'data'}).encode('utf-8')
+
+        stream = UnseekableStream()
+        self.file.write_zipped_contents({doc_oid: files_oid}, 'json_tree',
+                                        encoded_json, stream)
+
+        with zipfile.ZipFile(io.BytesIO(bytes(stream.buffer))) as zf:
+            self.assertListEqual(
+                [f'{doc_oid}/plain.bin', f'{doc_oid}/gz.txt',
+                 'json_tree.json'], zf.namelist())
+            self.assertEqual(content, zf.read(f'{doc_oid}/plain.bin'))
+            self.assertEqual(compressed_text, zf.read(f'{doc_oid}/gz.txt'))
+            self.assertEqual(encoded_json, zf.read('json_tree.json'))
+
+        # 異常系 添付ファイルが存在しない場合
+        with self.assertRaises(EdmanDbProcessError):
+            self.file.write_zipped_contents({doc_oid: [ObjectId()]},
+                                            'json_tree', encoded_json,
+                                            io.BytesIO())
+
     def test_get_fileref_and_generate_dl_list(self):
 
         if not self.db_server_connect:
@@ -790,6 +997,118 @@ class TestFile(TestCase):
                     expected.update({dl_file.name: f.read()})
             self.assertDictEqual(test_vars, expected)
 
+        # 並列、転送速度制限あり
+        with tempfile.TemporaryDirectory() as tmp_dl_dir:
+            path = Path(tmp_dl_dir)
+            self.assertTrue(self.file._grid_out(
+                files_oid, path, max_workers=2, max_bytes_per_sec=1024 ** 2))
+            expected = {}
+            for dl_file in path.glob('*.txt'):
+                with dl_file.open() as f:
+                    expected.update({dl_file.name: f.read()})
+            self.assertDictEqual(test_vars, expected)
+
+        # gzip圧縮されたファイルを解凍して保存する場合
+        compressed_oid = self.fs.put(gzip.compress(b'compressed'),
+                                     filename='compressed.txt', chunk_size=4)
+        with tempfile.TemporaryDirectory() as tmp_dl_dir:
+            path = Path(tmp_dl_dir)
+            self.assertTrue(self.file._grid_out([compressed_oid], path,
+                                                decompress=True))
+            with (path / 'compressed.txt').open('rb') as f:
+                self.assertEqual(b'compressed', f.read())
+
+        # 異常系 DBに存在しないファイルが含まれる場合
+        with tempfile.TemporaryDirectory() as tmp_dl_dir:
+            with self.assertRaises(EdmanDbProcessError):
+                self.file._grid_out(files_oid + [ObjectId()], tmp_dl_dir)
+
+    def test__iter_chunks(self):
+        if not self.db_server_connect:
+            return
+
+        # 改行を含まないチャンクサイズより大きいバイナリ
+        self.fs = gridfs.GridFS(self.testdb)
+        content = b'x' * (1024 * 5 + 10)
+        oid = self.fs.put(content, filename='no_newline.bin',
+                          chunk_size=1024)
+        actual = list(self.file._iter_chunks(self.fs.get(oid)))
+        self.assertEqual(6, len(actual))
+        for chunk in actual:
+            with self.subTest(size=len(chunk)):
+                self.assertLessEqual(len(chunk), 1024)
+        self.assertEqual(content, b''.join(actual))
+
+    def test__iter_decompressed(self):
+        data = os.urandom(1024 * 100)
+        compressed = gzip.compress(data)
+
+        def split(b, size):
+            return [b[i:i + size] for i in range(0, len(b), size)]
+
+        # gzip圧縮されていない場合はそのまま返す
+        actual = b''.join(self.file._iter_decompressed(split(data, 1000)))
+        self.assertEqual(data, actual)
+        self.assertEqual(b'', b''.join(self.file._iter_decompressed([])))
+
+        # チャンクサイズに関わらず逐次解凍する
+        for size in [1, 1000, len(compressed)]:
+            with self.subTest(size=size):
+                actual = b''.join(
+                    self.file._iter_decompressed(split(compressed, size)))
+                self.assertEqual(data, actual)
+
+        # 圧縮率が高くても解凍後のデータはmax_sizeずつ返す
+        zeros = b'\x00' * (1024 * 1024)
+        for max_size in [1000, 1024, 64 * 1024]:
+            with self.subTest(max_size=max_size):
+                actual = list(self.file._iter_decompressed(
+                    [gzip.compress(zeros)], max_size=max_size))
+                self.assertTrue(all(len(i) <= max_size for i in actual))
+                self.assertEqual(zeros, b''.join(actual))
+
+        # 連結された複数のgzipメンバー
+        actual = b''.join(self.file._iter_decompressed(
+            split(gzip.compress(b'abc') + gzip.compress(b'def'), 5)))
+        self.assertEqual(b'abcdef', actual)
+
+        # 異常系 途中で終了している場合
+        with self.assertRaises(EdmanInternalError):
+            b''.join(self.file._iter_decompressed(
+                split(compressed[:-10], 1000)))
+
+        # 異常系 データが壊れている場合
+        with self.assertRaises(EdmanInternalError):
+            b''.join(self.file._iter_decompressed(
+                [compressed[:10], b'broken' * 10]))
+
+    def test__map_files(self):
+        items = list(range(10))
+
+        # 逐次
+        actual = self.file._map_files(lambda x: x * 2, items)
+        self.assertListEqual([i * 2 for i in items], actual)
+
+        # 並列でも入力順を維持する
+        actual = self.file._map_files(lambda x: x * 2, items, max_workers=4)
+        self.assertListEqual([i * 2 for i in items], actual)
+
+        # 異常系
+        with self.assertRaises(EdmanFormatError):
+            self.file._map_files(lambda x: x, items, max_workers=0)
+
+    def test_byte_rate_limiter(self):
+        limiter = ByteRateLimiter(1000)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.consume(100)
+        # 300byteを1000byte/sで転送するので0.3秒以上かかる
+        self.assertGreaterEqual(time.monotonic() - start, 0.29)
+
+        # 異常系
+        with self.assertRaises(EdmanFormatError):
+            ByteRateLimiter(0)
+
     def test_upload(self):
         if not self.db_server_connect:
             return
@@ -1034,6 +1353,118 @@ class TestFile(TestCase):
 
             self.assertListEqual(sorted(actual), sorted(expected))
 
+            # チャンクサイズを指定した場合
+            for oid in self.file.grid_in(td, chunk_size=4):
+                data = self.fs.get(oid)
+                with (Path(tmp_dir) / data.filename).open('rb') as f:
+                    content = f.read()
+                with self.subTest(filename=data.filename):
+                    self.assertEqual(4, data.chunk_size)
+                    self.assertEqual(content, data.read())
+                    self.assertEqual(hashlib.sha256(content).hexdigest(),
+                                     data.sha256)
+
+            # 重複排除
+            dedup_oids = self.file.grid_in(td + td, dedup=True)
+            self.assertListEqual(dedup_oids[:2], dedup_oids[2:])
+            for oid in dedup_oids[:2]:
+                with self.subTest(oid=oid):
+                    self.assertEqual(2, self.testdb['fs.files'].find_one(
+                        {'_id': oid})[Config.fs_refcount])
+            self.assertEqual(2, self.testdb['fs.files'].count_documents(
+                {'_id': {'$in': dedup_oids}}))
+            self.assertEqual(0, self.file.fs_delete(dedup_oids[:2]))
+            self.assertEqual(2, self.file.fs_delete(dedup_oids[2:]))
+
+            # 並列、転送速度制限ありの場合は入力順に結果が返る
+            inserted = self.file.grid_in(td, max_workers=2,
+                                         max_bytes_per_sec=1024 ** 2)
+            actual = [self.fs.get(oid).filename for oid in inserted]
+            self.assertListEqual([p.name for p in td], actual)
+
+        # 異常系 ファイルが存在しない場合
+        with self.assertRaises(EdmanDbProcessError):
+            self.file.grid_in((Path('not_exists.txt'),))
+
+        # 異常系 書き込み途中で失敗した場合はチャンクを残さない
+        class FailingReader(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell() >= 8:
+                    raise errors.AutoReconnect('connection lost')
+                return super().read(size)
+
+        chunks = self.testdb['fs.chunks'].count_documents({})
+        with self.assertRaises(errors.AutoReconnect):
+            self.file._grid_in_stream(FailingReader(b'x' * 10),
+                                      'failing.txt', chunk_size=4)
+        self.assertEqual(chunks, self.testdb['fs.chunks'].count_documents({}))
+        self.assertIsNone(self.testdb['fs.files'].find_one(
+            {'filename': 'failing.txt'}))
+
+    def test_upload_zipped(self):
+        if not self.db_server_connect:
+            return
+
+        self.fs = gridfs.GridFS(self.testdb)
+        json_data = {'parent': {'name': 'test',
+                                Config.file_attachment: ['dir/a.txt'],
+                                'child': {
+                                    'name': 'child',
+                                    Config.file_attachment: ['dir/b.txt',
+                                                             './c.txt']}}}
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('data.json', json.dumps(json_data))
+            zf.writestr('dir/a.txt', b'a' * 1024)
+            zf.writestr('dir/b.txt', b'b')
+            zf.writestr('c.txt', b'c')
+
+        archive.seek(0)
+        actual = self.file.upload_zipped(archive, max_workers=2)
+        parent = actual['parent']
+        self.assertNotIn(Config.file_attachment, parent)
+        self.assertEqual(1, len(parent[Config.file]))
+        self.assertEqual(b'a' * 1024,
+                         self.fs.get(parent[Config.file][0]).read())
+        child_files = [self.fs.get(i) for i in
+                       parent['child'][Config.file]]
+        self.assertListEqual([('b.txt', b'b'), ('c.txt', b'c')],
+                             [(i.filename, i.read()) for i in child_files])
+
+        # 異常系 zip内に存在しないファイル、zipの外を指すパス
+        for path in ['dir/x.txt', '../c.txt', '/c.txt']:
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w') as zf:
+                zf.writestr('data.json', json.dumps(
+                    {'doc': {Config.file_attachment: [path]}}))
+                zf.writestr('c.txt', b'c')
+            archive.seek(0)
+            with self.subTest(path=path):
+                with self.assertRaises(EdmanInternalError):
+                    self.file.upload_zipped(archive)
+
+        # 異常系 jsonファイルが存在しない場合
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('c.txt', b'c')
+        archive.seek(0)
+        with self.assertRaises(EdmanInternalError):
+            self.file.upload_zipped(archive)
+
+    def test_generate_archive_member_dict(self):
+        names = {'a.txt', 'dir/b.txt'}
+        actual = self.file.generate_archive_member_dict(
+            ['a.txt', './dir/b.txt', 'dir\\b.txt'], names)
+        expected = {'a.txt': 'a.txt', './dir/b.txt': 'dir/b.txt',
+                    'dir\\b.txt': 'dir/b.txt'}
+        self.assertDictEqual(expected, actual)
+
+        # 異常系
+        for path in ['c.txt', '../a.txt', '/a.txt', 'dir/../../a.txt']:
+            with self.subTest(path=path):
+                with self.assertRaises(EdmanInternalError):
+                    self.file.generate_archive_member_dict([path], names)
+
     def test_generate_file_path_dict(self):
         with tempfile.TemporaryDirectory() as tmp:
             tmp_p = Path(tmp)
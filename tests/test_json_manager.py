@@ -0,0 +1,66 @@
+import io
+import json
+from logging import ERROR, StreamHandler, getLogger
+from unittest import TestCase
+
+from edman import JsonManager
+from edman.exceptions import EdmanFormatError
+
+
+class TestJsonManager(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.logger = getLogger()
+
+        # ログを画面に出力
+        ch = StreamHandler()
+        ch.setLevel(ERROR)  # ハンドラーにもそれぞれログレベル、フォーマットの設定が可能
+        cls.logger.addHandler(ch)  # StreamHandlerの追加
+
+    def test_iter_events(self):
+
+        data = {'a': [1, 2.5, -3e2, True, False, None],
+                'b': {'c': 'x"y\\u00e9', 'd': []},
+                '日本': '語' * 10}
+        text = json.dumps(data, ensure_ascii=False)
+        expected = [
+            ('start_map', None), ('map_key', 'a'), ('start_array', None),
+            ('value', 1), ('value', 2.5), ('value', -300.0),
+            ('value', True), ('value', False), ('value', None),
+            ('end_array', None), ('map_key', 'b'), ('start_map', None),
+            ('map_key', 'c'), ('value', 'x"y\\u00e9'), ('map_key', 'd'),
+            ('start_array', None), ('end_array', None), ('end_map', None),
+            ('map_key', '日本'), ('value', '語' * 10), ('end_map', None)
+        ]
+
+        # バッファの境界で値が分割されても同じ結果になる
+        for buffer_size in (1, 3, 65536):
+            with self.subTest(buffer_size=buffer_size):
+                actual = list(JsonManager.iter_events(
+                    io.StringIO(text), buffer_size))
+                self.assertListEqual(expected, actual)
+                actual = list(JsonManager.iter_events(
+                    io.BytesIO(text.encode()), buffer_size))
+                self.assertListEqual(expected, actual)
+
+        # 異常系
+        for i in ['{"a": 1', '{"a": tru}', '{"a": 1]', '{"a": "x',
+                  '{"a" {"x" 1 "y" 2}}', '{"a": 1 "b": 2}', '[1,, 2]',
+                  '[1 2 3]', '{"a": 1,}', '[1,]', '{1: 2}', '{"a": 1} x',
+                  '{"a": 1} {"b": 2}', '1 2', '', '{"a": 1x}', ':1',
+                  '{"a": "x\\u12"}']:
+            with self.subTest(i=i):
+                with self.assertRaises(EdmanFormatError):
+                    list(JsonManager.iter_events(io.StringIO(i), 2))
+
+        # 不完全なUTF-8
+        with self.assertRaises(EdmanFormatError):
+            list(JsonManager.iter_events(
+                io.BytesIO('["語"]'.encode()[:-3]), 2))
+
+        # 閉じられていない文字列で残りを全て読み込まない
+        fp = io.BytesIO(('{"a": "x\n' + 'y' * 100000 + '"}').encode())
+        with self.assertRaises(EdmanFormatError):
+            list(JsonManager.iter_events(fp, 10))
+        self.assertLess(fp.tell(), 100)
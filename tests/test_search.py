@@ -11,7 +11,7 @@ from bson import DBRef, ObjectId, errors
 from pymongo import MongoClient
 from pymongo import errors as py_errors
 
-from edman import DB, Config, Convert, Search
+from edman import DB, Config, Convert, DocumentCache, Search
 
 
 class TestSearch(TestCase):
@@ -233,6 +233,26 @@ class TestSearch(TestCase):
             self.assertEqual(v[parent2_coll][self.child][0].id, data3['_id'])
             self.assertEqual(v[parent2_coll]['_id'], data3[self.parent].id)
 
+        # 祖先のリファレンス情報が付与されている場合も同じ構造になる
+        expected = self.search._get_parent({self_coll: data3}, depth=2)
+        self.db.backfill_ancestors([parent_coll])
+        data3 = db[self_coll].find_one({'_id': data3_id})
+        for depth in (1, 2, 3):
+            with self.subTest(depth=depth):
+                actual = self.search._get_parent({self_coll: data3},
+                                                 depth=depth)
+                parent_keys = list(actual[parent_coll].keys()) if (
+                        parent_coll in actual) else []
+                if depth == 1:
+                    self.assertIn(parent2_coll, actual)
+                else:
+                    self.assertIn(parent2_coll, parent_keys)
+        actual = self.search._get_parent({self_coll: data3}, depth=2)
+        self.assertEqual(expected[parent_coll]['_id'],
+                         actual[parent_coll]['_id'])
+        self.assertEqual(expected[parent_coll][parent2_coll]['_id'],
+                         actual[parent_coll][parent2_coll]['_id'])
+
 
         # テスト
         # parent_col = 'Beamtime'
@@ -794,10 +814,58 @@ class TestSearch(TestCase):
         self.assertDictEqual(mid_all_tree, last_all_tree)
         self.assertDictEqual(last_all_tree, top_all_tree)
 
+        # tree_cacheを指定した場合は2回目以降キャッシュから取得する
+        tree_cache = DocumentCache()
+        search = Search(self.db, tree_cache=tree_cache)
+        try:
+            self.assertDictEqual(top_all_tree,
+                                 search.get_tree(parent_col, docs['_id']))
+            self.assertDictEqual(top_all_tree,
+                                 search.get_tree(parent_col, docs['_id']))
+            self.assertDictEqual(
+                self.search.get_tree(parent_col, docs['_id'],
+                                     include=['_id']),
+                search.get_tree(parent_col, docs['_id'], include=['_id']))
+            self.assertEqual(2, tree_cache.hits)
+
+            # ツリー内のドキュメントが破棄されるとツリーも破棄される
+            tree_cache.invalidate('layer_test5', [self_doc_id])
+            self.assertEqual(0, len(tree_cache))
+
+            # DB(cache=...)と同じキャッシュでもドキュメントとツリーは衝突しない
+            self.db.cache = tree_cache
+            self.assertListEqual([tree_cache], self.db.caches)
+            search.get_tree(parent_col, docs['_id'])
+            self.assertEqual(docs['_id'], self.db._dereference(
+                DBRef(parent_col, docs['_id']))['_id'])
+            self.assertDictEqual(top_all_tree,
+                                 search.get_tree(parent_col, docs['_id']))
+
+            # このDBからの更新でツリーも破棄される
+            self.db.update('layer_test5', self_doc_id, {'v': 1}, 'ref')
+            self.assertIsNone(tree_cache.get(
+                (Search._tree_namespace, parent_col), docs['_id']))
+            self.assertNotEqual(top_all_tree,
+                                search.get_tree(parent_col, docs['_id']))
+        finally:
+            self.db.cache = None
+            self.db._extra_caches.clear()
+
         # oidを含むツリーを取得する場合(例としてpx-appの詳細画面のtree取得を想定)
         # test_tree = self.search.get_tree('layer_test5', self_doc_id, include=['_id'])
         # print(test_tree)
 
+    def test__tree_members(self):
+        oids = [ObjectId() for _ in range(4)]
+        tree = {'a': {'_id': oids[0], 'emb': {'v': 1},
+                      'b': [{'_id': oids[1],
+                             'c': [{'_id': oids[2]}, {'_id': oids[3]}]}],
+                      'list': [1, 2]}}
+        actual = list(Search._tree_members(tree))
+        expected = [('a', oids[0]), ('b', oids[1]), ('c', oids[2]),
+                    ('c', oids[3])]
+        self.assertListEqual(expected, actual)
+
     def test_doc2(self):
         if not self.db_server_connect:
             return